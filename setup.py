@@ -15,6 +15,7 @@ REQUIREMENTS = [
 ]
 
 EXTRAS_REQUIRE = {
+    'bigwig': ['pyBigWig'],
     'dev': [
         'sphinx', 'sphinx-autobuild', 'sphinx-rtd-theme', 'bumpversion',
         'pytest>=2.7', 'pytest-mock', 'pytest-helpers-namespace', 'pytest-cov',
@@ -1,4 +1,6 @@
-from .base import Track, DummyTrack, plot_tracks
+from .base import Track, DummyTrack, plot_genes, plot_tracks
 from .feature import FeatureTrack, RugTrack
-from .gene import BiomartTrack, GtfTrack
-from .ngs import CoverageTrack, SpliceTrack
+from .gene import BiomartTrack, GeneTrack, GtfTrack
+from .ngs import (AlignmentTrack, CoverageTrack, MultiCoverageTrack,
+                  ReadFilter, SashimiTrack, SpliceTrack)
+from .signal import SignalTrack
@@ -1,3 +1,5 @@
+from concurrent import futures
+
 import numpy as np
 from matplotlib import pyplot as plt
 
@@ -6,6 +8,8 @@ try:
 except ImportError:
     sns = None
 
+from geneviz.util.tabix import GeneIndex
+
 
 class Track(object):
     """Abstract base class representing a Geneviz track.
@@ -45,6 +49,43 @@ class Track(object):
 
         return 1
 
+    def prefetch_task(self, region, ax):
+        """Returns a task that fetches the data required for drawing.
+
+        Used by plot_tracks to fetch data for multiple tracks in parallel
+        using a process pool. Tracks that support prefetching should return
+        a picklable callable without arguments, whose result is passed to
+        **set_prefetched** before the track is drawn. By default, tracks do
+        not support prefetching and None is returned.
+
+        Parameters
+        ----------
+        region : Tuple[str, int, int]
+            Genomic region that will be drawn.
+        ax : matplotlib.Axes
+            Axis that the track will be drawn on.
+
+        Returns
+        -------
+        Callable[[], Any]
+            Task that fetches the data, or None if not supported.
+
+        """
+        return None
+
+    def set_prefetched(self, region, data):
+        """Stores prefetched data, to be used when drawing the region.
+
+        Parameters
+        ----------
+        region : Tuple[str, int, int]
+            Genomic region that will be drawn.
+        data : Any
+            Result of the task returned by **prefetch_task**.
+
+        """
+        raise NotImplementedError()
+
     def draw(self, region, ax):
         """Draws the track on the given axis.
 
@@ -117,7 +158,8 @@ def plot_tracks(tracks,
                 tick_top=False,
                 padding=(0, 0),
                 reverse=False,
-                despine=False):
+                despine=False,
+                n_jobs=1):
     """Plots given tracks over the specified range on shared axes.
 
     Parameters
@@ -139,6 +181,10 @@ def plot_tracks(tracks,
     reverse : bool
         Whether the x-axis should be reversed, useful for drawing features
         on the reverse strand from left to right.
+    n_jobs : int
+        Number of processes to use for fetching track data in parallel
+        before drawing (for tracks that support prefetching, such as
+        CoverageTrack). Data is fetched in the main process if n_jobs is 1.
 
     Returns
     -------
@@ -173,6 +219,10 @@ def plot_tracks(tracks,
 
     axes[0].set_xlim(x_start, x_end)
 
+    # Fetch data for tracks in parallel if requested.
+    if n_jobs > 1:
+        _prefetch_tracks(tracks, region, axes, n_jobs)
+
     # Plot tracks.
     for track, ax in zip(tracks, axes):
         track.draw(region, ax)
@@ -198,6 +248,75 @@ def plot_tracks(tracks,
     return fig
 
 
+def plot_genes(tracks, gene_ids, index, flank=0, field='gene_id', **kwargs):
+    """Plots given tracks around the locations of the given genes.
+
+    Gene locations are resolved in bulk using a gene index, after which
+    the tracks are plotted for each gene using **plot_tracks**.
+
+    Parameters
+    ----------
+    tracks : List[Track]
+        List of tracks to draw.
+    gene_ids : List[str]
+        Ids (or names) of the genes to plot.
+    index : Union[GeneIndex, Path]
+        Gene index used to locate the genes. If a path is given, this is
+        assumed to be the path of a GTF file, whose index is loaded (or
+        built if needed).
+    flank : Union[int, Tuple[int, int]]
+        Amount of flanking sequence to include around each gene, either
+        as a single value or as a tuple of (left, right) values in
+        genomic coordinates.
+    field : str
+        Field to look up genes by, either 'gene_id' or 'gene_name'.
+    **kwargs
+        Any kwargs are passed to plot_tracks.
+
+    Yields
+    ------
+    Tuple[str, matplotlib.Figure]
+        Gene id and figure for each of the given genes.
+
+    """
+
+    if not isinstance(index, GeneIndex):
+        index = GeneIndex.from_gtf(index)
+
+    if not isinstance(flank, tuple):
+        flank = (flank, flank)
+
+    gene_ids = list(gene_ids)
+    locations = index.locate(gene_ids, field=field)
+
+    missing = [gid for gid, loc in zip(gene_ids, locations) if loc is None]
+    if missing:
+        raise ValueError('Genes {} do not exist'.format(', '.join(missing)))
+
+    for gene_id, (chromosome, start, end, _) in zip(gene_ids, locations):
+        region = (chromosome, max(start - flank[0], 0), end + flank[1])
+        yield gene_id, plot_tracks(tracks, region, **kwargs)
+
+
+def _prefetch_tracks(tracks, region, axes, n_jobs):
+    """Fetches data of tracks that support prefetching in parallel."""
+
+    tasks = [(track, track.prefetch_task(region, ax))
+             for track, ax in zip(tracks, axes)]
+    tasks = [(track, task) for track, task in tasks if task is not None]
+
+    if tasks:
+        with futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = executor.map(_run_task, [task for _, task in tasks])
+
+            for (track, _), result in zip(tasks, results):
+                track.set_prefetched(region, result)
+
+
+def _run_task(task):
+    return task()
+
+
 def _calc_height_ratios(tracks, region, figsize, reverse):
     """Calculates height ratios based on heights of given tracks."""
 
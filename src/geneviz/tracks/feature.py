@@ -185,7 +185,7 @@ class FeatureTrack(Track):
             ax=ax,
             spacing=self._spacing)
 
-        return stacked['y'].max() + self._height + self._spacing
+        return _max_y(stacked) + self._height + self._spacing
 
     def _fetch_data(self, region):
         """Fetches features within a given region."""
@@ -248,7 +248,7 @@ class FeatureTrack(Track):
                     self._draw_label_single(tup, ax)
 
         # Set ylim and style axes.
-        ax.set_ylim(0, stacked['y'].max() + self._height + self._spacing)
+        ax.set_ylim(0, _max_y(stacked) + self._height + self._spacing)
         ax.set_yticks([])
 
     def _feature_patch(self, tup):
@@ -373,6 +373,9 @@ def stack(data, group=None, label=None, label_func=None, ax=None,
 
     # TODO: Refactor out label function? (Not a core feature of stack).
 
+    if len(data) == 0:
+        return data.assign(y=pd.Series([], dtype=float, index=data.index))
+
     if group is not None:
         agg_funcs = {'start': min, 'end': max, 'height': max}
 
@@ -396,6 +399,11 @@ def stack(data, group=None, label=None, label_func=None, ax=None,
         return pd.concat([data, heights], axis=1)
 
 
+def _max_y(stacked):
+    """Returns the maximum y-offset of stacked features (0 if empty)."""
+    return stacked['y'].max() if len(stacked) > 0 else 0
+
+
 def _stack(data, label=None, label_func=None, ax=None, spacing=0.05):
     if label is not None:
         data = _augment_with_labels(data, label, label_func, ax)
@@ -10,16 +10,32 @@ following tracks:
 
 """
 
+from collections import OrderedDict
+import functools
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
-import pybiomart
-import toolz
+
+try:
+    import pybiomart
+except ImportError:
+    pybiomart = None
 
 from geneviz.tracks.base import Track
+from geneviz.util.annotation import AnnotationDatabase
 from geneviz.util.genomic import merge_intervals
-from geneviz.util.tabix import GtfIterator
+from geneviz.util.tabix import GtfIterator, RecordFilter, RegionCache
 
 from .feature import FeatureTrack
 
+# Attributes (key "value" pairs) of GTF records.
+ATTRIBUTE_REGEX = r'(\S+) "([^"]*)"'
+
+# Largest position supported by tabix indices, used to fetch
+# the annotation of a chromosome as a whole.
+MAX_POSITION = 2**29 - 1
+
 
 class _BaseGeneTrack(Track):
     def __init__(self,
@@ -34,7 +50,8 @@ class _BaseGeneTrack(Track):
                  spacing=0.05,
                  label_kws=None,
                  patch_kws=None,
-                 line_kws=None):
+                 line_kws=None,
+                 cache_size=None):
         super().__init__()
 
         self._gene_id = gene_id
@@ -42,6 +59,10 @@ class _BaseGeneTrack(Track):
         self._collapse = collapse
         self._filter = filter
 
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self._last_exons = None
+
         # Determine which grouping feature to use.
         collapse_group_map = {
             'transcript': gene_id,
@@ -49,6 +70,7 @@ class _BaseGeneTrack(Track):
             None: transcript_id
         }
         group = collapse_group_map[collapse]
+        self._group = group
 
         # Setup kws for feature track.
         self._track_kws = {
@@ -65,6 +87,13 @@ class _BaseGeneTrack(Track):
             'line_kws': line_kws
         }
 
+    def __getstate__(self):
+        # Don't pickle cached exons.
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        state['_last_exons'] = None
+        return state
+
     def get_height(self, region, ax):
         track = self._build_track(region)
         return track.get_height(region, ax)
@@ -76,12 +105,61 @@ class _BaseGeneTrack(Track):
     def _fetch_data(self, region):
         raise NotImplementedError()
 
+    def _fetch_group(self):
+        """Returns the column by which _fetch_data selects exons.
+
+        If not None, _fetch_data returns all exons of the groups (e.g.
+        transcripts) overlapping the region, rather than only the exons
+        overlapping the region.
+        """
+        return None
+
     def _fetch_exons(self, region):
-        exons = self._fetch_data(region)
+        if self._cache_size is None:
+            return self._process_exons(self._fetch_data(region))
+
+        # Exons of the last region are kept, as regions are typically
+        # fetched repeatedly when drawing (e.g. by get_height and draw).
+        region = tuple(region)
+
+        if self._last_exons is None or self._last_exons[0] != region:
+            chromosome, start, end = region
+            exons = self._get_exon_index(chromosome).fetch(start, end)
+            self._last_exons = (region, self._process_exons(exons))
+
+        return self._last_exons[1]
+
+    def _get_exon_index(self, chromosome):
+        """Returns index of exons for the given chromosome.
+
+        Indices are built lazily and cached for the last cache_size
+        chromosomes that were queried. Note that each index holds the
+        exons of an entire chromosome in memory.
+        """
+
+        try:
+            index = self._cache.pop(chromosome)
+        except KeyError:
+            exons = self._fetch_data((chromosome, 0, MAX_POSITION))
+            index = _ExonIndex(exons, group=self._fetch_group())
 
-        if self._filter is not None:
+            # Evict least recently used chromosomes.
+            while len(self._cache) >= max(self._cache_size, 1):
+                self._cache.popitem(last=False)
+
+        self._cache[chromosome] = index
+
+        return index
+
+    def _process_exons(self, exons):
+        """Filters and collapses fetched exons."""
+
+        if self._filter is not None and len(exons) > 0:
             exons = exons.query(self._filter)
 
+        if len(exons) == 0:
+            return exons
+
         if self._collapse == 'gene':
             exons = self._collapse_gene(exons)
         elif self._collapse == 'transcript':
@@ -125,7 +203,90 @@ class _BaseGeneTrack(Track):
         return track.draw(region, ax)
 
 
+class _ExonIndex(object):
+    """Positional index over the exons of a single chromosome.
+
+    Exons are indexed individually or by group (e.g. transcript), in which
+    case queries return all exons of the groups overlapping a region. This
+    way, the index selects the same exons as the _fetch_data method of the
+    corresponding track. Groups are ordered by their start position and
+    are located using binary search, which is bounded by the longest span.
+    """
+
+    def __init__(self, exons, group=None):
+        if len(exons) == 0:
+            spans = pd.DataFrame({'start': [], 'end': []})
+            order, exon_rank = np.array([], dtype=int), np.array([], dtype=int)
+        elif group is None:
+            spans = exons[['start', 'end']].reset_index(drop=True)
+            spans = spans.sort_values(['start', 'end'])
+
+            order = spans.index.values
+            exon_rank = np.empty(len(spans), dtype=int)
+            exon_rank[order] = np.arange(len(spans))
+        else:
+            spans = exons.groupby(group).agg({'start': 'min', 'end': 'max'})
+            spans = spans.sort_values(['start', 'end'])
+
+            rank = pd.Series(np.arange(len(spans)), index=spans.index)
+            exon_rank = rank.loc[exons[group]].values
+            order = np.lexsort((exons['start'].values, exon_rank))
+
+        self._exons = exons.iloc[order].reset_index(drop=True)
+        self._starts = spans['start'].values
+        self._ends = spans['end'].values
+        self._offsets = np.searchsorted(
+            exon_rank[order], np.arange(len(spans) + 1), side='left')
+
+        if len(spans) > 0:
+            self._max_span = (self._ends - self._starts).max()
+        else:
+            self._max_span = 0
+
+    def fetch(self, start, end):
+        """Returns exons (of groups) overlapping the given range."""
+
+        lower = np.searchsorted(
+            self._starts, start - self._max_span, side='left')
+        upper = np.searchsorted(self._starts, end, side='right')
+
+        groups = lower + np.flatnonzero(self._ends[lower:upper] >= start)
+
+        # Gather the (consecutive) exon rows of the selected groups.
+        sizes = self._offsets[groups + 1] - self._offsets[groups]
+        rows = (np.repeat(self._offsets[groups] - np.cumsum(sizes) + sizes,
+                          sizes) + np.arange(sizes.sum()))
+
+        return self._exons.iloc[rows]
+
+
 class GeneTrack(_BaseGeneTrack):
+    """Track for plotting gene/transcript annotations from local data.
+
+    Annotations can be given as a DataFrame of exons (containing the columns
+    chromosome, start, end, strand and the gene/transcript id columns) or as
+    a compiled AnnotationDatabase. Compiled databases are memory-mapped and
+    queried using binary search, which makes them suitable for large
+    annotations that are shared between worker processes.
+
+    Parameters
+    ----------
+    data : Union[pandas.DataFrame, AnnotationDatabase, Path]
+        Exon annotation to draw. Paths are opened as AnnotationDatabase.
+    cache_size : int
+        Number of chromosomes for which exons are cached. Note that the
+        cache is bounded by whole chromosomes, each of which is kept in
+        memory in its entirety. If given, exons are fetched once per
+        chromosome and regions are looked up using a positional index.
+        If None (the default), exons are fetched for every region. In both
+        cases, the same exons are drawn: whole transcripts for an
+        AnnotationDatabase and overlapping exons for a DataFrame.
+    **kwargs
+        Other keywords define the aesthetics of the track, similar to
+        other gene tracks.
+
+    """
+
     def __init__(self,
                  data,
                  gene_id='gene_id',
@@ -139,7 +300,8 @@ class GeneTrack(_BaseGeneTrack):
                  spacing=0.05,
                  label_kws=None,
                  patch_kws=None,
-                 line_kws=None):
+                 line_kws=None,
+                 cache_size=None):
 
         super().__init__(
             gene_id=gene_id,
@@ -153,11 +315,27 @@ class GeneTrack(_BaseGeneTrack):
             spacing=spacing,
             label_kws=label_kws,
             patch_kws=patch_kws,
-            line_kws=line_kws)
+            line_kws=line_kws,
+            cache_size=cache_size)
+
+        if isinstance(data, (str, Path)):
+            data = AnnotationDatabase(data)
+
         self._data = data
 
+    def _fetch_group(self):
+        # Databases return overlapping transcripts in full.
+        if isinstance(self._data, AnnotationDatabase):
+            return self._transcript_id
+        return None
+
     def _fetch_data(self, region):
-        raise NotImplementedError()
+        if isinstance(self._data, AnnotationDatabase):
+            return self._data.fetch_frame(*region)
+
+        return self._data.query(
+            ('chromosome == {!r} and end >= {} and start <= {}')
+            .format(*region))  # yapf: disable
 
 
 class GtfTrack(_BaseGeneTrack):
@@ -174,7 +352,9 @@ class GtfTrack(_BaseGeneTrack):
                  spacing=0.05,
                  label_kws=None,
                  patch_kws=None,
-                 line_kws=None):
+                 line_kws=None,
+                 cache_size=None,
+                 region_cache_bytes=64 * 2**20):
         super().__init__(
             gene_id=gene_id,
             transcript_id=transcript_id,
@@ -187,36 +367,55 @@ class GtfTrack(_BaseGeneTrack):
             spacing=spacing,
             label_kws=label_kws,
             patch_kws=patch_kws,
-            line_kws=line_kws)
+            line_kws=line_kws,
+            cache_size=cache_size)
         self._gtf_path = gtf_path
 
+        # Cache raw exon records, so that zooming/panning
+        # only fetches records for regions not seen before.
+        self._region_cache = RegionCache(
+            GtfIterator(gtf_path),
+            max_bytes=region_cache_bytes,
+            filters=[RecordFilter(feature='exon')])
+
     def _fetch_data(self, region):
         # TODO: Ensure we fetch the full transcript.
 
         # Fetch exon records from gtf.
-        gtf_iter = GtfIterator(self._gtf_path)
-        records = gtf_iter.fetch(*region)
+        records = self._region_cache.fetch(*region)
 
         # Convert to DataFrame.
-        exons = pd.DataFrame.from_records(self._records_to_exons(records))
+        return self._batch_to_exons(
+            records, id_columns=[self._gene_id, self._transcript_id])
 
-        return exons
+    @staticmethod
+    def _batch_to_exons(batch, id_columns=()):
+        """Converts a batch of raw GTF records to an exon DataFrame.
 
-    @classmethod
-    def _records_to_exons(cls, records):
-        for record in records:
-            if record.feature == 'exon':
-                yield cls._parse_exon_record(record)
+        If the batch is empty, an empty frame is returned containing the
+        basic exon columns and the given (attribute) id_columns.
+        """
 
-    @staticmethod
-    def _parse_exon_record(record):
-        basic_info = {
-            'chromosome': record.contig,
-            'start': record.start,
-            'end': record.end,
-            'strand': numeric_strand(record.strand)
-        }
-        return toolz.merge(basic_info, dict(record))
+        columns = ['chromosome', 'start', 'end', 'strand']
+
+        if len(batch) == 0:
+            return pd.DataFrame(columns=columns + list(id_columns))
+
+        attributes = pd.DataFrame.from_records(
+            [dict(pairs)
+             for pairs in batch['attributes'].str.findall(ATTRIBUTE_REGEX)],
+            index=batch.index)
+
+        exons = pd.DataFrame(
+            {
+                'chromosome': batch['contig'],
+                'start': batch['start'],
+                'end': batch['end'],
+                'strand': batch['strand'].map(numeric_strand)
+            },
+            columns=columns)
+
+        return pd.concat([exons, attributes], axis=1)
 
 
 def numeric_strand(strand):
@@ -232,10 +431,16 @@ class BiomartTrack(_BaseGeneTrack):
     fashion if transcripts/genes are overlapping. Gene annotations
     are queried directly from Biomart.
 
+    The Biomart dataset is only resolved when annotations are first
+    fetched and is cached per process, so that constructing the track is
+    cheap and the track can be pickled (e.g. for use in process pools).
+
     Args:
         host (str): Biomart host address.
         mart (str): Biomart mart name.
         dataset (str): Biomart dataset name.
+        cache_size (int): Number of (whole) chromosomes for which
+            annotations are cached (see GeneTrack). Disabled if None.
         **kwargs: Keywords are passed to the GeneTrack constructor,
             which is used internally to draw transcripts/genes.
 
@@ -257,7 +462,8 @@ class BiomartTrack(_BaseGeneTrack):
                  spacing=0.05,
                  label_kws=None,
                  patch_kws=None,
-                 line_kws=None):
+                 line_kws=None,
+                 cache_size=None):
         super().__init__(
             gene_id=gene_id,
             transcript_id=transcript_id,
@@ -270,17 +476,28 @@ class BiomartTrack(_BaseGeneTrack):
             spacing=spacing,
             label_kws=label_kws,
             patch_kws=patch_kws,
-            line_kws=line_kws)
+            line_kws=line_kws,
+            cache_size=cache_size)
 
         if pybiomart is None:
             raise ValueError('Pybiomart must be installed to use '
                              'the BiomartGeneTrack ')
 
-        # Fetch dataset from server.
-        server = pybiomart.Server(host=host)
-        self._dataset = (server.marts[mart].datasets[dataset])
+        self._host = host
+        self._mart = mart
+        self._dataset_name = dataset
         self._bm_gene_name = bm_gene_name
 
+    @property
+    def _dataset(self):
+        """Biomart dataset, resolved lazily on first access."""
+        return _get_biomart_dataset(self._host, self._mart,
+                                    self._dataset_name)
+
+    def _fetch_group(self):
+        # Exons are fetched for all transcripts overlapping the region.
+        return 'transcript_id'
+
     def _fetch_data(self, region):
         # TODO: Fetch transcript name instead of id (needs extra query).
 
@@ -322,3 +539,10 @@ class BiomartTrack(_BaseGeneTrack):
         })
 
         return data
+
+
+@functools.lru_cache(maxsize=None)
+def _get_biomart_dataset(host, mart, dataset):
+    """Resolves (and memoizes) a Biomart dataset for the current process."""
+    server = pybiomart.Server(host=host)
+    return server.marts[mart].datasets[dataset]
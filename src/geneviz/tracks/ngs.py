@@ -5,35 +5,129 @@ from builtins import (ascii, bytes, chr, dict, filter, hex, input, int, map,
                       next, oct, open, pow, range, round, str, super, zip)
 from future.utils import native_str
 
+from collections import OrderedDict
+import functools
+import heapq
+import random
+
 import numpy as np
+import pandas as pd
 import pysam
 import toolz
 
-from matplotlib import (path as mpath, collections as mcollections, patches as
-                        mpatches)
+from matplotlib import path as mpath, collections as mcollections
 
 from geneviz.tracks import Track
+from geneviz.util.coverage import CoveragePyramid
 from geneviz.util.tabix import BedIterator
 
+# CIGAR operations (as used by pysam) for aligned bases (M, =, X),
+# deletions (D) and skipped regions (N).
+CIGAR_ALIGNED = {0, 7, 8}
+CIGAR_DEL = 2
+CIGAR_SKIP = 3
+
+# Flags of reads that are skipped by the 'all' pileup stepper:
+# unmapped, secondary, QC-failed and duplicate reads.
+STEPPER_FLAGS = {'all': 0x4 | 0x100 | 0x200 | 0x400, 'nofilter': 0}
+
 
 class SpliceTrack(Track):
+    """Track that plots splice junctions as arcs.
+
+    Junctions are taken from a DataFrame (containing the columns chromosome,
+    start, end and score) or are extracted directly from the reads in a
+    BAM file (see **from_bam**). All arcs are drawn as a single compound
+    path, optionally culling junctions that would not be visible.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Junctions to draw.
+    height : float
+        Height of the track.
+    color : str
+        Color of the arcs.
+    patch_kws : dict[str, Any]
+        Dict of keyword arguments to pass to the PathCollection used
+        to draw the arcs.
+    min_score : float
+        Minimum score of junctions to draw.
+    min_width : float
+        Minimum width (in pixels) of junctions to draw.
+
+    """
 
     _default_kws = dict(facecolor=None, lw=1)
 
-    def __init__(self, data, height=1, color=None, patch_kws=None):
+    def __init__(self,
+                 data,
+                 height=1,
+                 color=None,
+                 patch_kws=None,
+                 min_score=None,
+                 min_width=None):
         super().__init__()
 
         self._data = data
         self._height = height
 
+        self._min_score = min_score
+        self._min_width = min_width
+
         patch_kws = toolz.merge(self._default_kws, {'edgecolor': color},
                                 patch_kws or {})
         self._patch_kws = patch_kws
 
+    @classmethod
+    def from_bam(cls,
+                 bam_path,
+                 min_count=1,
+                 min_anchor=0,
+                 read_filter=None,
+                 cache_size=8,
+                 **kwargs):
+        """Builds a track that extracts junctions from a BAM file.
+
+        Junctions are extracted from the skipped regions (N operations) of
+        the reads in the drawn region, in a single pass over the reads.
+
+        Parameters
+        ----------
+        bam_path : str
+            Path to the (indexed) BAM file.
+        min_count : int
+            Minimum number of reads supporting a junction.
+        min_anchor : int
+            Minimum number of aligned bases flanking both sides of a
+            junction within a read for the read to support the junction.
+        read_filter : ReadFilter
+            Filter selecting the reads used to extract junctions. Defaults
+            to excluding unmapped, secondary, QC-failed and duplicate reads.
+        cache_size : int
+            Number of regions for which junctions are cached. Junctions of
+            regions contained in a cached region are taken from the cache.
+        **kwargs
+            Other keywords are passed to the main constructor.
+
+        """
+
+        junctions = BamJunctions(
+            bam_path,
+            min_count=min_count,
+            min_anchor=min_anchor,
+            read_filter=read_filter,
+            cache_size=cache_size)
+
+        return cls(junctions, **kwargs)
+
     def get_height(self, region, ax):
         return self._height
 
     def _fetch_data(self, region):
+        if isinstance(self._data, BamJunctions):
+            return self._data.fetch(region)
+
         return self._data.query(
             ('chromosome == {!r} and end >= {} and start <= {}')
             .format(*region))  # yapf: disable
@@ -41,60 +135,431 @@ class SpliceTrack(Track):
     def draw(self, region, ax):
         data = self._fetch_data(region)
 
-        arcs = (self._splice_arc(start, end, score)
-                for start, end, score in
-                zip(data['start'], data['end'], data['score'])) # yapf: disable
+        starts = data['start'].values
+        ends = data['end'].values
+        scores = data['score'].values
 
-        patches = mcollections.PatchCollection(arcs, **self._patch_kws)
+        # Cull junctions that are too weak or too narrow to be visible.
+        mask = np.ones(len(data), dtype=bool)
 
-        ax.add_collection(patches)
+        if self._min_score is not None:
+            mask &= scores >= self._min_score
 
-        ax.set_ylim(0, data['score'].max())
+        if self._min_width is not None:
+            xlim = ax.get_xlim()
+            px_per_bp = (ax.get_window_extent().width /
+                         max(abs(xlim[1] - xlim[0]), 1))
+            mask &= (ends - starts) * px_per_bp >= self._min_width
+
+        starts, ends, scores = starts[mask], ends[mask], scores[mask]
+
+        # Draw all arcs as a single compound path.
+        path = self._splice_arcs(starts, ends, scores)
+        ax.add_collection(
+            mcollections.PathCollection([path], **self._patch_kws))
+
+        if len(scores) > 0:
+            ax.set_ylim(0, scores.max())
 
     @staticmethod
-    def _splice_arc(start, end, height):
-        bezier_height = height / 0.75
-        vertices = [(start, 0.), (start, bezier_height), (end, bezier_height),
-                    (end, 0)]
+    def _splice_arcs(starts, ends, heights, start_bases=None, end_bases=None):
+        """Builds a compound path of Bezier arcs for the given junctions.
+
+        Arcs start at zero, unless base heights are given for the start
+        and/or end of the junctions, in which case arcs rise by the given
+        heights above the highest of their two bases.
+        """
+
+        bezier_heights = np.asarray(heights, dtype=float) / 0.75
+        zeros = np.zeros_like(bezier_heights)
 
-        codes = [
+        start_bases = zeros if start_bases is None else start_bases
+        end_bases = zeros if end_bases is None else end_bases
+
+        tops = np.maximum(start_bases, end_bases) + bezier_heights
+
+        # Build vertices as (start, b1), (start, h), (end, h), (end, b2).
+        x = np.column_stack([starts, starts, ends, ends]).ravel()
+        y = np.column_stack([start_bases, tops, tops, end_bases]).ravel()
+
+        codes = np.tile([
             mpath.Path.MOVETO, mpath.Path.CURVE4, mpath.Path.CURVE4,
             mpath.Path.CURVE4
-        ]
+        ], len(bezier_heights)).astype(mpath.Path.code_type)
+
+        return mpath.Path(np.column_stack([x, y]).astype(float), codes)
+
+
+class BamJunctions(object):
+    """Extracts (and caches) splice junctions from the reads in a BAM file.
+
+    See SpliceTrack.from_bam for a description of the parameters.
+    """
+
+    def __init__(self,
+                 bam_path,
+                 min_count=1,
+                 min_anchor=0,
+                 read_filter=None,
+                 cache_size=8):
+        self._bam_path = bam_path
+        self._min_count = min_count
+        self._min_anchor = min_anchor
+        self._read_filter = read_filter or ReadFilter(
+            exclude_flags=STEPPER_FLAGS['all'])
+
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        return state
+
+    def fetch(self, region):
+        """Returns junctions overlapping the given region.
+
+        Returns
+        -------
+        pandas.DataFrame
+            DataFrame containing the columns chromosome, start, end and
+            score (the number of supporting reads) of each junction.
+
+        """
+
+        chromosome, start, end = region
+
+        # Look for a cached region containing the requested region.
+        for cached_region in reversed(self._cache):
+            if (cached_region[0] == chromosome and
+                    cached_region[1] <= start and cached_region[2] >= end):
+                junctions = self._cache.pop(cached_region)
+                self._cache[cached_region] = junctions
+                break
+        else:
+            junctions = self._extract(region)
+
+            if self._cache_size > 0:
+                while len(self._cache) >= self._cache_size:
+                    self._cache.popitem(last=False)
+                self._cache[tuple(region)] = junctions
+
+        mask = (junctions['end'] >= start) & (junctions['start'] <= end)
+        return junctions.loc[mask]
+
+    def _extract(self, region):
+        with pysam.AlignmentFile(native_str(self._bam_path), 'rb') as file_:
+            reads = (read for read in file_.fetch(*region)
+                     if self._read_filter.matches(read))
+            starts, ends, counts = junction_counts(
+                reads, min_anchor=self._min_anchor)
 
-        path = mpath.Path(vertices, codes)
-        patch = mpatches.PathPatch(path)
+        mask = counts >= self._min_count
 
-        return patch
+        return pd.DataFrame(
+            {
+                'chromosome': region[0],
+                'start': starts[mask],
+                'end': ends[mask],
+                'score': counts[mask]
+            },
+            columns=['chromosome', 'start', 'end', 'score'])
+
+
+class ReadFilter(object):
+    """Declarative filter selecting reads by flags, mapping quality and strand.
+
+    Filters can be evaluated on individual reads (when fetching reads) or in
+    a vectorized fashion on arrays of read flags and mapping qualities,
+    which allows multiple filters to be applied to the same set of reads.
+
+    Parameters
+    ----------
+    min_mapq : int
+        Minimum mapping quality of reads.
+    include_flags : int
+        Flags that must all be set for a read to be included.
+    exclude_flags : int
+        Flags of which none may be set for a read to be included.
+    strand : str
+        Strand of the reads to include ('+' or '-'). If None, reads
+        from both strands are included.
+
+    """
+
+    def __init__(self,
+                 min_mapq=0,
+                 include_flags=0,
+                 exclude_flags=0,
+                 strand=None):
+        if strand not in {'+', '-', None}:
+            raise ValueError('Unexpected value for strand')
+
+        self.min_mapq = min_mapq
+        self.include_flags = include_flags
+        self.exclude_flags = exclude_flags
+        self.strand = strand
+
+    @property
+    def _strand_flags(self):
+        """Returns (include, exclude) flags corresponding to the strand."""
+        if self.strand == '-':
+            return 0x10, 0
+        elif self.strand == '+':
+            return 0, 0x10
+        return 0, 0
+
+    def merge(self, other):
+        """Returns a filter requiring the conditions of both filters."""
+
+        if (self.strand is not None and other.strand is not None and
+                self.strand != other.strand):
+            raise ValueError('Cannot merge filters on different strands')
+
+        return ReadFilter(
+            min_mapq=max(self.min_mapq, other.min_mapq),
+            include_flags=self.include_flags | other.include_flags,
+            exclude_flags=self.exclude_flags | other.exclude_flags,
+            strand=self.strand or other.strand)
+
+    def matches(self, read):
+        """Checks if the given read passes the filter."""
+
+        strand_incl, strand_excl = self._strand_flags
+        include = self.include_flags | strand_incl
+        exclude = self.exclude_flags | strand_excl
+
+        return (read.mapping_quality >= self.min_mapq and
+                read.flag & include == include and not read.flag & exclude)
+
+    def mask(self, flags, mapqs):
+        """Returns a mask of the reads (given as arrays) passing the filter.
+        """
+
+        strand_incl, strand_excl = self._strand_flags
+        include = self.include_flags | strand_incl
+        exclude = self.exclude_flags | strand_excl
+
+        return ((mapqs >= self.min_mapq) & (flags & include == include) &
+                (flags & exclude == 0))
+
+    def params(self):
+        """Returns the parameters of the filter as a dict."""
+        return {
+            'min_mapq': self.min_mapq,
+            'include_flags': self.include_flags,
+            'exclude_flags': self.exclude_flags,
+            'strand': self.strand
+        }
+
+    def __eq__(self, other):
+        return isinstance(other, ReadFilter) and self.params() == other.params()
+
+    def __repr__(self):
+        params = ', '.join('{}={!r}'.format(key, value)
+                           for key, value in sorted(self.params().items()))
+        return 'ReadFilter({})'.format(params)
 
 
 class CoverageTrack(Track):
+    """Track that plots the read coverage of a BAM file.
+
+    Parameters
+    ----------
+    bam_path : str
+        Path to the (indexed) BAM file.
+    height : float
+        Height of the track.
+    fill : bool
+        Whether to fill the area below the coverage line.
+    stepper : str
+        Pysam stepper, determining which reads are counted.
+    read_filter : ReadFilter
+        Additional filter for selecting the reads that are counted, which
+        is applied while fetching reads from the BAM file.
+    plot_kwargs : dict[str, Any]
+        Keyword arguments to pass to ax.plot when drawing the coverage.
+    resample_interval : int
+        Interval at which to resample per-base coverage for plotting.
+    bins : Union[int, str]
+        Number of bins to reduce the coverage into, or 'auto' to use
+        one bin per pixel of the axis. If given, coverage is computed in
+        chunks and aggregated directly into bins, which bounds memory
+        usage for large regions. Overrides resample_interval.
+    agg : str
+        Aggregate to plot for binned coverage ('mean', 'max' or 'min').
+        Using 'max' retains narrow peaks in large regions.
+    chunk_size : int
+        Size of the chunks (in bp) in which binned coverage is computed.
+    cache_dir : str
+        Directory for caching coverage. If given, coverage of the BAM file
+        is computed once per chromosome and stored as a multi-resolution
+        CoveragePyramid, which is reused by subsequent draws. Note that the
+        first draw of a chromosome computes the coverage of the entire
+        chromosome (not only of the drawn region), which can take a while
+        for large BAM files.
+
+    """
+
     def __init__(self,
                  bam_path,
                  height=1,
                  fill=True,
                  stepper='all',
                  plot_kwargs=None,
-                 resample_interval=None):
+                 resample_interval=None,
+                 bins=None,
+                 agg='mean',
+                 chunk_size=1000000,
+                 cache_dir=None,
+                 read_filter=None):
         super().__init__()
 
+        if agg not in {'mean', 'max', 'min'}:
+            raise ValueError('Unexpected value for agg')
+
         # Bam file parameters.
         self._bam_path = bam_path
         self._stepper = stepper
+        self._read_filter = read_filter
 
         # Draw parameters.
         self._height = height
         self._fill = fill
         self._resample_interval = resample_interval
 
+        self._bins = bins
+        self._agg = agg
+        self._chunk_size = chunk_size
+
+        self._cache_dir = cache_dir
+        self._pyramid = None
+
+        self._prefetched = None
+
         self._plot_kwargs = {} if plot_kwargs is None else plot_kwargs
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pyramid'] = None
+        state['_prefetched'] = None
+        return state
+
     def get_height(self, region, ax):
         return self._height
 
+    def _get_pyramid(self):
+        if self._pyramid is None:
+            self._pyramid = CoveragePyramid(
+                self._bam_path,
+                cache_dir=self._cache_dir,
+                coverage_func=self._compute_coverage,
+                params={
+                    'stepper': self._stepper,
+                    'read_filter': (None if self._read_filter is None else
+                                    self._read_filter.params())
+                },
+                chunk_size=self._chunk_size)
+        return self._pyramid
+
     def _get_coverage(self, region):
+        if self._cache_dir is not None:
+            return self._get_pyramid().fetch(region)
+        return self._compute_coverage(region)
+
+    def _fetch_filter(self):
+        """Returns the filter that is applied when fetching reads."""
+
+        read_filter = ReadFilter(exclude_flags=STEPPER_FLAGS[self._stepper])
+
+        if self._read_filter is not None:
+            read_filter = read_filter.merge(self._read_filter)
+
+        return read_filter
+
+    def _fetch_reads(self, file_, region):
+        """Fetches reads in the region that pass the fetch filter."""
+
+        read_filter = self._fetch_filter()
+        return (read for read in file_.fetch(*region)
+                if read_filter.matches(read))
+
+    def _compute_coverage(self, region):
+        if self._stepper not in STEPPER_FLAGS:
+            return self._get_coverage_pileup(region)
+
+        _, start, end = region
+
+        with pysam.AlignmentFile(native_str(self._bam_path), 'rb') as file_:
+            return block_coverage(
+                self._fetch_reads(file_, region), start, end)
+
+    def _get_binned_coverage(self, region, bins):
+        """Determines coverage aggregated into the given number of bins.
+
+        Coverage is computed in chunks of chunk_size bases, which are reduced
+        into the bins before the next chunk is processed.
+
+        Returns
+        -------
+        Tuple[np.ndarray, Dict[str, np.ndarray]]
+            Bin edges and the mean, max and min coverage of each bin.
+
+        """
+
+        if self._cache_dir is not None:
+            return self._get_pyramid().fetch_binned(region, bins)
+
+        seqname, start, end = region
+        bins = max(min(bins, end - start), 1)
+
+        # Flooring ensures that edges are strictly increasing.
+        edges = np.floor(np.linspace(start, end, bins + 1)).astype(np.int64)
+
+        sums, maxs, mins = None, None, None
+
+        for chunk_start in range(start, end, self._chunk_size):
+            chunk_end = min(chunk_start + self._chunk_size, end)
+            coverage = self._get_coverage((seqname, chunk_start, chunk_end))
+
+            if sums is None:
+                # Allocate bins, allowing for multiple coverage
+                # signals (along the first axis) per track.
+                shape = coverage.shape[:-1] + (bins, )
+                sums = np.zeros(shape, dtype=np.int64)
+                maxs = np.zeros(shape, dtype=np.int32)
+                mins = np.full(shape, np.iinfo(np.int32).max, dtype=np.int32)
+
+            # Determine bins overlapping with chunk and their
+            # offsets within the chunk.
+            first = np.searchsorted(edges, chunk_start, side='right') - 1
+            last = np.searchsorted(edges, chunk_end, side='left')
+            idx = np.arange(first, last)
+
+            offsets = np.maximum(edges[idx], chunk_start) - chunk_start
+
+            sums[..., idx] += np.add.reduceat(
+                coverage, offsets, axis=-1, dtype=np.int64)
+            maxs[..., idx] = np.maximum(
+                maxs[..., idx],
+                np.maximum.reduceat(coverage, offsets, axis=-1))
+            mins[..., idx] = np.minimum(
+                mins[..., idx],
+                np.minimum.reduceat(coverage, offsets, axis=-1))
+
+        aggregates = {'mean': sums / np.diff(edges), 'max': maxs, 'min': mins}
+
+        return edges, aggregates
+
+    def _get_coverage_pileup(self, region):
+        """Determines coverage by counting reads in a pysam pileup.
+
+        Used for steppers other than 'all' and 'nofilter', as these apply
+        additional (base-level) filters during the pileup.
+        """
+
         seqname, start, end = region
-        hist = np.zeros(end - start)
+        hist = np.zeros(end - start, dtype=np.int32)
 
         with pysam.AlignmentFile(native_str(self._bam_path), 'rb') as file_:
             # Truncate = True truncates pileups at start-end
@@ -112,28 +577,929 @@ class CoverageTrack(Track):
                 for read in pileup.pileups:
                     # Is_del == 0 if read is positioned here, i.e.,
                     # this ignores reads spliced over position.
-                    if read.is_del == 0:
+                    if read.is_del == 0 and (
+                            self._read_filter is None or
+                            self._read_filter.matches(read.alignment)):
                         coverage += 1
 
                 hist[pileup.pos - start] = coverage
 
         return hist
 
-    def draw(self, region, ax):
+    def _get_bins(self, ax):
+        if self._bins == 'auto':
+            return int(ax.get_window_extent().width)
+        return self._bins
+
+    def _get_plot_data(self, region, bins=None):
+        """Returns x-positions and coverage values for plotting."""
+
         _, start, end = region
 
-        # Determine coverage.
-        x_range = np.arange(start, end)
-        coverage = self._get_coverage(region)
+        if bins is not None:
+            # Determine binned coverage.
+            edges, aggregates = self._get_binned_coverage(region, bins)
+            x_range, coverage = edges[:-1], aggregates[self._agg]
+        else:
+            # Determine coverage.
+            x_range = np.arange(start, end)
+            coverage = self._get_coverage(region)
 
-        # Resample if needed.
-        if self._resample_interval is not None:
-            x_new = np.arange(start, end, step=self._resample_interval)
-            coverage = np.interp(x_new, xp=x_range, fp=coverage)
-            x_range = x_new
+            # Resample if needed.
+            if self._resample_interval is not None:
+                x_new = np.arange(start, end, step=self._resample_interval)
+                coverage = np.interp(x_new, xp=x_range, fp=coverage)
+                x_range = x_new
+
+        return x_range, coverage
+
+    def prefetch_task(self, region, ax):
+        """Returns a task that computes the coverage for the given region.
+
+        The coverage is computed using the (compact) binned representation
+        if bins is given, which limits the data returned by workers.
+        """
+        return functools.partial(self._get_plot_data, region,
+                                 self._get_bins(ax))
+
+    def set_prefetched(self, region, data):
+        self._prefetched = (region, data)
+
+    def draw(self, region, ax):
+        if self._prefetched is not None and self._prefetched[0] == region:
+            x_range, coverage = self._prefetched[1]
+            self._prefetched = None
+        else:
+            x_range, coverage = self._get_plot_data(region,
+                                                    self._get_bins(ax))
 
         # Plot coverage line.
         ax.plot(x_range, coverage, **self._plot_kwargs)
 
         if self._fill:
             ax.fill_between(x_range, 0, coverage)
+
+
+class MultiCoverageTrack(CoverageTrack):
+    """Track that plots multiple coverage signals from a single BAM file.
+
+    Each signal is defined by a ReadFilter (for example selecting reads on
+    the forward/reverse strand or reads with a minimum mapping quality).
+    All signals are computed in a single pass over the reads in the drawn
+    region and are drawn together on the same axis.
+
+    Parameters
+    ----------
+    bam_path : str
+        Path to the (indexed) BAM file.
+    signals : Dict[str, ReadFilter]
+        Ordered mapping of signal names to the filters defining the signals.
+        A filter of None selects all reads.
+    palette : List[Union[str, Tuple[float, float, float]]]
+        Colors to use for the different signals.
+    legend : bool
+        Whether to draw a legend with the signal names.
+    **kwargs
+        Other keywords are passed to the CoverageTrack constructor.
+        Caching coverage (cache_dir) is not supported for multiple signals.
+
+    """
+
+    def __init__(self, bam_path, signals, palette=None, legend=True, **kwargs):
+        if kwargs.get('cache_dir', None) is not None:
+            raise ValueError('MultiCoverageTrack does not support cache_dir')
+
+        if kwargs.get('stepper', 'all') not in STEPPER_FLAGS:
+            raise ValueError('MultiCoverageTrack only supports the '
+                             '{} steppers'.format(sorted(STEPPER_FLAGS)))
+
+        super().__init__(bam_path, **kwargs)
+
+        self._signals = list(signals.items())
+        self._palette = palette
+        self._legend = legend
+
+    @classmethod
+    def stranded(cls, bam_path, read_filter=None, **kwargs):
+        """Builds a track plotting forward/reverse strand coverage.
+
+        Parameters
+        ----------
+        bam_path : str
+            Path to the (indexed) BAM file.
+        read_filter : ReadFilter
+            Additional filter to apply to the reads of both strands.
+        **kwargs
+            Other keywords are passed to the main constructor.
+
+        """
+
+        read_filter = read_filter or ReadFilter()
+
+        signals = OrderedDict([
+            ('+', read_filter.merge(ReadFilter(strand='+'))),
+            ('-', read_filter.merge(ReadFilter(strand='-')))
+        ])
+
+        return cls(bam_path, signals=signals, **kwargs)
+
+    def _compute_coverage(self, region):
+        _, start, end = region
+        filters = [read_filter for _, read_filter in self._signals]
+
+        with pysam.AlignmentFile(native_str(self._bam_path), 'rb') as file_:
+            return multi_block_coverage(
+                self._fetch_reads(file_, region), start, end, filters)
+
+    def _get_plot_data(self, region, bins=None):
+        if bins is None and self._resample_interval is not None:
+            _, start, end = region
+
+            x_range = np.arange(start, end)
+            coverage = self._get_coverage(region)
+
+            x_new = np.arange(start, end, step=self._resample_interval)
+            coverage = np.vstack([
+                np.interp(x_new, xp=x_range, fp=values) for values in coverage
+            ])
+
+            return x_new, coverage
+
+        return super()._get_plot_data(region, bins=bins)
+
+    def draw(self, region, ax):
+        if self._prefetched is not None and self._prefetched[0] == region:
+            x_range, coverage = self._prefetched[1]
+            self._prefetched = None
+        else:
+            x_range, coverage = self._get_plot_data(region,
+                                                    self._get_bins(ax))
+
+        palette = self._palette or [None] * len(self._signals)
+
+        for (name, _), values, color in zip(self._signals, coverage, palette):
+            plot_kws = toolz.merge(self._plot_kwargs, {'label': name})
+            if color is not None:
+                plot_kws['color'] = color
+
+            line, = ax.plot(x_range, values, **plot_kws)
+
+            if self._fill:
+                ax.fill_between(
+                    x_range, 0, values, color=line.get_color(), alpha=0.3)
+
+        if self._legend:
+            ax.legend(loc='upper right')
+
+
+class AlignmentTrack(Track):
+    """Track that plots individual reads from a BAM file.
+
+    Reads in the drawn region are downsampled to a maximum number of reads
+    per genomic window using reservoir sampling, before any further
+    processing. The sampled reads are packed into rows (using a greedy
+    interval partitioning in O(n log n) time) and are drawn using a
+    small number of vectorized collections. Aligned blocks are drawn as
+    boxes, skipped regions and deletions as connecting lines and
+    mismatches (determined using the MD tag of reads) as colored boxes.
+
+    Parameters
+    ----------
+    bam_path : str
+        Path to the (indexed) BAM file.
+    height : float
+        Height of the track.
+    max_depth : int
+        Maximum number of reads sampled per window, based on the start
+        positions of the reads.
+    window_size : int
+        Size of the windows (in bp) used for downsampling.
+    read_filter : ReadFilter
+        Filter selecting the reads to draw. Defaults to excluding unmapped,
+        secondary, QC-failed and duplicate reads. Unmapped reads (or reads
+        without aligned bases) are always excluded.
+    mismatches : bool
+        Whether to draw mismatches. Requires reads to have MD tags.
+    colors : dict[str, str]
+        Colors to use for reads on the forward ('+') and reverse ('-')
+        strands.
+    mismatch_colors : dict[str, str]
+        Colors to use for mismatching bases.
+    random_state : int
+        Seed used for downsampling, ensuring reproducible plots.
+
+    """
+
+    _default_colors = {'+': 'lightcoral', '-': 'cornflowerblue'}
+
+    _default_mismatch_colors = {
+        'A': 'green',
+        'C': 'blue',
+        'G': 'orange',
+        'T': 'red',
+        'N': 'grey'
+    }
+
+    def __init__(self,
+                 bam_path,
+                 height=2,
+                 max_depth=100,
+                 window_size=100,
+                 read_filter=None,
+                 mismatches=True,
+                 colors=None,
+                 mismatch_colors=None,
+                 random_state=0):
+        super().__init__()
+
+        self._bam_path = bam_path
+        self._height = height
+
+        self._max_depth = max_depth
+        self._window_size = window_size
+        self._read_filter = read_filter or ReadFilter(
+            exclude_flags=STEPPER_FLAGS['all'])
+        self._random_state = random_state
+
+        self._mismatches = mismatches
+        self._colors = toolz.merge(self._default_colors, colors or {})
+        self._mismatch_colors = toolz.merge(self._default_mismatch_colors,
+                                            mismatch_colors or {})
+
+    def get_height(self, region, ax):
+        return self._height
+
+    def _fetch_reads(self, region):
+        """Fetches reads in the region, downsampled per window."""
+
+        rng = random.Random(self._random_state)
+        reservoirs, seen = {}, {}
+
+        with pysam.AlignmentFile(native_str(self._bam_path), 'rb') as file_:
+            for read in file_.fetch(*region):
+                # Unmapped reads can't be drawn, whatever the filter.
+                if read.is_unmapped or read.reference_end is None:
+                    continue
+
+                if not self._read_filter.matches(read):
+                    continue
+
+                window = read.reference_start // self._window_size
+
+                # Reservoir sampling (algorithm R) per window.
+                n_seen = seen.get(window, 0)
+                seen[window] = n_seen + 1
+
+                reservoir = reservoirs.setdefault(window, [])
+
+                if n_seen < self._max_depth:
+                    reservoir.append(read)
+                else:
+                    i = rng.randint(0, n_seen)
+                    if i < self._max_depth:
+                        reservoir[i] = read
+
+        reads = [read for window in sorted(reservoirs)
+                 for read in reservoirs[window]]
+        reads.sort(key=lambda read: read.reference_start)
+
+        return reads
+
+    def draw(self, region, ax):
+        reads = self._fetch_reads(region)
+
+        starts = np.array([read.reference_start for read in reads])
+        ends = np.array([read.reference_end for read in reads])
+        rows = pack_rows(starts, ends)
+
+        blocks, gaps = [], []
+        block_colors = []
+
+        for read, row in zip(reads, rows):
+            read_blocks = read.get_blocks()
+            color = self._colors['-' if read.is_reverse else '+']
+
+            for block_start, block_end in read_blocks:
+                blocks.append((block_start, block_end, row))
+                block_colors.append(color)
+
+            # Connect consecutive blocks (skipped regions/deletions).
+            for (_, prev_end), (next_start, _) in zip(read_blocks[:-1],
+                                                      read_blocks[1:]):
+                gaps.append(((prev_end, row), (next_start, row)))
+
+        ax.add_collection(
+            mcollections.PolyCollection(
+                _box_vertices(blocks, height=0.8),
+                facecolors=block_colors,
+                edgecolors='none'))
+
+        ax.add_collection(
+            mcollections.LineCollection(gaps, colors='grey', linewidths=0.5))
+
+        if self._mismatches:
+            mismatches, colors = self._mismatch_boxes(reads, rows)
+            ax.add_collection(
+                mcollections.PolyCollection(
+                    _box_vertices(mismatches, height=0.8),
+                    facecolors=colors,
+                    edgecolors='none'))
+
+        n_rows = rows.max() + 1 if len(rows) > 0 else 1
+        ax.set_ylim(n_rows, -0.2)
+        ax.set_yticks([])
+
+    def _mismatch_boxes(self, reads, rows):
+        """Determines positions and colors of mismatching bases."""
+
+        boxes, colors = [], []
+
+        for read, row in zip(reads, rows):
+            if not read.has_tag('MD'):
+                continue
+
+            sequence = read.query_sequence
+            pairs = read.get_aligned_pairs(matches_only=True, with_seq=True)
+
+            for query_pos, ref_pos, ref_base in pairs:
+                # Mismatching reference bases are lowercase.
+                if ref_base.islower():
+                    base = sequence[query_pos]
+                    boxes.append((ref_pos, ref_pos + 1, row))
+                    colors.append(self._mismatch_colors.get(base, 'grey'))
+
+        return boxes, colors
+
+
+class SashimiTrack(Track):
+    """Track that plots read coverage together with splice junctions.
+
+    Coverage and junctions are both determined from a single pass over the
+    reads in the drawn region: the aligned blocks of the reads are summed
+    into coverage using a difference array, whereas their skipped regions
+    are counted as junctions. Junctions are drawn as arcs on top of the
+    coverage, connecting the coverage at both ends of the junction. The
+    combined result is cached per region, so that redrawing a region does
+    not require reading the BAM file again.
+
+    Parameters
+    ----------
+    bam_path : str
+        Path to the (indexed) BAM file.
+    height : float
+        Height of the track.
+    min_count : int
+        Minimum number of reads supporting a junction.
+    min_anchor : int
+        Minimum number of aligned bases flanking both sides of a
+        junction within a read for the read to support the junction.
+    read_filter : ReadFilter
+        Filter selecting the reads used for coverage and junctions. Defaults
+        to excluding unmapped, secondary, QC-failed and duplicate reads.
+    bins : Union[int, str]
+        Number of bins to average the coverage into before drawing, or
+        'auto' to use one bin per pixel of the axis. If None, per-base
+        coverage is drawn.
+    color : str
+        Color of the coverage and the arcs.
+    labels : bool
+        Whether to label arcs with their read counts.
+    fill_kws : dict[str, Any]
+        Keyword arguments to pass to ax.fill_between when drawing
+        the coverage.
+    patch_kws : dict[str, Any]
+        Keyword arguments to pass to the PathCollection used to draw
+        the arcs.
+    cache_size : int
+        Number of regions for which coverage and junctions are cached.
+
+    """
+
+    def __init__(self,
+                 bam_path,
+                 height=2,
+                 min_count=1,
+                 min_anchor=0,
+                 read_filter=None,
+                 bins='auto',
+                 color='steelblue',
+                 labels=True,
+                 fill_kws=None,
+                 patch_kws=None,
+                 cache_size=8):
+        super().__init__()
+
+        self._bam_path = bam_path
+        self._height = height
+
+        self._min_count = min_count
+        self._min_anchor = min_anchor
+        self._read_filter = read_filter or ReadFilter(
+            exclude_flags=STEPPER_FLAGS['all'])
+
+        self._bins = bins
+        self._labels = labels
+
+        self._fill_kws = toolz.merge({'color': color, 'lw': 0}, fill_kws or
+                                     {})
+        self._patch_kws = toolz.merge({
+            'facecolor': 'none',
+            'edgecolor': color,
+            'lw': 1
+        }, patch_kws or {})
+
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        return state
+
+    def get_height(self, region, ax):
+        return self._height
+
+    def _compute_data(self, region):
+        """Determines coverage and junctions in a single pass over reads."""
+
+        _, start, end = region
+
+        with pysam.AlignmentFile(native_str(self._bam_path), 'rb') as file_:
+            reads = (read for read in file_.fetch(*region)
+                     if self._read_filter.matches(read))
+            coverage, (starts, ends, counts) = sashimi_counts(
+                reads, start, end, min_anchor=self._min_anchor)
+
+        mask = counts >= self._min_count
+
+        junctions = pd.DataFrame(
+            {
+                'chromosome': region[0],
+                'start': starts[mask],
+                'end': ends[mask],
+                'score': counts[mask]
+            },
+            columns=['chromosome', 'start', 'end', 'score'])
+
+        return coverage, junctions
+
+    def _cache_data(self, region, data):
+        if self._cache_size > 0:
+            self._cache.pop(region, None)
+            while len(self._cache) >= self._cache_size:
+                self._cache.popitem(last=False)
+            self._cache[region] = data
+
+    def _fetch_data(self, region):
+        """Returns (cached) coverage and junctions for the given region."""
+
+        region = tuple(region)
+
+        try:
+            data = self._cache.pop(region)
+        except KeyError:
+            data = self._compute_data(region)
+
+        self._cache_data(region, data)
+
+        return data
+
+    def prefetch_task(self, region, ax):
+        return functools.partial(self._compute_data, tuple(region))
+
+    def set_prefetched(self, region, data):
+        self._cache_data(tuple(region), data)
+
+    def draw(self, region, ax):
+        _, start, end = region
+        coverage, junctions = self._fetch_data(region)
+
+        # Draw (binned) coverage.
+        bins = self._bins
+        if bins == 'auto':
+            bins = int(ax.get_window_extent().width)
+
+        if bins is not None and 0 < bins < len(coverage):
+            offsets = np.floor(np.linspace(0, len(coverage),
+                                           bins + 1)).astype(np.int64)
+            values = (np.add.reduceat(coverage, offsets[:-1]) /
+                      np.diff(offsets))
+            x_range = start + offsets
+        else:
+            values = coverage
+            x_range = np.arange(start, end + 1)
+
+        ax.fill_between(
+            x_range,
+            0,
+            np.append(values, values[-1:]),
+            step='post',
+            **self._fill_kws)
+
+        # Draw junctions as arcs between the coverage flanking junctions.
+        starts = junctions['start'].values
+        ends = junctions['end'].values
+        scores = junctions['score'].values
+
+        start_bases = _lookup_coverage(coverage, starts - 1 - start)
+        end_bases = _lookup_coverage(coverage, ends - start)
+
+        path = SpliceTrack._splice_arcs(
+            starts, ends, scores, start_bases=start_bases, end_bases=end_bases)
+        ax.add_collection(
+            mcollections.PathCollection([path], **self._patch_kws))
+
+        tops = np.maximum(start_bases, end_bases) + scores
+
+        if self._labels:
+            for junction_start, junction_end, top, score in zip(
+                    starts, ends, tops, scores):
+                ax.text((junction_start + junction_end) / 2, top, str(score),
+                        ha='center', va='bottom', fontsize='small')
+
+        y_max = max(coverage.max() if len(coverage) > 0 else 0,
+                    tops.max() if len(tops) > 0 else 0)
+        ax.set_ylim(0, max(y_max * 1.1, 1))
+
+
+def _lookup_coverage(coverage, indices):
+    """Looks up coverage values, using zero for out-of-range indices."""
+
+    indices = np.asarray(indices, dtype=np.int64)
+    in_range = (indices >= 0) & (indices < len(coverage))
+
+    values = np.zeros(len(indices), dtype=float)
+    values[in_range] = coverage[indices[in_range]]
+
+    return values
+
+
+def pack_rows(starts, ends, spacing=1):
+    """Assigns intervals to rows so that intervals in a row don't overlap.
+
+    Intervals are processed in order of their start positions, keeping track
+    of occupied rows in a heap (ordered by the end positions of their
+    last interval) and of free rows in a second heap. Each interval is
+    assigned to the lowest free row, resulting in an O(n log n) packing.
+
+    Parameters
+    ----------
+    starts : np.ndarray
+        Start positions of the intervals.
+    ends : np.ndarray
+        End positions of the intervals.
+    spacing : int
+        Minimum distance between intervals in the same row.
+
+    Returns
+    -------
+    np.ndarray
+        Row assigned to each interval.
+
+    """
+
+    rows = np.zeros(len(starts), dtype=np.int64)
+
+    occupied, free = [], []
+    n_rows = 0
+
+    for i in np.argsort(starts, kind='mergesort'):
+        # Release rows whose last interval ends before this one.
+        while occupied and occupied[0][0] + spacing <= starts[i]:
+            _, row = heapq.heappop(occupied)
+            heapq.heappush(free, row)
+
+        if free:
+            row = heapq.heappop(free)
+        else:
+            row = n_rows
+            n_rows += 1
+
+        rows[i] = row
+        heapq.heappush(occupied, (ends[i], row))
+
+    return rows
+
+
+def _box_vertices(boxes, height):
+    """Builds polygon vertices for (start, end, row) boxes."""
+
+    if len(boxes) == 0:
+        return np.zeros((0, 4, 2))
+
+    boxes = np.array(boxes, dtype=float)
+    starts, ends, rows = boxes[:, 0], boxes[:, 1], boxes[:, 2]
+
+    x = np.column_stack([starts, ends, ends, starts])
+    y = np.column_stack([rows, rows, rows + height, rows + height])
+
+    return np.stack([x, y], axis=-1)
+
+
+def junction_counts(reads, min_anchor=0):
+    """Counts the splice junctions spanned by the given reads.
+
+    Junctions correspond to skipped regions (N operations) in the CIGAR
+    strings of the reads. Reads only support a junction if they have at
+    least min_anchor aligned bases on both sides of the junction.
+
+    Parameters
+    ----------
+    reads : Iterable[pysam.AlignedSegment]
+        Reads to extract junctions from.
+    min_anchor : int
+        Minimum number of aligned bases flanking both sides of a junction.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        Arrays containing the start, end and read count of each junction,
+        sorted by position.
+
+    """
+
+    junction_starts, junction_ends = [], []
+
+    for read in reads:
+        _read_junctions(read, min_anchor, junction_starts, junction_ends)
+
+    return _count_junctions(junction_starts, junction_ends)
+
+
+def sashimi_counts(reads, start, end, min_anchor=0):
+    """Calculates coverage and junction counts in a single pass over reads.
+
+    Parameters
+    ----------
+    reads : Iterable[pysam.AlignedSegment]
+        Reads to calculate coverage and junctions for.
+    start : int
+        Start of the range (0-based, inclusive).
+    end : int
+        End of the range (0-based, exclusive).
+    min_anchor : int
+        Minimum number of aligned bases flanking both sides of a junction.
+
+    Returns
+    -------
+    Tuple[np.ndarray, Tuple[np.ndarray, np.ndarray, np.ndarray]]
+        Per-base coverage over the range (see **block_coverage**) and the
+        start, end and read count of each junction (see
+        **junction_counts**).
+
+    """
+
+    blocks, overlaps, pending = [], [], {}
+    junction_starts, junction_ends = [], []
+
+    for read in reads:
+        read_blocks = read.get_blocks()
+        blocks += read_blocks
+        overlaps += _mate_overlaps(read, read_blocks, pending)[0]
+
+        _read_junctions(read, min_anchor, junction_starts, junction_ends)
+
+    coverage = _block_coverage(blocks, start, end) - _block_coverage(
+        overlaps, start, end)
+    junctions = _count_junctions(junction_starts, junction_ends)
+
+    return coverage, junctions
+
+
+def _read_junctions(read, min_anchor, junction_starts, junction_ends):
+    """Appends the (sufficiently anchored) junctions of a read to lists."""
+
+    cigar = read.cigartuples
+
+    if cigar is None:
+        return
+
+    # Collect aligned bases between skipped regions.
+    position = read.reference_start
+    anchors, skips = [0], []
+
+    for operation, length in cigar:
+        if operation == CIGAR_SKIP:
+            skips.append((position, position + length))
+            anchors.append(0)
+            position += length
+        elif operation in CIGAR_ALIGNED:
+            anchors[-1] += length
+            position += length
+        elif operation == CIGAR_DEL:
+            position += length
+
+    for i, (skip_start, skip_end) in enumerate(skips):
+        if anchors[i] >= min_anchor and anchors[i + 1] >= min_anchor:
+            junction_starts.append(skip_start)
+            junction_ends.append(skip_end)
+
+
+def _count_junctions(junction_starts, junction_ends):
+    """Counts occurrences of unique junctions."""
+
+    if len(junction_starts) == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, empty
+
+    junctions = np.column_stack([
+        np.array(junction_starts, dtype=np.int64),
+        np.array(junction_ends, dtype=np.int64)
+    ])
+
+    unique, counts = np.unique(junctions, axis=0, return_counts=True)
+
+    return unique[:, 0], unique[:, 1], counts
+
+
+def block_coverage(reads, start, end):
+    """Calculates per-base coverage of reads over the given range.
+
+    Coverage is calculated from the aligned blocks of each read, which
+    excludes deletions and skipped (spliced) regions of the reads. Block
+    boundaries are accumulated into a difference array, which is summed
+    to obtain the coverage. Similar to pysam pileups, bases covered by
+    both mates of an (overlapping) read pair are only counted once. In
+    contrast to pysam pileups, no minimum base quality is applied.
+
+    Parameters
+    ----------
+    reads : Iterable[pysam.AlignedSegment]
+        Reads to calculate the coverage for.
+    start : int
+        Start of the range (0-based, inclusive).
+    end : int
+        End of the range (0-based, exclusive).
+
+    Returns
+    -------
+    np.ndarray
+        Array of length end - start containing the coverage per position.
+
+    """
+
+    blocks, overlaps, pending = [], [], {}
+
+    for read in reads:
+        read_blocks = read.get_blocks()
+        blocks += read_blocks
+        overlaps += _mate_overlaps(read, read_blocks, pending)[0]
+
+    return _block_coverage(blocks, start, end) - _block_coverage(
+        overlaps, start, end)
+
+
+def multi_block_coverage(reads, start, end, filters):
+    """Calculates coverage of multiple read subsets in a single pass.
+
+    Aligned blocks and properties (flags, mapping qualities) of the reads
+    are collected once, after which each filter is applied to the read
+    properties in a vectorized fashion to calculate its coverage. Bases
+    covered by both mates of a read pair are counted once if both mates
+    pass the filter (see **block_coverage**).
+
+    Parameters
+    ----------
+    reads : Iterable[pysam.AlignedSegment]
+        Reads to calculate the coverage for.
+    start : int
+        Start of the range (0-based, inclusive).
+    end : int
+        End of the range (0-based, exclusive).
+    filters : List[ReadFilter]
+        Filters defining the read subsets. A filter of None includes
+        all reads.
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (len(filters), end - start) containing the coverage
+        of each subset.
+
+    """
+
+    block_starts, block_ends, block_reads = [], [], []
+    overlaps, overlap_reads, overlap_mates = [], [], []
+    flags, mapqs = [], []
+    pending = {}
+
+    for i, read in enumerate(reads):
+        flags.append(read.flag)
+        mapqs.append(read.mapping_quality)
+
+        read_blocks = read.get_blocks()
+        for block_start, block_end in read_blocks:
+            block_starts.append(block_start)
+            block_ends.append(block_end)
+            block_reads.append(i)
+
+        read_overlaps, mate = _mate_overlaps(
+            read, read_blocks, pending, index=i)
+        overlaps += read_overlaps
+        overlap_reads += [i] * len(read_overlaps)
+        overlap_mates += [mate] * len(read_overlaps)
+
+    block_starts = np.array(block_starts, dtype=np.int64)
+    block_ends = np.array(block_ends, dtype=np.int64)
+    block_reads = np.array(block_reads, dtype=np.int64)
+
+    overlaps = np.array(overlaps, dtype=np.int64).reshape(-1, 2)
+    overlap_reads = np.array(overlap_reads, dtype=np.int64)
+    overlap_mates = np.array(overlap_mates, dtype=np.int64)
+
+    flags = np.array(flags, dtype=np.int64)
+    mapqs = np.array(mapqs, dtype=np.int64)
+
+    coverage = np.zeros((len(filters), end - start), dtype=np.int32)
+
+    for i, read_filter in enumerate(filters):
+        if read_filter is None:
+            mask = slice(None)
+            overlap_mask = slice(None)
+        else:
+            read_mask = read_filter.mask(flags, mapqs)
+            mask = read_mask[block_reads]
+            overlap_mask = (read_mask[overlap_reads] &
+                            read_mask[overlap_mates])
+
+        coverage[i] = (
+            _diff_coverage(block_starts[mask], block_ends[mask], start, end) -
+            _diff_coverage(overlaps[overlap_mask, 0],
+                           overlaps[overlap_mask, 1], start, end))
+
+    return coverage
+
+
+def _mate_overlaps(read, blocks, pending, index=None):
+    """Returns the aligned blocks of a read that are also covered by its mate.
+
+    Mates are matched by name, for which pending keeps the blocks (and
+    index) of reads whose mate may overlap them and has not been seen yet.
+    This assumes that reads are given in order of their start positions.
+
+    Returns
+    -------
+    Tuple[List[Tuple[int, int]], Any]
+        Blocks covered by both mates, together with the index of the mate.
+
+    """
+
+    if (not read.is_paired or read.mate_is_unmapped or read.is_secondary or
+            read.is_supplementary or
+            read.reference_id != read.next_reference_id):
+        return [], None
+
+    mate = pending.pop(read.query_name, None)
+
+    if mate is not None:
+        mate_blocks, mate_index = mate
+        return _intersect_blocks(blocks, mate_blocks), mate_index
+
+    if read.reference_start <= read.next_reference_start < read.reference_end:
+        pending[read.query_name] = (blocks, index)
+
+    return [], None
+
+
+def _intersect_blocks(blocks, other_blocks):
+    """Intersects two sorted lists of (non-overlapping) blocks."""
+
+    intersection = []
+    i, j = 0, 0
+
+    while i < len(blocks) and j < len(other_blocks):
+        start = max(blocks[i][0], other_blocks[j][0])
+        end = min(blocks[i][1], other_blocks[j][1])
+
+        if start < end:
+            intersection.append((start, end))
+
+        if blocks[i][1] < other_blocks[j][1]:
+            i += 1
+        else:
+            j += 1
+
+    return intersection
+
+
+def _block_coverage(blocks, start, end):
+    """Sums a list of (start, end) blocks into coverage."""
+
+    blocks = np.array(blocks, dtype=np.int64).reshape(-1, 2)
+    return _diff_coverage(blocks[:, 0], blocks[:, 1], start, end)
+
+
+def _diff_coverage(block_starts, block_ends, start, end):
+    """Sums blocks into coverage using a difference array."""
+
+    size = end - start
+
+    block_starts = np.clip(np.array(block_starts, dtype=np.int64) - start,
+                           0, size)
+    block_ends = np.clip(np.array(block_ends, dtype=np.int64) - start,
+                         0, size)
+
+    diff = (np.bincount(block_starts, minlength=size + 1) -
+            np.bincount(block_ends, minlength=size + 1))
+
+    return np.cumsum(diff[:-1]).astype(np.int32)
@@ -0,0 +1,228 @@
+"""This module provides tracks for plotting precomputed quantitative
+signals (such as ChIP-seq signal, normalized RNA-seq coverage or
+methylation levels) from bigWig or bgzipped/tabix-indexed bedGraph files.
+
+"""
+
+import numpy as np
+import toolz
+
+try:
+    import pyBigWig
+except ImportError:
+    pyBigWig = None
+
+from geneviz.util.tabix import BedGraphIterator, RegionCache
+
+from .base import Track
+
+BIGWIG_EXTENSIONS = ('.bw', '.bigwig', '.bigWig')
+
+
+class SignalTrack(Track):
+    """Track for plotting a precomputed signal along the genome.
+
+    Signals are read from bigWig files (if the file has a bigWig extension)
+    or from bgzipped and tabix-indexed bedGraph files. Only intervals
+    within the drawn region are fetched and are drawn directly as steps,
+    without expanding them into per-base values. For bigWig files, wide
+    regions are summarized using the zoom levels of the file.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the bigWig or bedGraph file.
+    height : float
+        Height of the track.
+    fill : bool
+        Whether to fill the area below the signal.
+    bins : Union[int, str]
+        Maximum number of bins to draw for bigWig files, or 'auto' to use
+        one bin per pixel of the axis. Regions spanning more intervals are
+        summarized using the zoom levels of the bigWig file.
+    agg : str
+        Summary statistic used for summarized bigWig regions ('mean',
+        'max', 'min' or 'coverage').
+    plot_kws : dict[str, Any]
+        Dict of keyword arguments to pass to ax.plot when drawing the
+        signal.
+    fill_kws : dict[str, Any]
+        Dict of keyword arguments to pass to ax.fill_between when filling
+        the area below the signal.
+    region_cache_bytes : int
+        Memory budget of the cache of intervals fetched from bedGraph
+        files, which avoids re-reading intervals when zooming or panning.
+
+    """
+
+    def __init__(self,
+                 file_path,
+                 height=1,
+                 fill=True,
+                 bins='auto',
+                 agg='mean',
+                 plot_kws=None,
+                 fill_kws=None,
+                 region_cache_bytes=64 * 2**20):
+        super().__init__()
+
+        self._file_path = str(file_path)
+        self._is_bigwig = self._file_path.endswith(BIGWIG_EXTENSIONS)
+
+        if self._is_bigwig and pyBigWig is None:
+            raise ImportError('pyBigWig library is required for '
+                              'reading bigWig files')
+
+        self._height = height
+        self._fill = fill
+        self._bins = bins
+        self._agg = agg
+
+        self._plot_kws = plot_kws or {}
+        self._fill_kws = toolz.merge({'linewidth': 0}, fill_kws or {})
+
+        if not self._is_bigwig:
+            self._region_cache = RegionCache(
+                BedGraphIterator(self._file_path),
+                max_bytes=region_cache_bytes)
+
+    def get_height(self, region, ax):
+        """Returns the height of the track.
+
+        Parameters
+        ----------
+        region : Tuple[str, int, int]
+            The genomic region that will be drawn. Specified as a tuple of
+            (chromosome, start, end).
+        ax : matplotlib.Axes
+            Axis that the track will be drawn on.
+
+        Returns
+        -------
+        height : int
+            Height of the track.
+
+        """
+        return self._height
+
+    def _fetch_intervals(self, region, bins=None):
+        """Fetches signal intervals within the region as arrays."""
+
+        if self._is_bigwig:
+            return self._fetch_bigwig(region, bins)
+
+        frame = self._region_cache.fetch(*region)
+
+        return (frame['start'].values, frame['end'].values,
+                frame['value'].values)
+
+    def _fetch_bigwig(self, region, bins=None):
+        chromosome, start, end = region
+
+        file_ = pyBigWig.open(self._file_path)
+
+        try:
+            if chromosome not in file_.chroms():
+                empty = np.array([], dtype=np.int64)
+                return empty, empty, np.array([], dtype=np.float64)
+
+            end = min(end, file_.chroms(chromosome))
+
+            if bins is not None and end - start > bins:
+                # Summarize wide regions using zoom levels.
+                edges = np.floor(np.linspace(start, end, bins + 1))
+                edges = edges.astype(np.int64)
+
+                values = file_.stats(
+                    chromosome, start, end, type=self._agg, nBins=bins)
+                values = np.array(values, dtype=np.float64)
+
+                starts, ends = edges[:-1], edges[1:]
+            else:
+                intervals = file_.intervals(chromosome, start, end) or []
+                intervals = np.array(intervals, dtype=np.float64)
+                intervals = intervals.reshape(-1, 3)
+
+                starts = intervals[:, 0].astype(np.int64)
+                ends = intervals[:, 1].astype(np.int64)
+                values = intervals[:, 2]
+        finally:
+            file_.close()
+
+        # Drop bins without data.
+        mask = ~np.isnan(values)
+
+        return starts[mask], ends[mask], values[mask]
+
+    def draw(self, region, ax):
+        """Draws the track on the given axis.
+
+        Parameters
+        ----------
+        region : Tuple[str, int, int]
+            Genomic region to draw.
+        ax : matplotlib.Axes
+            Axis to draw track on.
+
+        """
+
+        if self._bins == 'auto':
+            bins = int(ax.get_window_extent().width)
+        else:
+            bins = self._bins
+
+        starts, ends, values = self._fetch_intervals(region, bins=bins)
+        x, y = step_coordinates(starts, ends, values)
+
+        lines = ax.plot(x, y, **self._plot_kws)
+
+        if self._fill:
+            fill_kws = toolz.merge({'color': lines[0].get_color()},
+                                   self._fill_kws)
+            ax.fill_between(x, 0, y, **fill_kws)
+
+
+def step_coordinates(starts, ends, values):
+    """Converts signal intervals into coordinates for drawing steps.
+
+    Intervals (which are expected to be sorted) are drawn as steps, which
+    only return to zero at gaps between intervals and at the outer bounds
+    of the intervals. This way, adjacent intervals (such as bigWig bins or
+    bedGraph runs) are drawn as a continuous signal, whereas gaps are drawn
+    as zero signal.
+
+    Parameters
+    ----------
+    starts : np.ndarray
+        Start positions of the intervals.
+    ends : np.ndarray
+        End positions of the intervals.
+    values : np.ndarray
+        Signal values of the intervals.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        X and y coordinates of the steps.
+
+    """
+
+    starts, ends, values = (np.asarray(starts), np.asarray(ends),
+                            np.asarray(values))
+
+    x = np.column_stack([starts, starts, ends, ends]).ravel()
+
+    zeros = np.zeros_like(values)
+    y = np.column_stack([zeros, values, values, zeros]).ravel()
+
+    if len(starts) == 0:
+        return x, y
+
+    # Only keep zero points at gaps between intervals.
+    gaps = starts[1:] != ends[:-1]
+    ones = np.ones(len(starts), dtype=bool)
+
+    mask = np.column_stack(
+        [np.r_[True, gaps], ones, ones, np.r_[gaps, True]]).ravel()
+
+    return x[mask], y[mask]
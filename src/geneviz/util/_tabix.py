@@ -5,15 +5,21 @@ from builtins import (ascii, bytes, chr, dict, filter, hex, input, int, map,
                       next, oct, open, pow, range, round, str, super, zip)
 from future.utils import native_str
 
+from collections import OrderedDict
+from concurrent import futures
 import contextlib
+import heapq
 import itertools
 import os
-import subprocess
+import re
+import tempfile
 
 import pysam
 import numpy as np
 import pandas as pd
 
+from .tabix import GeneIndex
+
 
 class TabixFile(object):
     def __init__(self, filename, parser, **kwargs):
@@ -108,8 +114,14 @@ class TabixFile(object):
             end,
             filters=filters,
             incl_left=incl_left,
-            incl_right=incl_right)
-        return self._frame_constructor().from_records(records)
+            incl_right=incl_right,
+            raw=True)
+        return self._records_to_frame(records)
+
+    @classmethod
+    def _records_to_frame(cls, records):
+        return cls._frame_constructor().from_records(
+            cls._to_series(rec) for rec in records)
 
     @classmethod
     def _to_series(cls, record):
@@ -121,10 +133,58 @@ class TabixFile(object):
 
 
 class TabixFrame(pd.DataFrame):
+    """Base class for in-memory frames of tabix records.
+
+    Region lookups (see **fetch_frame**) use a positional index, which is
+    built lazily on the first lookup. The index is specific to the frame
+    instance: it is not carried over to frames derived from the frame
+    (copies, subsets, etc.) and is dropped when columns are assigned or
+    when the frame is modified by in-place operations (such as sorting
+    or dropping rows with inplace=True). If positions are modified
+    in-place by other means (such as using .loc), the index should be
+    dropped explicitly using **reset_region_index**.
+    """
+
+    # Names of the columns containing positions of records.
+    _ref_col = 'contig'
+    _start_col = 'start'
+    _end_col = 'end'
+
     @property
     def _constructor(self):
         raise NotImplementedError()
 
+    def __setitem__(self, key, value):
+        self.reset_region_index()
+        super().__setitem__(key, value)
+
+    def _update_inplace(self, result, **kwargs):
+        self.reset_region_index()
+        super()._update_inplace(result, **kwargs)
+
+    def reset_region_index(self):
+        """Drops the positional index used for region lookups."""
+        self.__dict__.pop('_region_index', None)
+
+    @property
+    def region_index(self):
+        """Positional index used for region lookups, built lazily."""
+
+        # The index is stored together with the rows it was built for,
+        # so that it is rebuilt if rows were changed in-place.
+        index, rows, n_rows = self.__dict__.get('_region_index',
+                                                (None, None, None))
+
+        if (index is None or not self.index.is_(rows) or
+                n_rows != len(self)):
+            index = _RegionIndex(self[self._ref_col].values,
+                                 self[self._start_col].values,
+                                 self[self._end_col].values)
+            object.__setattr__(self, '_region_index',
+                               (index, self.index, len(self)))
+
+        return index
+
     def fetch(self,
               reference=None,
               start=None,
@@ -152,15 +212,99 @@ class TabixFrame(pd.DataFrame):
                     filters=None,
                     incl_left=True,
                     incl_right=True):
+        """Returns records overlapping the given region.
 
-        return _get_region(
-            self,
-            reference,
-            start,
-            end,
-            filters=filters,
-            incl_left=incl_left,
-            incl_right=incl_right)
+        Candidate records are located using the positional index, after
+        which inclusiveness and other filters are only applied to the
+        candidate rows. Records are returned in their original order.
+        """
+
+        rows = self.region_index.lookup(reference, start, end)
+
+        if not incl_left or not incl_right or filters:
+            mask = np.ones(len(rows), dtype=bool)
+
+            if not incl_left:
+                mask &= self[self._start_col].values[rows] > start
+
+            if not incl_right:
+                mask &= self[self._end_col].values[rows] < end
+
+            # Apply any additional filters.
+            for name, value in (filters or {}).items():
+                mask &= np.asarray(self[name].values[rows] == value)
+
+            rows = rows[mask]
+
+        return self.iloc[rows]
+
+
+class _RegionIndex(object):
+    """Positional index for locating records overlapping regions.
+
+    Records are sorted per contig by their start position, which allows
+    overlapping records to be located using binary search in O(log n + k)
+    time. The maximum span of the records in each contig bounds how far
+    before the query start overlapping records may start.
+    """
+
+    def __init__(self, references, starts, ends):
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+
+        codes, contigs = pd.factorize(references, sort=False)
+        order = np.lexsort((starts, codes))
+
+        bounds = np.searchsorted(codes[order], np.arange(len(contigs) + 1))
+
+        self._contigs = {}
+
+        for i, contig in enumerate(contigs):
+            rows = order[bounds[i]:bounds[i + 1]]
+            spans = ends[rows] - starts[rows]
+
+            self._contigs[contig] = (rows, starts[rows], ends[rows],
+                                     int(spans.max()) if len(spans) else 0)
+
+    def lookup(self, reference=None, start=None, end=None):
+        """Returns (sorted) row positions of records overlapping a region.
+
+        Records overlap if they start at or before the end of the region
+        and end at or after its start. If reference is None, records from
+        all contigs are considered.
+        """
+
+        if reference is None:
+            contigs = list(self._contigs)
+        elif reference in self._contigs:
+            contigs = [reference]
+        else:
+            contigs = []
+
+        positions = []
+
+        for contig in contigs:
+            rows, starts, ends, max_span = self._contigs[contig]
+
+            lower, upper = 0, len(rows)
+
+            if start is not None:
+                lower = np.searchsorted(starts, start - max_span, side='left')
+
+            if end is not None:
+                upper = np.searchsorted(starts, end, side='right')
+
+            candidates = rows[lower:upper]
+
+            if start is not None:
+                candidates = candidates[ends[lower:upper] >= start]
+
+            positions.append(candidates)
+
+        if not positions:
+            return np.array([], dtype=np.int64)
+
+        return np.sort(np.concatenate(positions))
 
 
 def _parse_float(value):
@@ -185,7 +329,8 @@ class GtfFile(TabixFile):
             else:
                 file_path = self.compress(file_path, create_index=True)
 
-        super().__init__(filename, parser=pysam.asGTF(), **kwargs)
+        super().__init__(file_path, parser=pysam.asGTF(), **kwargs)
+        self._gene_index = None
 
     @classmethod
     def _to_series(cls, record):
@@ -195,10 +340,45 @@ class GtfFile(TabixFile):
         return pd.Series(
             rec_values[:-1] + attr_values, index=cls.FIELDS[:-1] + attr_keys)
 
+    @classmethod
+    def _records_to_frame(cls, records):
+        """Builds a frame from records by accumulating columns.
+
+        Avoids building an intermediate Series per record, which is
+        considerably slower than constructing the frame once.
+        """
+
+        n_fields = len(cls.FIELDS) - 1
+        columns = [[] for _ in range(n_fields)]
+        attributes = []
+
+        for record in records:
+            for column, value in zip(columns, record):
+                column.append(value)
+            attributes.append(dict(record))
+
+        if len(attributes) == 0:
+            return GtfFrame.from_records([])
+
+        data = _typed_columns(cls.FIELDS[:n_fields], columns, cls.TYPE_MAP)
+
+        frame = pd.concat(
+            [pd.DataFrame(data), pd.DataFrame.from_records(attributes)],
+            axis=1)
+
+        return GtfFrame._format_frame(GtfFrame(frame))
+
     @classmethod
     def _frame_constructor(cls):
         return GtfFrame
 
+    @property
+    def gene_index(self):
+        """Index for locating genes, loaded (or built) on first access."""
+        if self._gene_index is None:
+            self._gene_index = GeneIndex.from_gtf(self._filename)
+        return self._gene_index
+
     def get_gene(self,
                  gene_id,
                  feature_type='gene',
@@ -208,6 +388,18 @@ class GtfFile(TabixFile):
         filters = kwargs.pop('filter', {})
         filters['feature'] = feature_type
 
+        # Restrict search to the gene location if it can be looked up
+        # in the gene index, avoiding a scan over the entire file.
+        if (feature_type == 'gene' and field_name in GeneIndex.COLUMNS[:2]
+                and 'reference' not in kwargs):
+            location, = self.gene_index.locate([gene_id], field=field_name)
+
+            if location is None:
+                raise ValueError('Gene {} does not exist'.format(gene_id))
+
+            kwargs.update(dict(zip(('reference', 'start', 'end'),
+                                   location[:3])))
+
         # Search for gene record.
         records = self.fetch(filters=filters, raw=True, **kwargs)
         for record in records:
@@ -217,35 +409,43 @@ class GtfFile(TabixFile):
         raise ValueError('Gene {} does not exist'.format(gene_id))
 
     @classmethod
-    def compress(cls, filename, out_path=None, sort=True, create_index=True):
-        """Compresses and indexes a gtf file using bgzip and tabix."""
+    def compress(cls,
+                 filename,
+                 out_path=None,
+                 sort=True,
+                 create_index=True,
+                 max_lines=1000000):
+        """Compresses and indexes a gtf file using bgzip and tabix.
+
+        Records are sorted (if needed) using an external merge sort, which
+        sorts chunks of at most max_lines records in memory. Compression and
+        indexing are performed in-process using pysam.
+        """
 
         # Base output path on original file name.
         out_path = out_path or filename + '.gz'
 
-        if sort:
-            # Sort file before compressing and indexing.
-            filename = cls.sort(filename, out_path=out_path + '.tmp')
-
-        # Gzip and index file.
-        gzipped_path = bgzip(filename, out_path=out_path)
+        compress_sorted(
+            filename,
+            out_path,
+            key=_gtf_sort_key,
+            sort=sort,
+            max_lines=max_lines)
 
         if create_index:
-            tabix(gzipped_path, preset='gff')
-
-        # Clean up temp file.
-        if filename.endswith('.tmp'):
-            os.unlink(filename)
+            tabix(out_path, preset='gff')
 
-        return gzipped_path
+        return out_path
 
     @classmethod
-    def sort(cls, filename, out_path):
+    def sort(cls, filename, out_path, max_lines=1000000):
         """Sorts a gtf file by position, as required for tabix."""
-        with open(out_path, 'w') as out_file:
-            cmd = '(grep ^"#" {0}; grep -v ^"#" {0} ' '| sort -k1,1 -k4,4n)'
-            subprocess.check_call(
-                cmd.format(filename), stdout=out_file, shell=True)
+
+        with open(filename, 'r') as in_file, \
+                open(out_path, 'w') as out_file:
+            out_file.writelines(
+                external_sort(in_file, key=_gtf_sort_key, max_lines=max_lines))
+
         return out_path
 
     def __repr__(self):
@@ -258,9 +458,78 @@ class GtfFrame(TabixFrame):
         return GtfFrame
 
     @classmethod
-    def read_csv(cls, path, *args, **kwargs):
-        frame = pd.read_csv(path, *args, sep='\t', comment='#', **kwargs)
-        return cls._format_frame(frame)
+    def read_csv(cls,
+                 path,
+                 attributes=None,
+                 chunksize=500000,
+                 n_jobs=1,
+                 **kwargs):
+        """Reads a (gzipped) GTF file into a GtfFrame.
+
+        The file is read and parsed chunk by chunk to bound memory usage.
+        Attributes are extracted using vectorized string operations and
+        stored as categorical columns.
+
+        Positions are kept as they are in the GTF file, meaning that start
+        positions are 1-based. Note that this differs from the records
+        returned by GtfFile.fetch_frame, which have 0-based start positions
+        (similar to pysam).
+
+        Parameters
+        ----------
+        path : str
+            Path to the GTF file.
+        attributes : List[str]
+            Attribute keys to extract. If None, all attributes present
+            in the file are extracted.
+        chunksize : int
+            Number of records to parse per chunk.
+        n_jobs : int
+            Number of processes to use for parsing chunks in parallel.
+        **kwargs
+            Any other keyword arguments are passed to pandas.read_csv,
+            overriding
+            the defaults used for reading GTF files (e.g. nrows or
+            compression).
+
+        Returns
+        -------
+        GtfFrame
+            Frame containing the GTF records.
+
+        """
+
+        read_kws = {
+            'sep': '\t',
+            'comment': '#',
+            'header': None,
+            'names': GtfFile.FIELDS,
+            'na_values': {'score': ['.']},
+            'keep_default_na': False,
+            'dtype': {'contig': str,
+                      'frame': str}
+        }
+        read_kws.update(kwargs)
+
+        chunks = pd.read_csv(str(path), chunksize=chunksize, **read_kws)
+
+        if attributes is not None:
+            attributes = list(attributes)
+
+        if n_jobs == 1:
+            parsed = [_parse_gtf_chunk(chunk, attributes) for chunk in chunks]
+        else:
+            with futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                parsed = _bounded_map(
+                    executor, _parse_gtf_chunk, chunks,
+                    attributes=attributes, max_pending=2 * n_jobs)
+
+        if len(parsed) == 0:
+            frame = pd.DataFrame([], columns=GtfFile.FIELDS[:-1])
+        else:
+            frame = _concat_categorical(parsed)
+
+        return cls._format_frame(cls(frame))
 
     @classmethod
     def from_records(cls, data, *args, **kwargs):
@@ -287,8 +556,8 @@ class GtfFrame(TabixFrame):
         return frame
 
     def get_gene(self, gene_id):
-        result = self.ix[((self['feature'] == 'gene') &
-                          (self['gene_id'] == gene_id))]
+        result = self.loc[((self['feature'] == 'gene') &
+                           (self['gene_id'] == gene_id))]
 
         if len(result) == 0:
             raise ValueError('Gene {} does not exist'.format(gene_id))
@@ -319,49 +588,79 @@ class BedFile(TabixFile):
                         for i, val in enumerate(record)))
         return pd.Series(values, index=cls.FIELDS[:len(values)])
 
+    @classmethod
+    def _records_to_frame(cls, records):
+        """Builds a frame from records by accumulating columns.
+
+        See GtfFile._records_to_frame for details.
+        """
+
+        rows = [tuple(record) for record in records]
+
+        if len(rows) == 0:
+            return BedFrame.from_records([])
+
+        # Pad records with fewer fields.
+        columns = list(itertools.zip_longest(*rows, fillvalue=np.nan))
+        columns = columns[:len(cls.FIELDS)]
+
+        data = _typed_columns(cls.FIELDS[:len(columns)], columns,
+                              cls.TYPE_MAP)
+
+        return BedFrame._format_frame(BedFrame(data))
+
     @classmethod
     def _frame_constructor(cls):
         return BedFrame
 
     @classmethod
-    def compress(cls, filename, out_path=None, sort=True, create_index=True):
-        """Compresses and indexes a bed file using bgzip and tabix."""
+    def compress(cls,
+                 filename,
+                 out_path=None,
+                 sort=True,
+                 create_index=True,
+                 max_lines=1000000):
+        """Compresses and indexes a bed file using bgzip and tabix.
+
+        See GtfFile.compress for details.
+        """
 
         # Base output path on original file name.
         out_path = out_path or filename + '.gz'
 
-        if sort:
-            # Read and sort bed file.
-            frame = BedFrame.read(filename)
-            frame.sort_values(inplace=True)
-
-            filename = out_path + '.tmp'
-            frame.write(filename)
-
-        # Gzip and index file.
-        gzipped_path = bgzip(filename, out_path=out_path)
+        compress_sorted(
+            filename,
+            out_path,
+            key=_bed_sort_key,
+            sort=sort,
+            max_lines=max_lines)
 
         if create_index:
-            tabix(gzipped_path, preset='bed')
-
-        # Clean up temp file.
-        if filename.endswith('.tmp'):
-            os.unlink(filename)
+            tabix(
+                out_path,
+                preset='bed',
+                line_skip=_count_skipped(filename))
 
-        return gzipped_path
+        return out_path
 
     @classmethod
-    def sort(cls, filename, out_path):
-        """Sorts a gtf file by position, as required for tabix."""
-        with open(out_path, 'w') as out_file:
-            cmd = '(grep ^"#" {0}; grep -v ^"#" {0} ' '| sort -k1,1 -k4,4n)'
-            subprocess.check_call(
-                cmd.format(filename), stdout=out_file, shell=True)
+    def sort(cls, filename, out_path, max_lines=1000000):
+        """Sorts a bed file by position, as required for tabix."""
+
+        with open(filename, 'r') as in_file, \
+                open(out_path, 'w') as out_file:
+            out_file.writelines(
+                external_sort(in_file, key=_bed_sort_key, max_lines=max_lines))
+
         return out_path
 
 
 class BedFrame(TabixFrame):
 
+    _ref_col = 'chrom'
+    _start_col = 'chromStart'
+    _end_col = 'chromEnd'
+
     COL_NAMES = ('chrom', 'chromStart', 'chromEnd', 'name', 'score', 'strand',
                  'thickStart', 'thickEnd', 'itemRgb', 'blockCount',
                  'blockSizes', 'blockStarts')
@@ -375,13 +674,14 @@ class BedFrame(TabixFrame):
         with open(str(file_path), 'r') as file_:
             skip = 1 if next(iter(file_)).startswith('track') else 0
 
-        return cls(
-            pd.read_csv(
-                str(file_path),
-                sep='\t',
-                skiprows=skip,
-                names=cls.COL_NAMES,
-                dtype={'chrom': str}))
+        frame = pd.read_csv(
+            str(file_path),
+            sep='\t',
+            skiprows=skip,
+            names=cls.COL_NAMES,
+            dtype={'chrom': str})
+
+        return cls._format_frame(cls(frame))
 
     def write(self, file_path):
         return self.to_csv(
@@ -404,61 +704,343 @@ class BedFrame(TabixFrame):
         if len(frame) == 0:
             frame = pd.DataFrame([], columns=BedFile.FIELDS)
 
+        return cls._format_frame(frame)
+
+    @classmethod
+    def _format_frame(cls, frame):
+        # Convert chromosomes to categorical, similar to GtfFrame.
+        frame['chrom'] = frame['chrom'].astype('category')
+
         # Order columns.
         frame = _reorder_columns(frame, BedFile.FIELDS[:frame.shape[1]])
 
         return frame
 
 
-def _reorder_columns(frame, order):
-    columns = list(order)
-    extra_columns = sorted([c for c in frame.columns if c not in set(columns)])
-    return frame[columns + extra_columns]
+def _parse_gtf_chunk(chunk, attributes=None):
+    """Parses the attribute column of a chunk of GTF records."""
+
+    attr_values = chunk.pop('attribute').astype(str)
+
+    if attributes is None:
+        attributes = _attribute_keys(attr_values)
+
+    for key in attributes:
+        # Patterns start with the key (rather than a separator), as this
+        # allows the regex engine to quickly scan for the key. The
+        # lookbehind ensures that the key is not part of a longer key.
+        pattern = r'{0}(?<![^\s;]{0}) "?([^";]*)"?'.format(re.escape(key))
+        values = attr_values.str.extract(pattern, expand=False)
+        chunk[key] = values.astype('category')
+
+    return chunk
+
+
+def _attribute_keys(attr_values):
+    """Returns the (sorted) attribute keys present in the given values.
+
+    Keys are determined from the distinct layouts of the attributes, which
+    are obtained by removing quoted values. As records typically share only
+    a limited number of layouts, only few strings need to be split into keys.
+    """
+
+    layouts = attr_values.str.replace(r'"[^"]*"', '', regex=True).unique()
+
+    keys = set()
+    for layout in layouts:
+        keys.update(re.findall(r'(?:^|;)\s*(\S+) ', layout))
+
+    return sorted(keys)
+
+
+def _bounded_map(executor, func, iterable, max_pending, **kwargs):
+    """Maps func over iterable using executor, in order.
+
+    Limits the number of pending tasks to max_pending, which avoids
+    reading the entire iterable into memory.
+    """
 
+    results, pending = [], []
 
-def _get_region(frame,
-                reference,
-                start=None,
-                end=None,
-                filters=None,
-                incl_left=True,
-                incl_right=True,
-                ref_col='contig',
-                start_col='start',
-                end_col='end'):
-    # Filter on passed range.
-    mask = frame[ref_col] == reference
+    for item in iterable:
+        pending.append(executor.submit(func, item, **kwargs))
 
-    if start is not None:
-        mask &= frame[start_col] <= end
+        if len(pending) >= max_pending:
+            results.append(pending.pop(0).result())
 
-    if end is not None:
-        mask &= frame[end_col] >= start
+    results += [future.result() for future in pending]
 
-    # Filter for inclusiveness.
-    if not incl_left:
-        mask &= frame['start'] > start
+    return results
 
-    if not incl_right:
-        mask &= frame['end'] < end
 
-    # Apply any additional filters.
-    if filters is not None:
-        for name, value in filters.items():
-            mask &= frame[name] == value
+def _concat_categorical(frames):
+    """Concatenates frames, retaining categorical columns."""
 
-    return frame.ix[mask]
+    columns = []
+    for frame in frames:
+        columns += [col for col in frame.columns if col not in columns]
+
+    merged = {}
+    for col in columns:
+        values = [
+            frame[col] if col in frame.columns else pd.Series(
+                pd.Categorical(
+                    [None] * len(frame), categories=pd.Index(
+                        [], dtype=object))) for frame in frames
+        ]
+
+        if all(val.dtype.name == 'category' for val in values):
+            merged[col] = pd.api.types.union_categoricals(
+                values, ignore_order=True)
+        else:
+            merged[col] = pd.concat(values, ignore_index=True)
+
+    return pd.DataFrame(merged, columns=columns)
+
+
+def _typed_columns(names, columns, type_map):
+    """Converts columns of raw values using a (column index) type map.
+
+    Integer columns are converted using pandas, which yields integers
+    (or floats, if values are missing). Float columns are parsed leniently,
+    similar to _parse_float.
+    """
+
+    data = OrderedDict()
+
+    for i, (name, values) in enumerate(zip(names, columns)):
+        type_ = type_map.get(i)
+
+        if type_ is int:
+            data[name] = pd.to_numeric(pd.Series(values, dtype=object))
+        elif type_ is _parse_float:
+            data[name] = pd.to_numeric(
+                pd.Series(values, dtype=object), errors='coerce').astype(float)
+        else:
+            data[name] = pd.Series(values, dtype=object)
+
+    return data
+
+
+def _reorder_columns(frame, order):
+    columns = list(order)
+    extra_columns = sorted([c for c in frame.columns if c not in set(columns)])
+    return frame[columns + extra_columns]
+
+
+# Column definitions of tabix presets (0-based columns).
+TABIX_PRESETS = {
+    'gff': dict(seq_col=0, start_col=3, end_col=4, meta_char='#'),
+    'bed': dict(seq_col=0, start_col=1, end_col=2, meta_char='#',
+                zerobased=True)
+}
 
 
 def bgzip(file_path, out_path=None):
     if out_path is None:
         out_path = file_path + '.gz'
 
-    with open(out_path, 'w') as out_file:
-        subprocess.check_call(['bgzip', '-c', str(file_path)], stdout=out_file)
+    pysam.tabix_compress(str(file_path), str(out_path), force=True)
 
     return out_path
 
 
-def tabix(file_path, preset):
-    subprocess.check_call(['tabix', '-p', preset, file_path])
+def tabix(file_path, preset, line_skip=0):
+    if line_skip > 0:
+        # Presets don't support skipping lines, so we pass
+        # the corresponding columns explicitly instead.
+        columns = TABIX_PRESETS[preset]
+        pysam.tabix_index(
+            str(file_path), force=True, line_skip=line_skip, **columns)
+    else:
+        pysam.tabix_index(str(file_path), preset=preset, force=True)
+
+
+def _count_skipped(file_path):
+    """Counts the header lines to skip when indexing the (sorted) file.
+
+    All header lines of the file are counted (not only the leading ones),
+    as external_sort moves all header lines to the top of the file. No
+    lines need to be skipped if all headers start with a meta character.
+    """
+
+    n_headers, n_meta = 0, 0
+
+    with open(str(file_path), 'r') as file_:
+        for line in file_:
+            if _is_header(line):
+                n_headers += 1
+                n_meta += line.startswith('#')
+
+    return n_headers if n_headers > n_meta else 0
+
+
+def _is_header(line):
+    return line.startswith(('#', 'track', 'browser'))
+
+
+def _is_blank(line):
+    return not line.strip()
+
+
+def _gtf_sort_key(line):
+    fields = line.split('\t', 4)
+    return fields[0], int(fields[3])
+
+
+def _bed_sort_key(line):
+    fields = line.split('\t', 3)
+    return fields[0], int(fields[1]), int(fields[2])
+
+
+def is_sorted(lines, key):
+    """Checks if the (non-header) lines are sorted, stopping early if not.
+
+    Lines are considered to be sorted if the records of each contig are
+    contiguous and sorted by position, as required by tabix. Contigs
+    themselves may be in any order (e.g. karyotype order), meaning that
+    only the remainder of the key (after the contig) needs to increase.
+    Lines are also only considered to be sorted if all header lines precede
+    the records and there are no blank lines, matching the output of
+    external_sort.
+    """
+
+    prev_key = None
+    seen_contigs = set()
+
+    for line in lines:
+        if _is_blank(line):
+            return False
+
+        if _is_header(line):
+            if prev_key is not None:
+                return False
+            continue
+
+        line_key = key(line)
+        contig, position = line_key[0], line_key[1:]
+
+        if prev_key is not None and contig == prev_key[0]:
+            if position < prev_key[1]:
+                return False
+        elif contig in seen_contigs:
+            return False
+        else:
+            seen_contigs.add(contig)
+
+        prev_key = contig, position
+
+    return True
+
+
+def external_sort(lines, key, max_lines=1000000, tmp_dir=None):
+    """Sorts lines using an external merge sort with bounded memory.
+
+    Lines are sorted in chunks of at most max_lines lines, which are written
+    to temporary files and merged afterwards. Header lines are yielded
+    first, in their original order, and blank lines are dropped. Sorting
+    is stable, meaning that lines with equal keys keep their original order.
+
+    Parameters
+    ----------
+    lines : Iterable[str]
+        Lines to sort (including line endings).
+    key : Callable[[str], Any]
+        Function returning the sort key of a line.
+    max_lines : int
+        Maximum number of lines to sort in memory.
+    tmp_dir : str
+        Directory for temporary files.
+
+    Returns
+    -------
+    Iterable[str]
+        The sorted lines.
+
+    """
+
+    headers = []
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp_path:
+        chunk_paths = []
+        chunk = []
+
+        def _write_chunk():
+            chunk.sort(key=key)
+            chunk_path = os.path.join(tmp_path, '{}.txt'.format(
+                len(chunk_paths)))
+            with open(chunk_path, 'w') as chunk_file:
+                chunk_file.writelines(chunk)
+            chunk_paths.append(chunk_path)
+            del chunk[:]
+
+        for line in lines:
+            if _is_blank(line):
+                continue
+
+            if not line.endswith('\n'):
+                line += '\n'
+
+            if _is_header(line):
+                headers.append(line)
+            else:
+                chunk.append(line)
+                if len(chunk) >= max_lines:
+                    _write_chunk()
+
+        yield from headers
+
+        if not chunk_paths:
+            # Everything fits in memory, no need to merge.
+            yield from sorted(chunk, key=key)
+        else:
+            if chunk:
+                _write_chunk()
+
+            with contextlib.ExitStack() as stack:
+                chunk_files = [
+                    stack.enter_context(open(chunk_path, 'r'))
+                    for chunk_path in chunk_paths
+                ]
+                yield from heapq.merge(*chunk_files, key=key)
+
+
+def compress_sorted(file_path,
+                    out_path,
+                    key,
+                    sort=True,
+                    max_lines=1000000,
+                    tmp_dir=None,
+                    buffer_size=2**20):
+    """Sorts (if needed) and bgzips a file in a streaming fashion.
+
+    Sorting is skipped if the file is already sorted, which is determined
+    using a streaming pass over the file that stops at the first unsorted
+    line. Sorted lines are written to a BGZF file using pysam in chunks
+    of (roughly) buffer_size bytes.
+    """
+
+    with open(str(file_path), 'r') as file_:
+        needs_sort = sort and not is_sorted(file_, key=key)
+
+    with open(str(file_path), 'r') as file_, \
+            pysam.BGZFile(str(out_path), 'wb') as out_file:
+        if needs_sort:
+            lines = external_sort(
+                file_, key=key, max_lines=max_lines, tmp_dir=tmp_dir)
+        else:
+            lines = file_
+
+        buffer, buffered = [], 0
+        for line in lines:
+            buffer.append(line)
+            buffered += len(line)
+
+            if buffered >= buffer_size:
+                out_file.write(''.join(buffer).encode())
+                buffer, buffered = [], 0
+
+        if buffer:
+            out_file.write(''.join(buffer).encode())
+
+    return out_path
@@ -0,0 +1,319 @@
+"""Compiled, memory-mapped gene annotation database.
+
+Provides the AnnotationDatabase class, which stores exon annotations from a
+GTF file as compact per-chromosome NumPy arrays on disk. Databases are
+memory-mapped when opened, which makes opening a database near-instant and
+allows multiple worker processes to share the annotation through the page
+cache. Regions are queried using binary search over a transcript-span index.
+
+"""
+
+import gzip
+import json
+from pathlib import Path
+import re
+
+import numpy as np
+import pandas as pd
+
+ATTRIBUTE_REGEX = re.compile(r'(\S+) "([^"]*)"')
+
+STRAND_MAP = {'+': 1, '-': -1}
+
+EXON_FIELDS = ('exon_start', 'exon_end', 'exon_strand', 'exon_gene',
+               'exon_transcript')
+
+TRANSCRIPT_FIELDS = ('tx_start', 'tx_end', 'tx_offset')
+
+
+class AnnotationDatabase(object):
+    """Compiled annotation database containing exon features.
+
+    Databases are built from a GTF file using **build** and opened using the
+    main constructor. Array files are only memory-mapped when a chromosome
+    is first queried, which means that instances can also be pickled
+    cheaply for use in process pools.
+
+    Parameters
+    ----------
+    db_path : Path
+        Path to the (directory containing the) compiled database.
+
+    """
+
+    def __init__(self, db_path):
+        self._db_path = Path(db_path)
+
+        with (self._db_path / 'index.json').open() as file_:
+            index = json.load(file_)
+
+        self._contigs = index['contigs']
+        self._max_spans = index['max_spans']
+        self._gene_id = index['gene_id']
+        self._transcript_id = index['transcript_id']
+        self._gene_name = index['gene_name']
+
+        self._tables = None
+        self._arrays = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tables'] = None
+        state['_arrays'] = {}
+        return state
+
+    @property
+    def contigs(self):
+        """Contigs present in the database."""
+        return list(self._contigs)
+
+    @classmethod
+    def build(cls,
+              gtf_path,
+              db_path,
+              gene_id='gene_id',
+              transcript_id='transcript_id',
+              gene_name='gene_name'):
+        """Builds a database from the exon records in a GTF file.
+
+        Parameters
+        ----------
+        gtf_path : Path
+            Path to the GTF file (optionally gzipped).
+        db_path : Path
+            Output directory for the database.
+        gene_id : str
+            GTF attribute containing the gene identifier.
+        transcript_id : str
+            GTF attribute containing the transcript identifier.
+        gene_name : str
+            GTF attribute containing the gene name. Genes without this
+            attribute are named using their identifier.
+
+        Returns
+        -------
+        AnnotationDatabase
+            The opened database.
+
+        """
+
+        db_path = Path(db_path)
+        db_path.mkdir(parents=True, exist_ok=True)
+
+        exons, gene_names = _read_gtf_exons(gtf_path, gene_id, transcript_id,
+                                            gene_name)
+
+        # Build string tables and encode identifiers as codes.
+        gene_cat = pd.Categorical(exons['gene'])
+        tx_cat = pd.Categorical(exons['transcript'])
+
+        genes = np.asarray(gene_cat.categories, dtype=str)
+        names = np.array(
+            [gene_names.get(gene, gene) for gene in genes], dtype=str)
+
+        np.save(str(db_path / 'genes.npy'), genes)
+        np.save(str(db_path / 'gene_names.npy'), names)
+        np.save(str(db_path / 'transcripts.npy'),
+                np.asarray(tx_cat.categories, dtype=str))
+
+        frame = pd.DataFrame({
+            'contig': exons['contig'],
+            'start': np.asarray(exons['start'], dtype=np.int32),
+            'end': np.asarray(exons['end'], dtype=np.int32),
+            'strand': np.asarray(exons['strand'], dtype=np.int8),
+            'gene': gene_cat.codes.astype(np.int32),
+            'transcript': tx_cat.codes.astype(np.int32)
+        })
+
+        # Write per-contig arrays.
+        contigs = sorted(frame['contig'].unique())
+        max_spans = {}
+
+        for i, (contig, grp) in enumerate(frame.groupby('contig', sort=True)):
+            arrays, max_span = _build_contig_arrays(grp)
+            max_spans[contig] = max_span
+
+            for name, values in arrays.items():
+                np.save(str(db_path / '{}.{}.npy'.format(i, name)), values)
+
+        index = {
+            'contigs': contigs,
+            'max_spans': max_spans,
+            'gene_id': gene_id,
+            'transcript_id': transcript_id,
+            'gene_name': gene_name
+        }
+
+        with (db_path / 'index.json').open('w') as file_:
+            json.dump(index, file_)
+
+        return cls(db_path)
+
+    def _get_tables(self):
+        if self._tables is None:
+            self._tables = {
+                name: np.load(
+                    str(self._db_path / '{}.npy'.format(name)), mmap_mode='r')
+                for name in ('genes', 'gene_names', 'transcripts')
+            }
+        return self._tables
+
+    def _get_arrays(self, contig):
+        try:
+            return self._arrays[contig]
+        except KeyError:
+            i = self._contigs.index(contig)
+            arrays = {
+                name: np.load(
+                    str(self._db_path / '{}.{}.npy'.format(i, name)),
+                    mmap_mode='r')
+                for name in EXON_FIELDS + TRANSCRIPT_FIELDS
+            }
+            self._arrays[contig] = arrays
+            return arrays
+
+    def fetch_transcripts(self, chromosome, start, end):
+        """Returns indices of transcripts overlapping the given region.
+
+        Indices refer to the position of the transcripts in the
+        transcript-span index of the given chromosome.
+        """
+
+        if chromosome not in self._max_spans:
+            return np.array([], dtype=np.int64)
+
+        arrays = self._get_arrays(chromosome)
+        tx_start, tx_end = arrays['tx_start'], arrays['tx_end']
+
+        # Transcripts are sorted by start, so candidates must start within
+        # [start - max_span, end]. These are filtered further on their end.
+        lower = np.searchsorted(
+            tx_start, start - self._max_spans[chromosome], side='left')
+        upper = np.searchsorted(tx_start, end, side='right')
+
+        candidates = np.arange(lower, upper)
+        return candidates[np.asarray(tx_end[lower:upper]) >= start]
+
+    def fetch_frame(self, chromosome, start, end):
+        """Returns exons of all transcripts overlapping the given region.
+
+        Transcripts are returned in full, also if some of their exons
+        fall outside of the requested region.
+
+        Returns
+        -------
+        pandas.DataFrame
+            DataFrame containing the columns chromosome, start, end and
+            strand, together with the gene id, transcript id and gene name
+            of each exon.
+
+        """
+
+        columns = ['chromosome', 'start', 'end', 'strand', self._gene_id,
+                   self._transcript_id, self._gene_name]
+
+        transcripts = self.fetch_transcripts(chromosome, start, end)
+
+        if len(transcripts) == 0:
+            return pd.DataFrame([], columns=columns)
+
+        # Gather exon ranges of the selected transcripts.
+        arrays = self._get_arrays(chromosome)
+        offsets = arrays['tx_offset']
+
+        exon_idx = np.concatenate([
+            np.arange(offsets[i], offsets[i + 1]) for i in transcripts
+        ])
+
+        tables = self._get_tables()
+        gene_codes = np.asarray(arrays['exon_gene'][exon_idx])
+        tx_codes = np.asarray(arrays['exon_transcript'][exon_idx])
+
+        return pd.DataFrame(
+            {
+                'chromosome': chromosome,
+                'start': np.asarray(arrays['exon_start'][exon_idx]),
+                'end': np.asarray(arrays['exon_end'][exon_idx]),
+                'strand': np.asarray(arrays['exon_strand'][exon_idx]),
+                self._gene_id: tables['genes'][gene_codes],
+                self._transcript_id: tables['transcripts'][tx_codes],
+                self._gene_name: tables['gene_names'][gene_codes]
+            },
+            columns=columns)
+
+    def __repr__(self):
+        return '<AnnotationDatabase db_path={!r}>'.format(str(self._db_path))
+
+
+def _read_gtf_exons(gtf_path, gene_id, transcript_id, gene_name):
+    """Reads exon records from a (gzipped) GTF file into column lists."""
+
+    gtf_path = str(gtf_path)
+    open_func = gzip.open if gtf_path.endswith('.gz') else open
+
+    exons = {
+        'contig': [],
+        'start': [],
+        'end': [],
+        'strand': [],
+        'gene': [],
+        'transcript': []
+    }
+    gene_names = {}
+
+    with open_func(gtf_path, 'rt') as file_:
+        for line in file_:
+            if line.startswith('#'):
+                continue
+
+            fields = line.rstrip('\n').split('\t')
+            if fields[2] != 'exon':
+                continue
+
+            attrs = dict(ATTRIBUTE_REGEX.findall(fields[8]))
+
+            # Convert to 0-based start positions, as used by pysam.
+            exons['contig'].append(fields[0])
+            exons['start'].append(int(fields[3]) - 1)
+            exons['end'].append(int(fields[4]))
+            exons['strand'].append(STRAND_MAP.get(fields[6], 0))
+            exons['gene'].append(attrs[gene_id])
+            exons['transcript'].append(attrs[transcript_id])
+
+            if gene_name in attrs:
+                gene_names[attrs[gene_id]] = attrs[gene_name]
+
+    return exons, gene_names
+
+
+def _build_contig_arrays(exons):
+    """Builds exon and transcript-span arrays for the exons of one contig."""
+
+    tx_codes = exons['transcript'].values
+
+    # Determine transcript spans.
+    spans = exons.groupby('transcript').agg({'start': 'min', 'end': 'max'})
+    spans = spans.sort_values(['start', 'end'])
+
+    # Sort exons by transcript (in span order), then by start position.
+    tx_rank = pd.Series(np.arange(len(spans)), index=spans.index)
+    exon_rank = tx_rank.loc[tx_codes].values
+    order = np.lexsort((exons['start'].values, exon_rank))
+
+    offsets = np.searchsorted(
+        exon_rank[order], np.arange(len(spans) + 1), side='left')
+
+    arrays = {
+        'exon_start': exons['start'].values[order],
+        'exon_end': exons['end'].values[order],
+        'exon_strand': exons['strand'].values[order],
+        'exon_gene': exons['gene'].values[order],
+        'exon_transcript': tx_codes[order],
+        'tx_start': spans['start'].values.astype(np.int32),
+        'tx_end': spans['end'].values.astype(np.int32),
+        'tx_offset': offsets.astype(np.int64)
+    }
+
+    max_span = int((spans['end'] - spans['start']).max())
+
+    return arrays, max_span
@@ -0,0 +1,427 @@
+"""Parallel reader for BGZF-compressed, tabix-indexed files.
+
+Provides the BgzfTabixReader class, which reads the lines of a tabix file
+without going through htslib. The compressed file is memory-mapped and the
+tabix index is used to select the BGZF blocks covering a query. Selected
+blocks are decompressed in parallel on a thread pool (zlib releases the GIL
+while decompressing), after which the decompressed lines are yielded in
+file order. Positions of records are only parsed for blocks that may
+contain records outside of the queried region, which keeps the (serial)
+work per line to a minimum. Note that this serial work, rather than the
+decompression, typically bounds the speed of a scan, meaning that using
+more threads gives diminishing returns.
+
+"""
+
+from collections import deque
+from concurrent import futures
+import gzip
+import mmap
+import os
+from pathlib import Path
+import struct
+import zlib
+
+import numpy as np
+
+# Bins (and their offsets) of the binning scheme used by .tbi indices,
+# from the largest to the smallest bins (of 16 kb).
+TBI_LEVELS = ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681))
+
+# Pseudo-bin containing index metadata instead of chunks.
+TBI_META_BIN = 37450
+
+TBI_MIN_SHIFT = 14
+
+TBI_MAX_POSITION = 1 << 29
+
+# Tabix file formats (lowest 16 bits) and the flag for 0-based positions.
+TBI_FORMAT_GENERIC = 0
+TBI_FLAG_ZERO_BASED = 0x10000
+
+BGZF_HEADER_SIZE = 12
+BGZF_FOOTER_SIZE = 8
+
+
+class TabixIndex(object):
+    """Tabix (.tbi) index of a BGZF-compressed file.
+
+    Parameters
+    ----------
+    index_path : Path
+        Path to the tabix index.
+
+    """
+
+    def __init__(self, index_path):
+        with gzip.open(str(index_path), 'rb') as file_:
+            data = file_.read()
+
+        magic, n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm = \
+            struct.unpack_from('<4s8i', data, 0)
+
+        if magic != b'TBI\x01':
+            raise ValueError('Invalid tabix index {!r}'.format(
+                str(index_path)))
+
+        self.format = fmt & 0xFFFF
+        self.zero_based = bool(fmt & TBI_FLAG_ZERO_BASED)
+        self.col_seq = col_seq
+        self.col_beg = col_beg
+        self.col_end = col_end
+        self.meta = chr(meta)
+        self.skip = skip
+
+        offset = 36
+        names = data[offset:offset + l_nm].split(b'\x00')
+        self.contigs = [name.decode() for name in names[:n_ref]]
+        offset += l_nm
+
+        self._bins = []
+        self._linear = []
+
+        for _ in range(n_ref):
+            bins = {}
+
+            n_bin, = struct.unpack_from('<i', data, offset)
+            offset += 4
+
+            for _ in range(n_bin):
+                bin_, n_chunk = struct.unpack_from('<Ii', data, offset)
+                offset += 8
+
+                chunks = np.frombuffer(
+                    data, dtype='<u8', count=n_chunk * 2, offset=offset)
+                offset += n_chunk * 16
+
+                if bin_ != TBI_META_BIN:
+                    bins[bin_] = chunks.reshape(-1, 2)
+
+            n_intv, = struct.unpack_from('<i', data, offset)
+            offset += 4
+
+            linear = np.frombuffer(
+                data, dtype='<u8', count=n_intv, offset=offset)
+            offset += n_intv * 8
+
+            self._bins.append(bins)
+            self._linear.append(linear)
+
+    def chunks(self, reference, start, end):
+        """Returns merged (begin, end) virtual offsets covering a region."""
+
+        ref_id = self.contigs.index(reference)
+        bins, linear = self._bins[ref_id], self._linear[ref_id]
+
+        candidates = [
+            bins[bin_] for bin_ in _region_bins(start, end) if bin_ in bins
+        ]
+
+        if not candidates:
+            return []
+
+        chunks = np.concatenate(candidates)
+
+        # Drop chunks ending before the first record that may overlap
+        # the region, according to the linear index.
+        window = start >> TBI_MIN_SHIFT
+        if window < len(linear):
+            chunks = chunks[chunks[:, 1] > linear[window]]
+
+        chunks = chunks[np.argsort(chunks[:, 0], kind='mergesort')]
+
+        # Merge overlapping/adjacent chunks.
+        merged = []
+        for chunk_begin, chunk_end in chunks:
+            if merged and chunk_begin <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], chunk_end)
+            else:
+                merged.append([chunk_begin, chunk_end])
+
+        return [(int(begin), int(end)) for begin, end in merged]
+
+
+class BgzfTabixReader(object):
+    """Reads lines from a tabix-indexed file using parallel decompression.
+
+    Parameters
+    ----------
+    file_path : Path
+        Path to the BGZF-compressed file. The tabix index is expected
+        at file_path + '.tbi'.
+    n_threads : int
+        Number of threads used for decompression. Defaults to the
+        number of CPUs.
+    window_size : int
+        Number of blocks that are decompressed ahead of the lines that
+        are being yielded, which bounds memory usage of large scans.
+
+    """
+
+    def __init__(self, file_path, n_threads=None, window_size=256):
+        self._file_path = Path(file_path)
+        self._n_threads = n_threads or os.cpu_count() or 1
+        self._window_size = window_size
+        self._index = None
+
+    @property
+    def index(self):
+        """Tabix index of the file, read on first access."""
+
+        if self._index is None:
+            self._index = TabixIndex(str(self._file_path) + '.tbi')
+        return self._index
+
+    @property
+    def contigs(self):
+        """Contigs present in the file."""
+        return list(self.index.contigs)
+
+    def fetch_lines(self, reference=None, start=None, end=None):
+        """Fetches the (raw) lines of records overlapping a region.
+
+        Lines are returned in file order, without trailing newlines.
+        If reference is None, records of all contigs are returned.
+        """
+
+        with self._file_path.open('rb') as file_, \
+                mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                futures.ThreadPoolExecutor(self._n_threads) as executor:
+
+            if reference is None and start is None and end is None:
+                yield from self._scan_file(mm, executor)
+            else:
+                contigs = (self.index.contigs
+                           if reference is None else [reference])
+
+                for contig in contigs:
+                    yield from self._fetch_region(mm, executor, contig,
+                                                  start or 0, end or
+                                                  TBI_MAX_POSITION)
+
+    def _scan_file(self, mm, executor):
+        """Yields all data lines of the file."""
+
+        meta = self.index.meta
+
+        n_skip = self.index.skip
+
+        blocks = _iter_line_blocks(
+            self._decompress(mm, executor, _block_offsets(mm, 0, len(mm))))
+
+        for lines in blocks:
+            # Skip the leading lines given by the index.
+            if n_skip > 0:
+                n_skipped = min(n_skip, len(lines))
+                lines, n_skip = lines[n_skipped:], n_skip - n_skipped
+
+            yield from [line for line in lines if not line.startswith(meta)]
+
+    def _fetch_region(self, mm, executor, reference, start, end):
+        """Yields lines overlapping the given region of a contig."""
+
+        if reference not in self.index.contigs:
+            return
+
+        # Chunks only contain records of the given contig, meaning that
+        # positions don't need to be checked if the entire contig is queried.
+        whole_contig = start <= 0 and end >= TBI_MAX_POSITION
+
+        for chunk_begin, chunk_end in self.index.chunks(reference, start,
+                                                        end):
+            first_block, first_offset = chunk_begin >> 16, chunk_begin & 0xFFFF
+            last_block, last_offset = chunk_end >> 16, chunk_end & 0xFFFF
+
+            # Include the last block only if the chunk ends within it.
+            blocks = _block_offsets(mm, first_block,
+                                    last_block + (1 if last_offset else 0))
+
+            data = self._decompress(mm, executor, blocks,
+                                    first_offset=first_offset,
+                                    last_block=last_block,
+                                    last_offset=last_offset)
+
+            for lines in _iter_line_blocks(data):
+                if whole_contig or self._within(lines, reference, start, end):
+                    yield from lines
+                else:
+                    yield from [
+                        line for line in lines
+                        if self._overlaps(line, reference, start, end)
+                    ]
+
+    def _within(self, lines, reference, start, end):
+        """Checks if all (sorted) lines of a block overlap a region.
+
+        As records are sorted by position, this is the case if the first
+        record starts within the region (and therefore also ends after its
+        start) and the last record starts before the end of the region.
+        This way, positions only need to be parsed for the first and last
+        record of most blocks.
+        """
+
+        if not lines:
+            return True
+
+        first, last = self._position(lines[0]), self._position(lines[-1])
+
+        return (first is not None and last is not None and
+                first[0] == reference and last[0] == reference and
+                first[1] >= start and last[1] < end)
+
+    def _overlaps(self, line, reference, start, end):
+        position = self._position(line)
+
+        if position is None or position[0] != reference:
+            return False
+
+        return position[1] < end and position[2] > start
+
+    def _position(self, line):
+        """Returns the (0-based) reference, start and end of a line.
+
+        Returns None for meta lines. Similar to htslib, records are
+        considered to span at least one position.
+        """
+
+        index = self.index
+
+        if line.startswith(index.meta):
+            return None
+
+        fields = line.split('\t', max(index.col_seq, index.col_beg,
+                                      index.col_end))
+
+        rec_start = int(fields[index.col_beg - 1])
+        if not index.zero_based:
+            rec_start -= 1
+
+        if index.col_end > 0:
+            rec_end = max(int(fields[index.col_end - 1]), rec_start + 1)
+        else:
+            rec_end = rec_start + 1
+
+        return fields[index.col_seq - 1], rec_start, rec_end
+
+    def _decompress(self,
+                    mm,
+                    executor,
+                    blocks,
+                    first_offset=0,
+                    last_block=None,
+                    last_offset=0):
+        """Decompresses blocks in parallel, yielding data in order.
+
+        The data of the first block is trimmed to start at first_offset and
+        the data of the block starting at last_block is trimmed to end at
+        last_offset.
+        """
+
+        pending = deque()
+
+        def _submit(block):
+            block_start, block_end = block
+            pending.append((block_start,
+                            executor.submit(_inflate_block,
+                                            mm[block_start:block_end])))
+
+        blocks = iter(blocks)
+        for block in blocks:
+            _submit(block)
+            if len(pending) >= self._window_size:
+                break
+
+        is_first = True
+        while pending:
+            block_start, future = pending.popleft()
+            data = future.result()
+
+            # Keep the window filled while yielding decompressed data.
+            block = next(blocks, None)
+            if block is not None:
+                _submit(block)
+
+            if block_start == last_block:
+                data = data[:last_offset]
+
+            if is_first:
+                data = data[first_offset:]
+                is_first = False
+
+            yield data
+
+
+def _inflate_block(data):
+    """Decompresses the (raw deflate) payload of a single BGZF block."""
+
+    xlen, = struct.unpack_from('<H', data, 10)
+    payload = data[BGZF_HEADER_SIZE + xlen:len(data) - BGZF_FOOTER_SIZE]
+
+    return zlib.decompress(payload, -15)
+
+
+def _block_offsets(mm, start, end):
+    """Yields (start, end) file offsets of the BGZF blocks in a range."""
+
+    position = start
+    while position < end:
+        if mm[position:position + 2] != b'\x1f\x8b':
+            raise ValueError('Invalid BGZF block at offset {}'.format(
+                position))
+
+        xlen, = struct.unpack_from('<H', mm, position + 10)
+
+        # Find the BC subfield, which contains the block size.
+        block_size = None
+        extra = position + BGZF_HEADER_SIZE
+        while extra < position + BGZF_HEADER_SIZE + xlen:
+            si1, si2, slen = struct.unpack_from('<BBH', mm, extra)
+            if si1 == 66 and si2 == 67:
+                block_size, = struct.unpack_from('<H', mm, extra + 4)
+                block_size += 1
+                break
+            extra += 4 + slen
+
+        if block_size is None:
+            raise ValueError('Missing BGZF block size at offset {}'.format(
+                position))
+
+        yield position, position + block_size
+        position += block_size
+
+
+def _iter_line_blocks(data):
+    """Splits a stream of byte strings into lists of (decoded) lines.
+
+    Yields a list for each byte string, containing the lines ending in
+    the byte string. Lines are decoded per list rather than per line.
+    """
+
+    remainder = b''
+
+    for chunk in data:
+        buffer = remainder + chunk
+
+        split = buffer.rfind(b'\n')
+        if split == -1:
+            remainder = buffer
+            continue
+
+        remainder = buffer[split + 1:]
+        yield buffer[:split].decode().split('\n')
+
+    if remainder:
+        yield [remainder.decode()]
+
+
+def _region_bins(start, end):
+    """Returns the .tbi bins that may contain records overlapping a region."""
+
+    end -= 1
+    bins = [0]
+
+    for shift, offset in TBI_LEVELS:
+        bins.extend(range(offset + (start >> shift), offset + (end >> shift) +
+                          1))
+
+    return bins
@@ -0,0 +1,234 @@
+"""Multi-resolution cache for read coverage of BAM files.
+
+Provides the CoveragePyramid class, which stores the per-base coverage of
+a BAM file together with several binned zoom levels as memory-mappable
+NumPy arrays. Pyramids are built lazily per chromosome and are keyed by
+the path, size and modification time of the BAM file and the parameters
+used to compute the coverage, so that stale caches are never reused.
+Arrays are written to temporary files that are renamed into place, which
+allows multiple processes to build the same pyramid concurrently.
+
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import tempfile
+
+import numpy as np
+import pysam
+
+
+class CoveragePyramid(object):
+    """Cached coverage of a BAM file at multiple resolutions.
+
+    Parameters
+    ----------
+    bam_path : str
+        Path to the (indexed) BAM file.
+    cache_dir : str
+        Directory in which pyramids are stored.
+    coverage_func : Callable[[Tuple[str, int, int]], np.ndarray]
+        Function that computes per-base coverage for a given region. Used
+        to compute coverage when building the pyramid.
+    params : Dict[str, Any]
+        Parameters used to compute the coverage (such as read filters),
+        which are included in the cache key.
+    bin_sizes : Tuple[int]
+        Bin sizes of the zoom levels stored in the pyramid (in addition
+        to the per-base coverage).
+    chunk_size : int
+        Size of the chunks (in bp) in which coverage is computed.
+
+    """
+
+    AGGREGATES = ('sum', 'max', 'min')
+
+    def __init__(self,
+                 bam_path,
+                 cache_dir,
+                 coverage_func,
+                 params=None,
+                 bin_sizes=(64, 1024, 16384),
+                 chunk_size=1000000):
+        self._bam_path = str(bam_path)
+        self._coverage_func = coverage_func
+        self._bin_sizes = tuple(sorted(bin_sizes))
+        self._chunk_size = chunk_size
+
+        key = self._cache_key(self._bam_path, params or {}, self._bin_sizes)
+        self._dir_path = Path(cache_dir) / key
+
+        with pysam.AlignmentFile(self._bam_path, 'rb') as file_:
+            self._lengths = dict(zip(file_.references, file_.lengths))
+            self._ref_ids = {ref: i for i, ref in enumerate(file_.references)}
+
+        self._arrays = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
+    @staticmethod
+    def _cache_key(bam_path, params, bin_sizes):
+        stat = os.stat(bam_path)
+
+        key = json.dumps(
+            {
+                'path': os.path.abspath(bam_path),
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
+                'params': params,
+                'bin_sizes': bin_sizes
+            },
+            sort_keys=True,
+            default=str)
+
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _array_path(self, chromosome, level, aggregate=None):
+        parts = [str(self._ref_ids[chromosome]), str(level)]
+        if aggregate is not None:
+            parts.append(aggregate)
+        return self._dir_path / '.'.join(parts + ['npy'])
+
+    def _done_path(self, chromosome):
+        return self._dir_path / '{}.done'.format(self._ref_ids[chromosome])
+
+    def _temp_path(self):
+        """Returns a unique temporary (.npy) path in the pyramid directory."""
+
+        handle, tmp_path = tempfile.mkstemp(
+            suffix='.tmp.npy', dir=str(self._dir_path))
+        os.close(handle)
+
+        return Path(tmp_path)
+
+    def build(self, chromosome):
+        """Builds the pyramid for the given chromosome."""
+
+        self._dir_path.mkdir(parents=True, exist_ok=True)
+        length = self._lengths[chromosome]
+
+        # Compute per-base coverage in chunks.
+        base_path = self._array_path(chromosome, 0)
+        base_tmp = self._temp_path()
+
+        base = np.lib.format.open_memmap(
+            str(base_tmp), mode='w+', dtype=np.int32, shape=(length, ))
+
+        for start in range(0, length, self._chunk_size):
+            end = min(start + self._chunk_size, length)
+            base[start:end] = self._coverage_func((chromosome, start, end))
+
+        base.flush()
+
+        # Build zoom levels from per-base coverage.
+        for level, bin_size in enumerate(self._bin_sizes, 1):
+            offsets = np.arange(0, length, bin_size)
+
+            aggregates = {
+                'sum': np.add.reduceat(base, offsets, dtype=np.int64),
+                'max': np.maximum.reduceat(base, offsets),
+                'min': np.minimum.reduceat(base, offsets)
+            }
+
+            for name, values in aggregates.items():
+                tmp_path = self._temp_path()
+                np.save(str(tmp_path), values)
+                os.replace(str(tmp_path),
+                           str(self._array_path(chromosome, level, name)))
+
+        del base
+        os.replace(str(base_tmp), str(base_path))
+
+        self._done_path(chromosome).touch()
+
+    def _get_array(self, chromosome, level, aggregate=None):
+        key = (chromosome, level, aggregate)
+
+        try:
+            return self._arrays[key]
+        except KeyError:
+            if not self._done_path(chromosome).exists():
+                self.build(chromosome)
+
+            array = np.load(
+                str(self._array_path(chromosome, level, aggregate)),
+                mmap_mode='r')
+            self._arrays[key] = array
+
+            return array
+
+    def fetch(self, region):
+        """Returns per-base coverage for the given region."""
+
+        chromosome, start, end = region
+        return np.array(self._get_array(chromosome, 0)[start:end])
+
+    def fetch_binned(self, region, bins):
+        """Returns coverage for the given region, reduced into bins.
+
+        Coverage is read from the coarsest zoom level that still provides
+        the requested number of bins. Bin edges are aligned to the bins
+        of this zoom level.
+
+        Returns
+        -------
+        Tuple[np.ndarray, Dict[str, np.ndarray]]
+            Bin edges and the mean, max and min coverage of each bin.
+
+        """
+
+        chromosome, start, end = region
+
+        length = self._lengths[chromosome]
+        start, end = min(max(start, 0), length), min(end, length)
+
+        if start >= end:
+            # Region lies beyond the end of the chromosome.
+            empty = np.array([], dtype=np.float64)
+            return (np.array([start], dtype=np.int64),
+                    {'mean': empty, 'max': empty.copy(), 'min': empty.copy()})
+
+        target_size = (end - start) / max(bins, 1)
+
+        # Select coarsest level with sufficient resolution.
+        level, bin_size = 0, 1
+        for i, size in enumerate(self._bin_sizes, 1):
+            if size <= target_size:
+                level, bin_size = i, size
+
+        if level == 0:
+            values = self.fetch((chromosome, start, end))
+            aggregates = {'sum': values, 'max': values, 'min': values}
+            first, last = start, end
+        else:
+            first = start // bin_size
+            last = -(-end // bin_size)
+            aggregates = {
+                name: np.asarray(
+                    self._get_array(chromosome, level, name)[first:last])
+                for name in self.AGGREGATES
+            }
+
+        # Reduce level bins into the requested bins.
+        n_level = last - first
+        offsets = np.unique(
+            np.floor(np.linspace(0, n_level, min(bins, n_level) + 1))
+            .astype(np.int64))
+
+        edges = np.minimum((first + offsets) * bin_size,
+                           self._lengths[chromosome])
+
+        sums = np.add.reduceat(aggregates['sum'], offsets[:-1], dtype=np.int64)
+
+        reduced = {
+            'mean': sums / np.diff(edges),
+            'max': np.maximum.reduceat(aggregates['max'], offsets[:-1]),
+            'min': np.minimum.reduceat(aggregates['min'], offsets[:-1])
+        }
+
+        return edges, reduced
@@ -1,12 +1,24 @@
-import operator
-
+from collections import namedtuple
+from concurrent import futures
+import hashlib
 import itertools
+import json
 import operator
+from pathlib import Path
 from typing import Any, Iterable
 
 import numpy as np
 import pandas as pd
-from intervaltree import IntervalTree
+
+# Interval returned by searches, mirroring intervaltree.Interval.
+Interval = namedtuple('Interval', ['begin', 'end', 'data'])
+
+# Maximum number of candidate pairs that are evaluated at once in
+# batch overlap queries, which bounds their memory usage.
+MAX_CANDIDATES = 2**22
+
+# Distance used for queries without intervals up- or downstream.
+NO_DISTANCE = np.iinfo(np.int64).max
 
 
 class GenomicDataFrame(pd.DataFrame):
@@ -14,8 +26,22 @@ class GenomicDataFrame(pd.DataFrame):
 
     Requires columns 'chromosome', 'start' and 'end' to be present in the
     DataFrame, as these columns are used for indexing.
+
+    The index (trees) is built lazily and carried over to frames derived
+    by pandas operations that keep the same rows (as determined by the
+    identity of their row index), such as adding columns. Carried over
+    trees, and trees of frames that were modified in place, are checked
+    against the positions of the frame before they are reused and are
+    rebuilt if positions changed. Indices can be saved using
+    **save_trees** and memory-mapped using **load_trees**, which avoids
+    rebuilding the index in other processes.
     """
 
+    _metadata = [
+        '_chrom_col', '_start_col', '_end_col', '_trees', '_trees_index',
+        '_trees_checked'
+    ]
+
     def __init__(self,
                  *args,
                  chrom_col='chromosome',
@@ -28,78 +54,814 @@ class GenomicDataFrame(pd.DataFrame):
         self._start_col = start_col
         self._end_col = end_col
         self._trees = None
+        self._trees_index = None
+        self._trees_checked = False
 
     @property
     def _constructor(self):
         return GenomicDataFrame
 
+    def __finalize__(self, other, method=None, **kwargs):
+        result = super().__finalize__(other, method=method, **kwargs)
+
+        # Operations such as replace or where may have changed positions.
+        result._trees_checked = False
+
+        return result
+
+    def _clear_item_cache(self):
+        # Called by pandas when the frame is modified in place.
+        self._trees_checked = False
+        super()._clear_item_cache()
+
+    def __setitem__(self, key, value):
+        keys = key if isinstance(key, (list, tuple, pd.Index)) else [key]
+
+        position_cols = {self._chrom_col, self._start_col, self._end_col}
+        if any(col in position_cols for col in keys):
+            self.reset_trees()
+
+        super().__setitem__(key, value)
+
     @property
     def trees(self):
         """Returns trees used for indexing the DataFrame."""
-        if self._trees is None:
+
+        # Trees inherited from another frame are only valid for the rows
+        # they were built for, and only if their positions are unchanged.
+        if (self._trees is None or self._trees_index is None or
+                not self.index.is_(self._trees_index) or
+                (not self._trees_checked and not self._trees.matches(
+                    self[self._chrom_col].values, self[self._start_col]
+                    .values, self[self._end_col].values))):
             self._trees = self._build_trees()
+            self._trees_index = self.index
+
+        self._trees_checked = True
+
         return self._trees
 
-    def _build_trees(self):
-        # Subset frame to positions and rename columns to defaults.
-        position_df = self[[self._chrom_col, self._start_col, self._end_col]]
-        position_df = position_df.rename(columns={
-            self._chrom_col: 'chromosome',
-            self._start_col: 'start',
-            self._end_col: 'end'
-        })
+    def reset_trees(self):
+        """Drops the trees used for indexing the DataFrame."""
+        self._trees = None
+        self._trees_index = None
+        self._trees_checked = False
+
+    def fingerprint(self):
+        """Returns a fingerprint of the positions in the DataFrame.
+
+        The fingerprint is used to check if saved trees match the
+        positions of the frame they are loaded for.
+        """
+
+        return _fingerprint(self[self._chrom_col].values,
+                            self[self._start_col].values,
+                            self[self._end_col].values)
+
+    def save_trees(self, dir_path):
+        """Saves the trees used for indexing the DataFrame.
+
+        Parameters
+        ----------
+        dir_path : Path
+            Output directory for the trees.
+
+        """
 
-        # Add index and sort by chromosome (for grouping).
-        position_df = position_df.assign(index=np.arange(len(self)))
-        position_df = position_df.sort_values(by='chromosome')
+        self.trees.save(dir_path, fingerprint=self.fingerprint())
 
-        # Convert to tuples.
-        tuples = ((tup.chromosome, tup.start, tup.end, tup.index)
-                  for tup in position_df.itertuples())
+    def load_trees(self, dir_path, validate=True):
+        """Loads (memory-maps) trees saved using **save_trees**.
 
-        return GenomicIntervalTree.from_tuples(tuples)
+        Parameters
+        ----------
+        dir_path : Path
+            Directory containing the saved trees.
+        validate : bool
+            Whether to check that the fingerprint of the trees matches the
+            positions of the DataFrame. Validation requires hashing the
+            position columns, which can be skipped if the trees are known
+            to belong to the frame.
+
+        """
+
+        trees = GenomicIntervalTree.load(dir_path)
+
+        if validate and trees.fingerprint != self.fingerprint():
+            raise ValueError('Trees in {!r} do not match the positions '
+                             'of the DataFrame'.format(str(dir_path)))
+
+        self._trees = trees
+        self._trees_index = self.index
+        self._trees_checked = True
+
+    def _build_trees(self):
+        # Index rows by their position in the frame.
+        return GenomicIntervalTree.from_arrays(
+            self[self._chrom_col].values, self[self._start_col].values,
+            self[self._end_col].values)
 
     def search(self, chromosome, begin, end):
         """Subsets the DataFrame for rows within given range."""
-        overlap = self.trees.search(chromosome, begin, end)
-        indices = [interval[2] for interval in overlap]
+        indices = self.trees.search_indices(chromosome, begin, end)
         return self.iloc[indices].sort_index()
 
+    def overlap_indices(self, other, n_jobs=1):
+        """Returns positions of overlapping rows in this and another frame.
+
+        Rows are queried in bulk against the index of the other frame,
+        one chromosome at a time.
+
+        Parameters
+        ----------
+        other : GenomicDataFrame
+            Frame to find overlapping rows in.
+        n_jobs : int
+            Number of processes used to query chromosomes in parallel.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Row positions in this frame and the corresponding positions
+            of the overlapping rows in the other frame, sorted by position
+            in this frame and then by position in the other frame.
+
+        """
+
+        results = self._query_chromosomes(
+            other, IntervalArray.overlaps, n_jobs=n_jobs)
+
+        self_pos = [positions[query] for positions, _, (query, _) in results]
+        other_pos = [array.data[hits] for _, array, (_, hits) in results]
+
+        self_pos = np.concatenate([np.array([], dtype=np.int64)] + self_pos)
+        other_pos = np.concatenate([np.array([], dtype=np.int64)] + other_pos)
+
+        # Sort pairs on a combined key, which is cheaper than a lexsort.
+        keys = np.sort(self_pos * len(other) + other_pos)
+        return np.divmod(keys, max(len(other), 1))
+
+    def overlap_join(self, other, how='inner', suffixes=('', '_other'),
+                     n_jobs=1):
+        """Joins rows with the overlapping rows of another frame.
+
+        Parameters
+        ----------
+        other : GenomicDataFrame
+            Frame to join with.
+        how : str
+            Type of join. 'inner' only keeps rows with overlaps, 'left'
+            also keeps rows without overlaps (with missing values for
+            the columns of the other frame).
+        suffixes : Tuple[str, str]
+            Suffixes to add to columns that are present in both frames.
+        n_jobs : int
+            Number of processes used to query chromosomes in parallel.
+
+        Returns
+        -------
+        GenomicDataFrame
+            Joined frame, which keeps the index of this frame. Rows are
+            repeated for each overlapping row in the other frame.
+
+        """
+
+        if how not in {'inner', 'left'}:
+            raise ValueError('Unsupported join type {!r}'.format(how))
+
+        self_pos, other_pos = self.overlap_indices(other, n_jobs=n_jobs)
+
+        if how == 'left':
+            unmatched = np.setdiff1d(np.arange(len(self)), self_pos)
+
+            self_pos = np.concatenate([self_pos, unmatched])
+            other_pos = np.concatenate([other_pos, np.full_like(unmatched, -1)])
+
+            order = np.lexsort((other_pos, self_pos))
+            self_pos, other_pos = self_pos[order], other_pos[order]
+
+        left = pd.DataFrame(self).iloc[self_pos]
+
+        # Positions of -1 (no overlap) are reindexed as missing values.
+        right = pd.DataFrame(other).reset_index(drop=True).reindex(other_pos)
+        right.index = left.index
+
+        shared = left.columns.intersection(right.columns)
+        left = left.rename(columns={col: col + suffixes[0] for col in shared})
+        right = right.rename(columns={col: col + suffixes[1] for col in shared})
+
+        def _rename(col):
+            return col + suffixes[0] if col in shared else col
+
+        return GenomicDataFrame(
+            pd.concat([left, right], axis=1),
+            chrom_col=_rename(self._chrom_col),
+            start_col=_rename(self._start_col),
+            end_col=_rename(self._end_col))
+
+    def count_overlaps(self, other, n_jobs=1):
+        """Counts the rows of another frame overlapping each row.
+
+        Parameters
+        ----------
+        other : GenomicDataFrame
+            Frame containing the rows to count.
+        n_jobs : int
+            Number of processes used to query chromosomes in parallel.
+
+        Returns
+        -------
+        pd.Series
+            Number of overlapping rows, indexed by the index of this frame.
+
+        """
+
+        counts = np.zeros(len(self), dtype=np.int64)
+
+        results = self._query_chromosomes(
+            other, IntervalArray.count_overlaps, n_jobs=n_jobs)
+
+        for positions, _, result in results:
+            counts[positions] = result
+
+        return pd.Series(counts, index=self.index)
+
+    def nearest(self, other, n_jobs=1):
+        """Finds the nearest row of another frame for each row.
+
+        Overlapping rows have a distance of 0. Otherwise, the distance is
+        the number of bases between the two intervals. Rows without any
+        row of the other frame on their chromosome have a distance of -1.
+
+        Parameters
+        ----------
+        other : GenomicDataFrame
+            Frame to search for nearest rows.
+        n_jobs : int
+            Number of processes used to query chromosomes in parallel.
+
+        Returns
+        -------
+        pd.DataFrame
+            Frame indexed by the index of this frame, containing the
+            position of the nearest row in the other frame ('position')
+            and its distance ('distance'). Positions are -1 for rows
+            without a nearest row.
+
+        """
+
+        nearest_pos = np.full(len(self), -1, dtype=np.int64)
+        distances = np.full(len(self), -1, dtype=np.int64)
+
+        results = self._query_chromosomes(
+            other, IntervalArray.nearest, n_jobs=n_jobs)
+
+        for positions, array, (hits, hit_distances) in results:
+            found = hits >= 0
+            nearest_pos[positions[found]] = array.data[hits[found]]
+            distances[positions[found]] = hit_distances[found]
+
+        return pd.DataFrame(
+            {
+                'position': nearest_pos,
+                'distance': distances
+            },
+            index=self.index,
+            columns=['position', 'distance'])
+
+    def _query_chromosomes(self, other, func, n_jobs=1):
+        """Applies a batch query to the rows of each chromosome.
+
+        Calls func(array, begins, ends) for the rows of each chromosome,
+        with array the IntervalArray of the chromosome in other. Returns
+        a list of (positions, array, result) tuples, with positions the
+        positions of the queried rows in this frame. Chromosomes that
+        are not present in other are skipped.
+        """
+
+        codes, uniques = pd.factorize(self[self._chrom_col].values)
+
+        order = np.argsort(codes, kind='mergesort')
+        bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+
+        begins = self[self._start_col].values
+        ends = self[self._end_col].values
+
+        tasks = []
+        for i, chrom in enumerate(uniques):
+            try:
+                array = other.trees[chrom]
+            except KeyError:
+                continue
+
+            positions = order[bounds[i]:bounds[i + 1]]
+            tasks.append((positions, array, begins[positions],
+                          ends[positions]))
+
+        if n_jobs == 1 or len(tasks) <= 1:
+            results = [func(*task[1:]) for task in tasks]
+        else:
+            with futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(
+                    executor.map(func, *zip(*(task[1:] for task in tasks))))
+
+        return [(task[0], task[1], result)
+                for task, result in zip(tasks, results)]
+
 
 class GenomicIntervalTree(object):
-    """Datastructure for efficiently accessing genomic objects by position."""
+    """Datastructure for efficiently accessing genomic objects by position.
+
+    Intervals are stored per chromosome in an IntervalArray, which keeps
+    the interval bounds and objects in NumPy arrays sorted by start
+    position. Intervals are half-open, similar to intervaltree.
 
-    def __init__(self, trees):
-        # type: (Dict[str, IntervalTree]) -> None
+    Trees can be saved using **save** and opened using **load**. Saved
+    trees are memory-mapped per chromosome when first accessed, which
+    means that they can be shared between processes through the page
+    cache and be pickled cheaply for use in process pools.
+    """
+
+    def __init__(self, trees, fingerprint=None):
+        # type: (Dict[str, IntervalArray], str) -> None
         self._trees = trees
+        self._fingerprint = fingerprint
+        self._dir_path = None
+        self._chromosomes = None
+        self._max_spans = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+
+        # Saved trees are memory-mapped again after unpickling.
+        if self._dir_path is not None:
+            state['_trees'] = {}
+
+        return state
 
     def __getitem__(self, i):
-        # type: (str) -> IntervalTree
+        # type: (str) -> IntervalArray
         """Returns tree with given chromosome name."""
-        return self._trees[i]
+
+        try:
+            return self._trees[i]
+        except KeyError:
+            if self._dir_path is None or i not in self._max_spans:
+                raise
+
+            array = IntervalArray.load(self._dir_path,
+                                       self._chromosomes.index(i),
+                                       self._max_spans[i])
+            self._trees[i] = array
+
+            return array
+
+    @property
+    def chromosomes(self):
+        """Chromosomes present in the tree."""
+
+        if self._dir_path is not None:
+            return list(self._chromosomes)
+        return sorted(self._trees.keys())
+
+    @property
+    def fingerprint(self):
+        """Fingerprint of the intervals the tree was built for (if given)."""
+        return self._fingerprint
+
+    def save(self, dir_path, fingerprint=None):
+        """Saves the tree as NumPy arrays.
+
+        Parameters
+        ----------
+        dir_path : Path
+            Output directory for the tree.
+        fingerprint : str
+            Fingerprint of the intervals, which is stored with the tree
+            to check if it is still valid when loaded.
+
+        """
+
+        dir_path = Path(dir_path)
+        dir_path.mkdir(parents=True, exist_ok=True)
+
+        chromosomes = self.chromosomes
+        max_spans = {}
+
+        for i, chrom in enumerate(chromosomes):
+            array = self[chrom]
+            array.save(dir_path, i)
+            max_spans[chrom] = int(array.max_span)
+
+        index = {
+            'chromosomes': chromosomes,
+            'max_spans': max_spans,
+            'fingerprint': fingerprint or self._fingerprint
+        }
+
+        with (dir_path / 'index.json').open('w') as file_:
+            json.dump(index, file_)
+
+    @classmethod
+    def load(cls, dir_path):
+        """Opens a tree saved using **save**."""
+
+        dir_path = Path(dir_path)
+
+        with (dir_path / 'index.json').open() as file_:
+            index = json.load(file_)
+
+        tree = cls({}, fingerprint=index['fingerprint'])
+        tree._dir_path = dir_path
+        tree._chromosomes = index['chromosomes']
+        tree._max_spans = index['max_spans']
+
+        return tree
 
     @classmethod
     def from_tuples(cls, tuples):
-        """Builds an instance from tuples.
+        """Builds an instance from (chromosome, start, end, obj) tuples.
+
+        Tuples do not need to be sorted.
+        """
+
+        tuples = list(tuples)
+
+        if len(tuples) == 0:
+            return cls({})
+
+        chromosomes, starts, ends, objects = zip(*tuples)
+
+        data = np.empty(len(objects), dtype=object)
+        data[:] = objects
+
+        return cls.from_arrays(chromosomes, starts, ends, data=data)
+
+    @classmethod
+    def from_arrays(cls, chromosomes, starts, ends, data=None):
+        """Builds an instance from arrays of interval positions.
+
+        Parameters
+        ----------
+        chromosomes : np.ndarray
+            Chromosome of each interval.
+        starts : np.ndarray
+            Start position of each interval.
+        ends : np.ndarray
+            End position of each interval (exclusive).
+        data : np.ndarray
+            Object associated with each interval. Defaults to the
+            position of each interval in the given arrays.
 
-        Assumes tuples are sorted by chromosome.
         """
 
-        # Group by chromosome.
-        groups = itertools.groupby(tuples, key=operator.itemgetter(0))
+        starts = np.asarray(starts)
+        ends = np.asarray(ends)
+
+        if data is None:
+            data = np.arange(len(starts))
+
+        codes, uniques = pd.factorize(np.asarray(chromosomes), sort=True)
+
+        # Sort by chromosome, then start (stable for equal positions).
+        order = np.lexsort((starts, codes))
+        bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
 
-        # Build trees.
         trees = {}
-        for chrom, group in groups:
-            trees[chrom] = IntervalTree.from_tuples(
-                (start, end, obj) for _, start, end, obj in group)
+        for i, chrom in enumerate(uniques):
+            idx = order[bounds[i]:bounds[i + 1]]
+            trees[chrom] = IntervalArray(
+                starts[idx], ends[idx], data[idx], is_sorted=True)
 
         return cls(trees)
 
     def search(self, chromosome, begin, end=None):
-        # type: (str, int, int) -> Iterable[object]
+        # type: (str, int, int) -> Iterable[Interval]
         """Searches the tree for objects within given range."""
-        return self._trees[chromosome].search(begin, end)
+        return self[chromosome].search(begin, end)
+
+    def search_indices(self, chromosome, begin, end=None):
+        # type: (str, int, int) -> np.ndarray
+        """Returns the data of intervals within given range as an array."""
+        array = self[chromosome]
+        return array.data[array.search_positions(begin, end)]
+
+    def matches(self, chromosomes, starts, ends):
+        """Checks if the tree indexes the given intervals.
+
+        Assumes that the data of the tree contains the positions of the
+        intervals in the given arrays, as for trees of GenomicDataFrames.
+        """
+
+        sizes = [len(self[chrom]) for chrom in self.chromosomes]
+        if sum(sizes) != len(starts):
+            return False
+
+        for chrom in self.chromosomes:
+            array = self[chrom]
+            positions = np.asarray(array.data)
+
+            if not (np.array_equal(starts[positions], array.starts) and
+                    np.array_equal(ends[positions], array.ends) and
+                    np.all(chromosomes[positions] == chrom)):
+                return False
+
+        return True
+
+
+class IntervalArray(object):
+    """Intervals of a single chromosome, stored as sorted NumPy arrays.
+
+    Intervals are sorted by their start positions. Besides the interval
+    ends, the array stores the running maximum of the ends, which together
+    with the maximum interval span bounds the range of intervals that can
+    overlap a query. Queries therefore only require two binary searches
+    and a vectorized filter over the remaining candidates.
+
+    Parameters
+    ----------
+    starts : np.ndarray
+        Start positions of the intervals.
+    ends : np.ndarray
+        End positions of the intervals (exclusive).
+    data : np.ndarray
+        Objects associated with the intervals.
+    is_sorted : bool
+        Whether the intervals are already sorted by start position.
+
+    """
+
+    def __init__(self, starts, ends, data, is_sorted=False):
+        if not is_sorted:
+            order = np.argsort(starts, kind='mergesort')
+            starts, ends, data = starts[order], ends[order], data[order]
+
+        self.starts = starts
+        self.ends = ends
+        self.data = data
+
+        self._max_ends = np.maximum.accumulate(ends) if len(ends) else ends
+        self._max_span = (ends - starts).max() if len(ends) else 0
+
+        self._end_order = None
+        self._max_end_positions = None
+
+        # Location of saved arrays, if memory-mapped.
+        self._source = None
+
+    def __getstate__(self):
+        # Memory-mapped arrays are pickled by location.
+        if self._source is not None:
+            return {'_source': self._source}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if list(state) == ['_source']:
+            state = IntervalArray.load(*state['_source']).__dict__
+        self.__dict__.update(state)
+
+    @property
+    def end_order(self):
+        """Positions of the intervals, sorted by end position."""
+
+        if self._end_order is None:
+            self._end_order = np.argsort(self.ends, kind='mergesort')
+        return self._end_order
+
+    @property
+    def max_end_positions(self):
+        """Positions of the intervals with the running maximum end."""
+
+        if self._max_end_positions is None:
+            # Positions at which the running maximum increases.
+            is_max = np.empty(len(self.ends), dtype=bool)
+            is_max[:1] = True
+            is_max[1:] = self.ends[1:] > self._max_ends[:-1]
+
+            self._max_end_positions = np.maximum.accumulate(
+                np.where(is_max, np.arange(len(self.ends)), 0))
+
+        return self._max_end_positions
+
+    def __len__(self):
+        return len(self.starts)
+
+    def save(self, dir_path, prefix):
+        """Saves the arrays as prefix.name.npy files in dir_path."""
+
+        if self.data.dtype == object:
+            raise ValueError('Arrays with object data cannot be saved')
+
+        arrays = {
+            'starts': self.starts,
+            'ends': self.ends,
+            'data': self.data,
+            'max_ends': self._max_ends
+        }
+
+        for name, values in arrays.items():
+            np.save(
+                str(Path(dir_path) / '{}.{}.npy'.format(prefix, name)),
+                values)
+
+    @property
+    def max_span(self):
+        """Maximum span of the intervals."""
+        return self._max_span
+
+    @classmethod
+    def load(cls, dir_path, prefix, max_span):
+        """Memory-maps arrays saved using **save**."""
+
+        arrays = {
+            name: np.load(
+                str(Path(dir_path) / '{}.{}.npy'.format(prefix, name)),
+                mmap_mode='r')
+            for name in ('starts', 'ends', 'data', 'max_ends')
+        }
+
+        array = cls.__new__(cls)
+        array.starts = arrays['starts']
+        array.ends = arrays['ends']
+        array.data = arrays['data']
+
+        array._max_ends = arrays['max_ends']
+        array._max_span = max_span
+
+        array._end_order = None
+        array._max_end_positions = None
+
+        array._source = (str(dir_path), prefix, max_span)
+
+        return array
+
+    def __iter__(self):
+        for begin, end, obj in zip(self.starts, self.ends, self.data):
+            yield Interval(begin, end, obj)
+
+    def search_positions(self, begin, end=None):
+        """Returns positions of intervals overlapping the given range.
+
+        If end is None, intervals containing the point begin are returned.
+        """
+
+        if end is None:
+            upper = np.searchsorted(self.starts, begin, side='right')
+        elif begin >= end:
+            return np.array([], dtype=np.int64)
+        else:
+            upper = np.searchsorted(self.starts, end, side='left')
+
+        # Intervals before lower all end before begin.
+        lower = max(
+            np.searchsorted(self._max_ends, begin, side='right'),
+            np.searchsorted(
+                self.starts, begin - self._max_span, side='right'))
+
+        if lower >= upper:
+            return np.array([], dtype=np.int64)
+
+        candidates = np.arange(lower, upper)
+        return candidates[self.ends[lower:upper] > begin]
+
+    def search(self, begin, end=None):
+        """Returns intervals overlapping the given range."""
+
+        return [
+            Interval(self.starts[i], self.ends[i], self.data[i])
+            for i in self.search_positions(begin, end)
+        ]
+
+    def overlaps(self, begins, ends):
+        """Returns positions of intervals overlapping a batch of ranges.
+
+        Parameters
+        ----------
+        begins : np.ndarray
+            Start positions of the query ranges.
+        ends : np.ndarray
+            End positions of the query ranges (exclusive).
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Positions of the queries and of the overlapping intervals,
+            with one entry per overlapping pair.
+
+        """
+
+        begins = np.asarray(begins)
+        ends = np.asarray(ends)
+
+        lower = np.maximum(
+            np.searchsorted(self._max_ends, begins, side='right'),
+            np.searchsorted(
+                self.starts, begins - self._max_span, side='right'))
+
+        upper = np.searchsorted(self.starts, ends, side='left')
+        upper = np.where(begins < ends, np.maximum(upper, lower), lower)
+
+        counts = upper - lower
+        cum_counts = np.cumsum(counts)
+
+        # Split queries into chunks with a bounded number of candidates.
+        n_chunks = (cum_counts[-1] // MAX_CANDIDATES) if len(counts) else 0
+        splits = np.searchsorted(
+            cum_counts, np.arange(1, n_chunks + 1) * MAX_CANDIDATES)
+        bounds = np.unique(np.concatenate([[0], splits, [len(counts)]]))
+
+        queries, positions = [], []
+        for chunk_start, chunk_end in zip(bounds[:-1], bounds[1:]):
+            chunk_counts = counts[chunk_start:chunk_end]
+
+            query = np.repeat(np.arange(chunk_start, chunk_end), chunk_counts)
+            offsets = np.arange(len(query)) - np.repeat(
+                np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+            candidates = lower[query] + offsets
+
+            mask = self.ends[candidates] > begins[query]
+            queries.append(query[mask])
+            positions.append(candidates[mask])
+
+        if not queries:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty
+
+        return np.concatenate(queries), np.concatenate(positions)
+
+    def count_overlaps(self, begins, ends):
+        """Counts the intervals overlapping a batch of ranges.
+
+        Overlapping intervals start before the end of a range, excluding
+        the intervals that also end before (or at) the start of a range.
+        This avoids enumerating the overlapping intervals.
+        """
+
+        begins = np.asarray(begins)
+        ends = np.asarray(ends)
+
+        n_started = np.searchsorted(self.starts, ends, side='left')
+        n_ended = np.searchsorted(
+            self.ends[self.end_order], begins, side='right')
+
+        return np.where(begins < ends, n_started - n_ended, 0)
+
+    def nearest(self, begins, ends):
+        """Finds the nearest interval for a batch of ranges.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Positions of the nearest intervals (-1 if the array is empty)
+            and their distances to the ranges (0 for overlaps).
+
+        """
+
+        begins = np.asarray(begins)
+        ends = np.asarray(ends)
+
+        if len(self) == 0:
+            missing = np.full(len(begins), -1, dtype=np.int64)
+            return missing, missing.copy()
+
+        # Intervals starting before the end of a range overlap it if
+        # the largest end among them lies after the start of the range.
+        n_started = np.searchsorted(self.starts, ends, side='left')
+        overlapping = self.max_end_positions[np.maximum(n_started - 1, 0)]
+        is_overlap = (n_started > 0) & (self.ends[overlapping] > begins)
+
+        # Nearest downstream: first interval starting after the range.
+        downstream = np.minimum(n_started, len(self) - 1)
+        down_distance = np.where(n_started < len(self),
+                                 self.starts[downstream] - ends, NO_DISTANCE)
+
+        # Nearest upstream: interval with the last end before the range.
+        sorted_ends = self.ends[self.end_order]
+        n_ended = np.searchsorted(sorted_ends, begins, side='right')
+        upstream = self.end_order[np.maximum(n_ended - 1, 0)]
+        up_distance = np.where(n_ended > 0, begins - self.ends[upstream],
+                               NO_DISTANCE)
+
+        positions = np.where(
+            is_overlap, overlapping,
+            np.where(up_distance <= down_distance, upstream, downstream))
+        distances = np.where(is_overlap, 0,
+                             np.minimum(up_distance, down_distance))
+
+        return positions, distances
+
+
+def _fingerprint(chromosomes, starts, ends):
+    """Computes a fingerprint (hash) of interval positions."""
+
+    hash_ = hashlib.sha1(str(len(starts)).encode('utf-8'))
+
+    hash_.update(
+        pd.util.hash_array(np.asarray(chromosomes, dtype=object)).tobytes())
+    hash_.update(np.ascontiguousarray(starts, dtype=np.int64).tobytes())
+    hash_.update(np.ascontiguousarray(ends, dtype=np.int64).tobytes())
+
+    return hash_.hexdigest()
 
 
 def merge_genomic_intervals(genomic_intervals):
@@ -1,19 +1,38 @@
 """Functionality for creating and dealing with tabix-indexed files."""
 
+from collections import OrderedDict
 import contextlib
+import gzip
+import heapq
 import itertools
+import os
 from pathlib import Path
+import re
 import subprocess
-from typing import Any, Callable, Iterable, List
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
+import numpy as np
+import pandas as pd
 import pysam
 
+from .bgzf import BgzfTabixReader
+
 # GTF_PROXY = pysam.ctabixproxies.GTFProxy
 
 
 class TabixIterator(object):
     """Iterator that iterates over records in a tabix file using pysam."""
 
+    # Names of the columns in the tabix file, used for batches/filters.
+    _columns = ()  # type: Tuple[str, ...]
+
+    # Numeric columns and their dtypes. Other columns are kept as strings.
+    _dtypes = {}  # type: Dict[str, Any]
+
+    # Whether start positions in the file are 1-based. Positions in batches
+    # are converted to 0-based starts, similar to records returned by pysam.
+    _one_based = False
+
     def __init__(self, file_path: Path) -> None:
         self._file_path = file_path
 
@@ -23,9 +42,10 @@ class TabixIterator(object):
         raise NotImplementedError()
 
     @contextlib.contextmanager
-    def _open_file(self) -> pysam.TabixFile:
-        # Open gtf file.
-        tabix_file = pysam.TabixFile(self._file_path, parser=self._parser)
+    def _open_file(self, raw: bool=False) -> pysam.TabixFile:
+        # Open gtf file. Raw files yield unparsed lines.
+        tabix_file = pysam.TabixFile(
+            str(self._file_path), parser=None if raw else self._parser)
 
         # Yield file object and ensure it is closed.
         try:
@@ -33,6 +53,18 @@ class TabixIterator(object):
         finally:
             tabix_file.close()
 
+    @staticmethod
+    def _fetch_records(tabix_file, reference, start, end):
+        # For some reason pysam does not fetch all records if reference
+        # is None under Python 2.7. To fix this, here we simply chain all
+        # the contig records into one iterable.
+        if reference is None:
+            contigs = tabix_file.contigs
+            return itertools.chain.from_iterable((tabix_file.fetch(
+                reference=ref, start=start, end=end) for ref in contigs))
+
+        return tabix_file.fetch(reference=reference, start=start, end=end)
+
     @property
     def contigs(self) -> List[str]:
         """Contigs present in the tabix file."""
@@ -48,65 +80,785 @@ class TabixIterator(object):
         """Fetches tabix records from the tabix file."""
 
         with self._open_file() as tabix_file:
-            # For some reason pysam does not fetch all records if reference
-            # is None under Python 2.7. To fix this, here we simply chain all
-            # the contig records into one iterable.
-            if reference is None:
-                contigs = tabix_file.contigs
-                records = itertools.chain.from_iterable((tabix_file.fetch(
-                    reference=ref, start=start, end=end) for ref in contigs))
-            else:
-                records = tabix_file.fetch(
-                    reference=reference, start=start, end=end)
+            records = self._fetch_records(tabix_file, reference, start, end)
 
             # Filter records on additional filters.
             if filters is not None:
-                for filter_func in filters:
-                    records = (rec for rec in records if filter_func(rec))
+                filters = list(filters)
+                records = (rec for rec in records
+                           if all(filter_func(rec)
+                                  for filter_func in filters))
 
             yield from records
 
+    def fetch_many(self,
+                   regions: Iterable[Tuple[str, int, int]],
+                   filters: Iterable[Callable[[Any], bool]]=None,
+                   max_gap: int=65536) -> List[List[Any]]:
+        """Fetches tabix records for multiple regions in a single pass.
+
+        Regions are sorted and merged (joining overlapping regions and
+        regions within max_gap bp of each other), after which the merged
+        regions are fetched in order using a single file handle. This way,
+        each compressed block is decompressed at most once, also if the
+        requested regions overlap. Fetched records are routed back to each
+        of the requested regions that they overlap.
+
+        Parameters
+        ----------
+        regions : List[Tuple[str, int, int]]
+            Regions to fetch, given as (reference, start, end) tuples.
+        filters : List[Callable[[Any], bool]]
+            Additional filters, which records must all pass.
+        max_gap : int
+            Maximum distance (in bp) between regions for them to be merged.
+            Merging nearby regions avoids seeking to (and decompressing) the
+            same blocks repeatedly, at the expense of also reading the
+            records between the regions.
+
+        Returns
+        -------
+        List[List[Any]]
+            Records overlapping each of the given regions, in the same
+            order as the regions.
+
+        """
+
+        regions = [tuple(region) for region in regions]
+        results = [[] for _ in regions]
+
+        filters = list(filters or [])
+
+        with self._open_file() as tabix_file:
+            contigs = set(tabix_file.contigs)
+
+            for reference, start, end, members in _merge_regions(
+                    regions, max_gap=max_gap):
+                if reference not in contigs:
+                    continue
+
+                records = tabix_file.fetch(
+                    reference=reference, start=start, end=end)
+
+                # Route records to overlapping member regions using a sweep
+                # over the members (sorted by start), as records are also
+                # sorted by start position. Active members are kept in a
+                # heap ordered by their end position, so that members ending
+                # before the current record can be dropped.
+                active, n_added = [], 0
+
+                for record in records:
+                    if not all(filter_func(record)
+                               for filter_func in filters):
+                        continue
+
+                    rec_start, rec_end = self._record_span(record)
+
+                    while (n_added < len(members) and
+                           regions[members[n_added]][1] < rec_end):
+                        i = members[n_added]
+                        heapq.heappush(active, (regions[i][2], i))
+                        n_added += 1
+
+                    while active and active[0][0] <= rec_start:
+                        heapq.heappop(active)
+
+                    for _, i in active:
+                        if regions[i][1] < rec_end:
+                            results[i].append(record)
+
+        return results
+
+    @staticmethod
+    def _record_span(record) -> Tuple[int, int]:
+        """Returns the (0-based) start and end positions of a record."""
+        return record.start, record.end
+
+    def fetch_batches(self,
+                      reference: str=None,
+                      start: int=None,
+                      end: int=None,
+                      filters: Iterable['RecordFilter']=None,
+                      batch_size: int=100000,
+                      n_threads: int=None) -> Iterable[pd.DataFrame]:
+        """Fetches records from the tabix file as batches of columns.
+
+        In contrast to **fetch**, records are not parsed into pysam proxy
+        objects. Instead, filters are evaluated directly on the raw lines
+        of the file and the fields of records passing the filters are
+        collected into DataFrames of (at most) batch_size rows.
+
+        Parameters
+        ----------
+        reference : str
+            Reference (contig) to fetch records from. If None, records
+            from all contigs are fetched.
+        start : int
+            Start of the region to fetch (0-based).
+        end : int
+            End of the region to fetch.
+        filters : List[RecordFilter]
+            Declarative filters, which records must all pass.
+        batch_size : int
+            Maximum number of records per batch.
+        n_threads : int
+            If given, lines are read using a BgzfTabixReader, which
+            decompresses the BGZF blocks of the file in parallel using the
+            given number of threads. This is mainly beneficial for large
+            (whole-chromosome or whole-genome) scans.
+
+        Returns
+        -------
+        Iterable[pandas.DataFrame]
+            Batches of records, with one column per field of the file.
+
+        """
+
+        if not self._columns:
+            raise NotImplementedError()
+
+        predicates = [
+            filter_.compile(self._columns) for filter_ in (filters or [])
+        ]
+
+        rows, n_batches = [], 0
+        for line in self._fetch_lines(reference, start, end, n_threads):
+            fields = None
+            for predicate in predicates:
+                fields = predicate(line, fields)
+                if fields is None:
+                    break
+            else:
+                rows.append(fields or line.split('\t'))
+
+                if len(rows) >= batch_size:
+                    yield self._to_batch(rows)
+                    rows, n_batches = [], n_batches + 1
+
+        # Always yield at least one (possibly empty) batch.
+        if rows or n_batches == 0:
+            yield self._to_batch(rows)
+
+    def fetch_frame(self,
+                    reference: str=None,
+                    start: int=None,
+                    end: int=None,
+                    **kwargs) -> pd.DataFrame:
+        """Fetches records from the tabix file as a single DataFrame.
+
+        See **fetch_batches** for a description of the parameters.
+        """
+
+        batches = self.fetch_batches(reference, start, end, **kwargs)
+        return pd.concat(list(batches), ignore_index=True)
+
+    def _fetch_lines(self, reference, start, end, n_threads=None):
+        """Fetches raw lines, optionally using parallel decompression."""
+
+        if n_threads is not None:
+            reader = BgzfTabixReader(self._file_path, n_threads=n_threads)
+            yield from reader.fetch_lines(reference, start, end)
+        else:
+            with self._open_file(raw=True) as tabix_file:
+                yield from self._fetch_records(tabix_file, reference, start,
+                                               end)
+
+    def _to_batch(self, rows: List[List[str]]) -> pd.DataFrame:
+        """Converts rows of raw fields into a DataFrame of typed columns."""
+
+        # Transpose rows into columns, padding missing trailing fields.
+        if rows:
+            columns = list(itertools.zip_longest(*rows))[:len(self._columns)]
+        else:
+            columns = [[] for _ in self._columns]
+
+        data = {}
+        for name, values in zip(self._columns, columns):
+            dtype = self._dtypes.get(name)
+
+            if dtype is None:
+                data[name] = np.array(values, dtype=object)
+            elif np.issubdtype(dtype, np.integer):
+                data[name] = np.array(values).astype(dtype)
+            else:
+                data[name] = pd.to_numeric(
+                    pd.Series(values), errors='coerce').values.astype(dtype)
+
+        if self._one_based and 'start' in data:
+            data['start'] -= 1
+
+        return pd.DataFrame(data, columns=self._columns[:len(columns)])
+
+
+class RecordFilter(object):
+    """Declarative filter selecting tabix records on their raw fields.
+
+    Filters are compiled into predicates on the raw lines of a tabix file
+    (see TabixIterator.fetch_batches), which are checked before records
+    are parsed any further. Attribute filters are first checked using a
+    cheap substring test on the full line, which rejects most lines without
+    splitting them into fields.
+
+    Parameters
+    ----------
+    feature : str
+        Feature type of the records (GTF files only).
+    strand : str
+        Strand of the records ('+' or '-').
+    min_score : float
+        Minimum score of the records.
+    max_score : float
+        Maximum score of the records.
+    attributes : Dict[str, str]
+        Values that attributes of the records must be equal to (GTF
+        files only).
+
+    """
+
+    def __init__(self,
+                 feature: str=None,
+                 strand: str=None,
+                 min_score: float=None,
+                 max_score: float=None,
+                 attributes: Dict[str, str]=None) -> None:
+        self.feature = feature
+        self.strand = strand
+        self.min_score = min_score
+        self.max_score = max_score
+        self.attributes = dict(attributes or {})
+
+    @staticmethod
+    def _column_index(columns, name):
+        try:
+            return columns.index(name)
+        except ValueError:
+            raise ValueError('Cannot filter on {!r}, column not present '
+                             'in file'.format(name))
+
+    def compile(self, columns: Tuple[str, ...]
+                ) -> Callable[[str, Optional[List[str]]], Optional[List[str]]]:
+        """Compiles the filter into a predicate on raw lines.
+
+        Parameters
+        ----------
+        columns : Tuple[str]
+            Names of the columns in the tabix file.
+
+        Returns
+        -------
+        Callable[[str, List[str]], List[str]]
+            Predicate taking a raw line (and optionally its already split
+            fields), which returns the fields of the line if the line
+            passes the filter and None otherwise.
+
+        """
+
+        equals = []
+        if self.feature is not None:
+            equals.append((self._column_index(columns, 'feature'),
+                           self.feature))
+        if self.strand is not None:
+            equals.append((self._column_index(columns, 'strand'),
+                           self.strand))
+
+        score_idx = None
+        if self.min_score is not None or self.max_score is not None:
+            score_idx = self._column_index(columns, 'score')
+
+        min_score = -np.inf if self.min_score is None else self.min_score
+        max_score = np.inf if self.max_score is None else self.max_score
+
+        attr_idx, needles, regexes = None, [], []
+        if self.attributes:
+            attr_idx = self._column_index(columns, 'attributes')
+
+            for key, value in sorted(self.attributes.items()):
+                needle = '{} "{}"'.format(key, value)
+                needles.append(needle)
+                regexes.append(
+                    re.compile(r'(?:^|;)\s*' + re.escape(needle) + r'(?:;|$)'))
+
+        def _predicate(line, fields=None):
+            for needle in needles:
+                if needle not in line:
+                    return None
+
+            if fields is None:
+                fields = line.split('\t')
+
+            for idx, value in equals:
+                if fields[idx] != value:
+                    return None
+
+            if score_idx is not None:
+                try:
+                    score = float(fields[score_idx])
+                except ValueError:
+                    return None
+
+                if not min_score <= score <= max_score:
+                    return None
+
+            for regex in regexes:
+                if regex.search(fields[attr_idx].strip()) is None:
+                    return None
+
+            return fields
+
+        return _predicate
+
+    def __repr__(self):
+        params = {
+            'feature': self.feature,
+            'strand': self.strand,
+            'min_score': self.min_score,
+            'max_score': self.max_score,
+            'attributes': self.attributes or None
+        }
+        params = ', '.join('{}={!r}'.format(key, value)
+                           for key, value in sorted(params.items())
+                           if value is not None)
+        return 'RecordFilter({})'.format(params)
+
 
 class GtfIterator(TabixIterator):
     """Iterator that iterates over records in a GTF file using pysam."""
 
+    def __init__(self, file_path: Path) -> None:
+        super().__init__(file_path)
+        self._gene_index = None
+
+    _columns = ('contig', 'source', 'feature', 'start', 'end', 'score',
+                'strand', 'frame', 'attributes')
+
+    _dtypes = {'start': np.int64, 'end': np.int64, 'score': np.float64}
+
+    _one_based = True
+
     @property
     def _parser(self):
         """Returns parser to use for parsing tabix records."""
         return pysam.asGTF()
 
-    def fetch_genes(self, gene_ids: List[str]=None, **kwargs) -> Iterable[Any]:
-        """Fetches gene records from the GTF file."""
+    def fetch_batches(self,
+                      reference: str=None,
+                      start: int=None,
+                      end: int=None,
+                      filters: Iterable['RecordFilter']=None,
+                      batch_size: int=100000,
+                      n_threads: int=None,
+                      attributes: List[str]=None) -> Iterable[pd.DataFrame]:
+        """Fetches records from the GTF file as batches of columns.
+
+        See TabixIterator.fetch_batches for details. If attributes are
+        given, the values of these attributes are extracted into separate
+        columns of each batch (using vectorized string operations).
+        """
+
+        batches = super().fetch_batches(
+            reference,
+            start,
+            end,
+            filters=filters,
+            batch_size=batch_size,
+            n_threads=n_threads)
+
+        for batch in batches:
+            for attribute in attributes or []:
+                batch[attribute] = batch['attributes'].str.extract(
+                    r'(?:^|;)\s*{} "([^"]*)"'.format(re.escape(attribute)),
+                    expand=False)
+            yield batch
+
+    @property
+    def gene_index(self) -> 'GeneIndex':
+        """Index for locating genes, loaded (or built) on first access."""
+
+        if self._gene_index is None:
+            self._gene_index = GeneIndex.from_gtf(self._file_path)
+        return self._gene_index
+
+    def fetch_genes(self,
+                    gene_ids: List[str]=None,
+                    filters: Iterable[Callable[[Any], bool]]=None,
+                    **kwargs) -> Iterable[Any]:
+        """Fetches gene records from the GTF file.
+
+        If gene_ids are given, genes are located using the gene index of
+        the GTF file and only the regions of these genes are fetched.
+        Genes that do not pass the given filters are returned as None.
+        Other keyword arguments are passed to **fetch_many** if gene_ids
+        are given and to **fetch** otherwise.
+        """
 
-        # Fetch gene records.
         gene_filter = lambda rec: rec.feature == 'gene'
-        records = self.fetch(filters=[gene_filter], **kwargs)
+        filters = [gene_filter] + list(filters or [])
 
         if gene_ids is not None:
-            # Run through records.
-            sought_ids = set(gene_ids)
+            gene_ids = list(gene_ids)
+            locations = self.gene_index.locate(gene_ids)
+
+            # Fetch the regions of all located genes in a single pass.
+            found = [(gene_id, location[:3])
+                     for gene_id, location in zip(gene_ids, locations)
+                     if location is not None]
 
-            hits = {}
-            for rec in records:
-                if rec['gene_id'] in sought_ids:
-                    # Record hits.
-                    hits[rec['gene_id']] = rec
+            fetched = self.fetch_many(
+                [region for _, region in found], filters=filters, **kwargs)
 
-                    # Stop if we found everything.
-                    if len(hits) == len(gene_ids):
-                        break
+            genes = {}
+            for (gene_id, _), records in zip(found, fetched):
+                genes[gene_id] = next(
+                    (rec for rec in records if rec['gene_id'] == gene_id),
+                    None)
 
             # Yield results, returning None for genes that weren't found.
             for gene_id in gene_ids:
-                yield hits.get(gene_id, None)
-
+                yield genes.get(gene_id)
         else:
-            yield from records
+            yield from self.fetch(filters=filters, **kwargs)
 
 
 class BedIterator(TabixIterator):
     """Iterator that iterates over records in a BED file using pysam."""
 
+    _columns = ('contig', 'start', 'end', 'name', 'score', 'strand',
+                'thickStart', 'thickEnd', 'itemRGB', 'blockCount',
+                'blockSizes', 'blockStarts')
+
+    _dtypes = {'start': np.int64, 'end': np.int64, 'score': np.float64}
+
     @property
     def _parser(self):
         return pysam.asBed()
+
+
+class BedGraphIterator(TabixIterator):
+    """Iterator that iterates over records in a bedGraph file using pysam."""
+
+    _columns = ('contig', 'start', 'end', 'value')
+
+    _dtypes = {'start': np.int64, 'end': np.int64, 'value': np.float64}
+
+    @property
+    def _parser(self):
+        return pysam.asTuple()
+
+    @staticmethod
+    def _record_span(record) -> Tuple[int, int]:
+        return int(record[1]), int(record[2])
+
+    def fetch_intervals(self, reference: str, start: int=None,
+                        end: int=None) -> Tuple[Any, Any, Any]:
+        """Fetches intervals as arrays of starts, ends and values."""
+
+        frame = self.fetch_frame(reference, start, end)
+
+        return (frame['start'].values, frame['end'].values,
+                frame['value'].values)
+
+
+class RegionCache(object):
+    """Interval-aware cache of records fetched from a tabix file.
+
+    Records are fetched as columnar batches (see TabixIterator.fetch_batches)
+    and are cached together with the region they were fetched for. Regions
+    contained in a cached region are served by slicing the cached records,
+    whereas regions partially overlapping a cached region only fetch the
+    missing flanks, after which the cached region is extended. Cached
+    regions are evicted in least-recently-used order once the cached
+    records exceed the given memory budget.
+
+    Parameters
+    ----------
+    iterator : TabixIterator
+        Iterator used to fetch records.
+    max_bytes : int
+        Memory budget (in bytes) of the cached records. The most recently
+        used region is always kept, also if it exceeds the budget.
+    **kwargs
+        Other keywords (such as filters) are passed to fetch_batches.
+
+    """
+
+    def __init__(self,
+                 iterator: TabixIterator,
+                 max_bytes: int=64 * 2**20,
+                 **kwargs) -> None:
+        self._iterator = iterator
+        self._max_bytes = max_bytes
+        self._fetch_kws = kwargs
+
+        self._entries = OrderedDict()
+        self._sizes = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_entries'] = OrderedDict()
+        state['_sizes'] = {}
+        return state
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the cached records (in bytes)."""
+        return sum(self._sizes.values())
+
+    def clear(self) -> None:
+        """Removes all cached regions."""
+        self._entries.clear()
+        self._sizes.clear()
+
+    def fetch(self, reference: str, start: int, end: int) -> pd.DataFrame:
+        """Fetches records overlapping the given region.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Records overlapping the region, ordered by start position.
+
+        """
+
+        key = self._find_overlapping(reference, start, end)
+
+        if key is None:
+            key = (reference, start, end)
+            frame = self._fetch(reference, start, end)
+            self._insert(key, frame)
+        elif start < key[1] or end > key[2]:
+            frame = self._entries.pop(key)
+            del self._sizes[key]
+
+            key, frame = self._extend(key, frame, start, end)
+            self._insert(key, frame)
+        else:
+            # Contained in a cached region, which keeps its size.
+            self._entries.move_to_end(key)
+            frame = self._entries[key]
+
+        mask = (frame['start'] < end) & (frame['end'] > start)
+        return frame.loc[mask]
+
+    def _fetch(self, reference, start, end):
+        return self._iterator.fetch_frame(reference, start, end,
+                                          **self._fetch_kws)
+
+    def _find_overlapping(self, reference, start, end):
+        """Returns the cached region with the largest overlap (if any)."""
+
+        best_key, best_overlap = None, -1
+
+        for key in self._entries:
+            if key[0] == reference and key[1] <= end and key[2] >= start:
+                overlap = min(key[2], end) - max(key[1], start)
+                if overlap > best_overlap:
+                    best_key, best_overlap = key, overlap
+
+        return best_key
+
+    def _extend(self, key, frame, start, end):
+        """Extends a cached region by fetching its missing flanks."""
+
+        reference, cached_start, cached_end = key
+        parts = []
+
+        # Records overlapping both a flank and the cached region
+        # are already cached and are dropped from the flanks.
+        if start < cached_start:
+            left = self._fetch(reference, start, cached_start)
+            parts.append(left.loc[left['end'] <= cached_start])
+
+        parts.append(frame)
+
+        if end > cached_end:
+            right = self._fetch(reference, cached_end, end)
+            parts.append(right.loc[right['start'] >= cached_end])
+
+        frame = pd.concat(parts, ignore_index=True)
+        frame = frame.sort_values('start', kind='mergesort')
+        frame = frame.reset_index(drop=True)
+
+        key = (reference, min(start, cached_start), max(end, cached_end))
+
+        # Drop other cached regions contained in the extended region.
+        for other in list(self._entries):
+            if (other[0] == reference and other[1] >= key[1] and
+                    other[2] <= key[2]):
+                del self._entries[other]
+                del self._sizes[other]
+
+        return key, frame
+
+    def _insert(self, key, frame):
+        self._entries[key] = frame
+        self._sizes[key] = int(frame.memory_usage(deep=True).sum())
+
+        # Evict least recently used regions, keeping the current one.
+        while len(self._entries) > 1 and self.nbytes > self._max_bytes:
+            evicted, _ = self._entries.popitem(last=False)
+            del self._sizes[evicted]
+
+
+def _merge_regions(regions: List[Tuple[str, int, int]], max_gap: int=0
+                   ) -> List[Tuple[str, int, int, List[int]]]:
+    """Merges overlapping (or nearby) regions.
+
+    Returns
+    -------
+    List[Tuple[str, int, int, List[int]]]
+        Merged regions as (reference, start, end, members) tuples, in which
+        members are the indices of the merged regions, sorted by start.
+
+    """
+
+    order = sorted(range(len(regions)), key=lambda i: regions[i])
+
+    merged = []
+    for i in order:
+        reference, start, end = regions[i]
+
+        if (merged and merged[-1][0] == reference and
+                start <= merged[-1][2] + max_gap):
+            prev = merged[-1]
+            prev[3].append(i)
+            merged[-1] = (reference, prev[1], max(prev[2], end), prev[3])
+        else:
+            merged.append((reference, start, end, [i]))
+
+    return merged
+
+
+class GeneIndex(object):
+    """Index for locating genes in a GTF file by their id or name.
+
+    The index maps gene ids/names to the location of the corresponding
+    gene (chromosome, start, end, strand) and is typically stored next to
+    the tabix index of the GTF file, so that it only needs to be built once.
+    Start positions are 0-based, similar to records returned by pysam.
+
+    Parameters
+    ----------
+    genes : pandas.DataFrame
+        DataFrame containing the columns gene_id, gene_name, chromosome,
+        start, end and strand, describing the indexed genes.
+
+    """
+
+    COLUMNS = ('gene_id', 'gene_name', 'chromosome', 'start', 'end',
+               'strand')
+
+    ATTRIBUTE_REGEX = re.compile(r'(gene_id|gene_name) "([^"]*)"')
+
+    def __init__(self, genes: pd.DataFrame) -> None:
+        self._genes = genes[list(self.COLUMNS)]
+        self._lookups = {}
+
+    @staticmethod
+    def default_path(gtf_path: Path) -> Path:
+        """Returns default index path for the given GTF file."""
+        return Path(str(gtf_path) + '.gidx')
+
+    @classmethod
+    def from_gtf(cls, gtf_path: Path, index_path: Path=None,
+                 rebuild: bool=False) -> 'GeneIndex':
+        """Loads the index of a GTF file, building it if needed.
+
+        The index is (re)built if it does not exist, if it is older than
+        the GTF file or if rebuild is True. If the built index cannot be
+        written (for example because the directory of the GTF file is
+        read-only), the index is only kept in memory.
+        """
+
+        index_path = Path(index_path or cls.default_path(gtf_path))
+
+        if (rebuild or not index_path.exists() or
+                os.path.getmtime(str(index_path)) <
+                os.path.getmtime(str(gtf_path))):
+            index = cls.build(gtf_path)
+
+            try:
+                index.write(index_path)
+            except OSError:
+                pass
+        else:
+            index = cls.read(index_path)
+
+        return index
+
+    @classmethod
+    def build(cls, gtf_path: Path) -> 'GeneIndex':
+        """Builds an index from the gene records in a (gzipped) GTF file."""
+
+        gtf_path = str(gtf_path)
+        open_func = gzip.open if gtf_path.endswith('.gz') else open
+
+        rows = []
+        with open_func(gtf_path, 'rt') as file_:
+            for line in file_:
+                if line.startswith('#'):
+                    continue
+
+                fields = line.split('\t', 8)
+                if fields[2] != 'gene':
+                    continue
+
+                attrs = dict(cls.ATTRIBUTE_REGEX.findall(fields[8]))
+                gene_id = attrs.get('gene_id')
+
+                rows.append((gene_id, attrs.get('gene_name', gene_id),
+                             fields[0], int(fields[3]) - 1, int(fields[4]),
+                             fields[6]))
+
+        return cls(pd.DataFrame.from_records(rows, columns=cls.COLUMNS))
+
+    @classmethod
+    def read(cls, index_path: Path) -> 'GeneIndex':
+        """Reads an index from the given path."""
+
+        genes = pd.read_csv(
+            str(index_path),
+            sep='\t',
+            dtype={'gene_id': str,
+                   'gene_name': str,
+                   'chromosome': str})
+
+        return cls(genes)
+
+    def write(self, index_path: Path) -> None:
+        """Writes the index to the given path."""
+        self._genes.to_csv(str(index_path), sep='\t', index=False)
+
+    def _get_lookup(self, field):
+        try:
+            return self._lookups[field]
+        except KeyError:
+            genes = self._genes.drop_duplicates(subset=[field])
+            lookup = genes.set_index(field)[
+                ['chromosome', 'start', 'end', 'strand']]
+            self._lookups[field] = lookup
+            return lookup
+
+    def locate(self, gene_ids: Iterable[str],
+               field: str='gene_id') -> List[Tuple[str, int, int, str]]:
+        """Locates the given genes.
+
+        Parameters
+        ----------
+        gene_ids : List[str]
+            Ids (or names) of the genes to locate.
+        field : str
+            Field to look up genes by, either 'gene_id' or 'gene_name'.
+
+        Returns
+        -------
+        List[Tuple[str, int, int, str]]
+            Location of each gene as a (chromosome, start, end, strand)
+            tuple, or None for genes that are not in the index.
+
+        """
+
+        located = self._get_lookup(field).reindex(list(gene_ids))
+
+        return [
+            None if pd.isnull(chrom) else (chrom, int(start), int(end), strand)
+            for chrom, start, end, strand in located.itertuples(index=False)
+        ]
@@ -24,3 +24,44 @@ def data_path(relative_path, relative_to=None):
         relative_to = relative_to.parent
 
     return relative_to / 'data' / relative_path
+
+
+@pytest.fixture
+def bam_path(tmpdir):
+    """Builds a small indexed BAM file with (spliced) test reads."""
+
+    import random
+    import pysam
+
+    random.seed(0)
+
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'LN': 10000, 'SN': '1'}]}
+
+    cigars = ['50M', '20M5D30M', '20M200N30M', '10S40M', '25M2I23M']
+    flags = [0, 16, 0, 16, 1024]
+
+    reads = []
+    for i in range(500):
+        read = pysam.AlignedSegment()
+        read.query_name = 'read{}'.format(i)
+        read.cigarstring = random.choice(cigars)
+        read.query_sequence = 'A' * read.infer_query_length()
+        read.query_qualities = pysam.qualitystring_to_array(
+            'I' * read.infer_query_length())
+        read.flag = random.choice(flags)
+        read.reference_id = 0
+        read.reference_start = random.randint(1000, 2000)
+        read.mapping_quality = random.choice([0, 10, 60])
+        reads.append(read)
+
+    reads.sort(key=lambda r: r.reference_start)
+
+    file_path = str(tmpdir / 'test.bam')
+    with pysam.AlignmentFile(file_path, 'wb', header=header) as file_:
+        for read in reads:
+            file_.write(read)
+
+    pysam.index(file_path)
+
+    return file_path
@@ -0,0 +1,45 @@
+# pylint: disable=W0622,W0614,W0401
+from __future__ import absolute_import, division, print_function
+from builtins import *
+# pylint: enable=W0622,W0614,W0401
+
+import matplotlib
+matplotlib.use('agg')
+
+import pandas as pd
+import pytest
+
+from geneviz.tracks import base
+from geneviz.util.tabix import GeneIndex
+
+# pylint: disable=redefined-outer-name, no-self-use,too-few-public-methods
+
+
+@pytest.fixture
+def gene_index():
+    genes = pd.DataFrame.from_records(
+        [('ENSG1', 'GeneA', '1', 1000, 2000, '+'),
+         ('ENSG2', 'GeneB', '2', 500, 800, '-')],
+        columns=GeneIndex.COLUMNS)
+    return GeneIndex(genes)
+
+
+class TestPlotGenes(object):
+    def test_regions(self, gene_index):
+        """Tests if genes are plotted over their (flanked) regions."""
+
+        figures = dict(
+            base.plot_genes(
+                [base.DummyTrack()], ['GeneB', 'GeneA'],
+                index=gene_index,
+                flank=(100, 200),
+                field='gene_name'))
+
+        assert figures['GeneA'].axes[0].get_xlim() == (900, 2200)
+        assert figures['GeneB'].axes[0].get_xlim() == (400, 1000)
+
+    def test_missing(self, gene_index):
+        """Tests if missing genes raise a ValueError."""
+
+        with pytest.raises(ValueError):
+            list(base.plot_genes([base.DummyTrack()], ['ENSG3'], gene_index))
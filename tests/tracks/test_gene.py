@@ -0,0 +1,217 @@
+# pylint: disable=W0622,W0614,W0401
+from __future__ import absolute_import, division, print_function
+from builtins import *
+# pylint: enable=W0622,W0614,W0401
+
+import pickle
+
+import matplotlib
+matplotlib.use('agg')
+
+import pandas as pd
+import pytest
+
+from geneviz.tracks import gene, plot_tracks
+from geneviz.util.annotation import AnnotationDatabase
+
+# pylint: disable=redefined-outer-name, no-self-use,too-few-public-methods
+
+
+class TestBiomartTrack(object):
+    def test_lazy_dataset(self, mocker):
+        """Tests that the Biomart dataset is only resolved when needed."""
+
+        server_mock = mocker.patch.object(gene.pybiomart, 'Server')
+        gene._get_biomart_dataset.cache_clear()
+
+        track = gene.BiomartTrack(dataset='mmusculus_gene_ensembl')
+        assert not server_mock.called
+
+        # Dataset should be resolved once and memoized.
+        dataset = track._dataset
+        assert dataset is track._dataset
+        server_mock.assert_called_once_with(host='http://www.ensembl.org')
+
+    def test_pickle(self, mocker):
+        """Tests that tracks can be pickled without a connection."""
+
+        server_mock = mocker.patch.object(gene.pybiomart, 'Server')
+
+        track = gene.BiomartTrack(dataset='mmusculus_gene_ensembl')
+        unpickled = pickle.loads(pickle.dumps(track))
+
+        assert unpickled._dataset_name == 'mmusculus_gene_ensembl'
+        assert not server_mock.called
+
+
+class TestGeneTrack(object):
+    def test_fetch_database(self, tmpdir):
+        """Tests fetching exons from a compiled annotation database."""
+
+        gtf_path = pytest.helpers.data_path('mm10.test.gtf.gz')
+        database = AnnotationDatabase.build(gtf_path, str(tmpdir / 'db'))
+
+        track = gene.GeneTrack(database, collapse='gene')
+        exons = track._fetch_exons(('1', 182409431, 182461830))
+
+        assert list(exons['gene_id']) == ['ENSMUSG00000026510']
+        assert exons['start'].iloc[0] == 182409171
+        assert exons['end'].iloc[0] == 182462432
+
+    def test_fetch_frame(self):
+        """Tests fetching exons from a DataFrame."""
+
+        data = pd.DataFrame({
+            'chromosome': ['1', '1', '2'],
+            'start': [10, 50, 10],
+            'end': [20, 60, 20],
+            'strand': [1, 1, -1],
+            'gene_id': ['a', 'b', 'c'],
+            'transcript_id': ['a1', 'b1', 'c1']
+        })
+
+        track = gene.GeneTrack(data)
+        exons = track._fetch_exons(('1', 15, 40))
+
+        assert list(exons['gene_id']) == ['a']
+
+    @pytest.mark.parametrize('collapse', [None, 'gene', 'transcript'])
+    def test_fetch_cached(self, tmpdir, collapse):
+        """Tests that cached exons match exons processed per region."""
+
+        gtf_path = pytest.helpers.data_path('mm10.test.gtf.gz')
+        database = AnnotationDatabase.build(gtf_path, str(tmpdir / 'db'))
+
+        region = ('1', 182409431, 182461830)
+        expected = gene.GeneTrack(
+            database, collapse=collapse)._fetch_exons(region)
+
+        track = gene.GeneTrack(database, collapse=collapse, cache_size=1)
+        result = track._fetch_exons(region)
+
+        sort_cols = ['start', 'end']
+        assert len(result) > 0
+        assert (result.sort_values(sort_cols).reset_index(drop=True)
+                .equals(expected.sort_values(sort_cols)
+                        .reset_index(drop=True)))
+
+        # Check that only the last chromosome is retained.
+        track._fetch_exons(('11', 0, 1000))
+        assert list(track._cache) == ['11']
+
+    @pytest.mark.parametrize('collapse', [None, 'gene', 'transcript'])
+    def test_fetch_cached_intron(self, tmpdir, collapse):
+        """Tests that cached transcripts match within an intron."""
+
+        gtf_path = pytest.helpers.data_path('mm10.test.gtf.gz')
+        database = AnnotationDatabase.build(gtf_path, str(tmpdir / 'db'))
+
+        region = ('1', 182420000, 182425000)
+        expected = gene.GeneTrack(
+            database, collapse=collapse)._fetch_exons(region)
+
+        track = gene.GeneTrack(database, collapse=collapse, cache_size=1)
+        result = track._fetch_exons(region)
+
+        sort_cols = ['start', 'end']
+        assert len(result) > 0
+        assert (result.sort_values(sort_cols).reset_index(drop=True)
+                .equals(expected.sort_values(sort_cols)
+                        .reset_index(drop=True)))
+
+    def test_fetch_cached_region(self, mocker):
+        """Tests that exons of the last region are only processed once."""
+
+        data = pd.DataFrame({
+            'chromosome': ['1', '1'],
+            'start': [10, 50],
+            'end': [20, 60],
+            'strand': [1, 1],
+            'gene_id': ['a', 'a'],
+            'transcript_id': ['a1', 'a1']
+        })
+
+        track = gene.GeneTrack(data, collapse='gene', cache_size=1)
+        process = mocker.spy(track, '_process_exons')
+
+        exons = track._fetch_exons(('1', 0, 100))
+        assert track._fetch_exons(('1', 0, 100)) is exons
+        assert process.call_count == 1
+
+        track._fetch_exons(('1', 0, 30))
+        assert process.call_count == 2
+
+    @pytest.mark.parametrize('collapse', [None, 'gene', 'transcript'])
+    def test_fetch_cached_partial(self, collapse):
+        """Tests that cached exons match for partially overlapping genes."""
+
+        data = pd.DataFrame({
+            'chromosome': ['1', '1', '1', '1'],
+            'start': [10, 50, 100, 30],
+            'end': [20, 60, 110, 70],
+            'strand': [1, 1, 1, -1],
+            'gene_id': ['a', 'a', 'a', 'b'],
+            'transcript_id': ['a1', 'a1', 'a1', 'b1']
+        })
+
+        region = ('1', 15, 55)
+        expected = gene.GeneTrack(
+            data, collapse=collapse)._fetch_exons(region)
+
+        track = gene.GeneTrack(data, collapse=collapse, cache_size=1)
+        result = track._fetch_exons(region)
+
+        sort_cols = ['start', 'end']
+        assert result['end'].max() == 70
+        assert (result.sort_values(sort_cols).reset_index(drop=True)
+                .equals(expected.sort_values(sort_cols)
+                        .reset_index(drop=True)))
+
+
+class TestGtfTrack(object):
+    def test_fetch_data(self):
+        """Tests fetching of exons from a GTF file."""
+
+        gtf_path = pytest.helpers.data_path('mm10.test.gtf.gz')
+        region = ('1', 182409171, 182462432)
+
+        track = gene.GtfTrack(gtf_path)
+        exons = track._fetch_data(region)
+
+        assert len(exons) > 0
+        assert set(exons['strand']) == {1}
+        assert set(exons['gene_id']) == {'ENSMUSG00000026510'}
+        assert exons['start'].min() >= 182409171 - 1
+
+    def test_fetch_data_zoom(self, mocker):
+        """Tests that zooming in does not fetch records from disk."""
+
+        gtf_path = pytest.helpers.data_path('mm10.test.gtf.gz')
+
+        track = gene.GtfTrack(gtf_path)
+        track._fetch_data(('1', 182409171, 182462432))
+
+        fetch = mocker.spy(track._region_cache._iterator, 'fetch_frame')
+        exons = track._fetch_data(('1', 182420000, 182430000))
+
+        assert not fetch.called
+        assert len(exons) > 0
+
+    @pytest.mark.parametrize('cache_size', [None, 2])
+    def test_draw_empty(self, cache_size):
+        """Tests drawing of a region without exons."""
+
+        gtf_path = pytest.helpers.data_path('mm10.test.gtf.gz')
+        region = ('1', 0, 1000)
+
+        track = gene.GtfTrack(gtf_path, cache_size=cache_size)
+
+        exons = track._fetch_data(region)
+        assert len(exons) == 0
+        assert {'start', 'end', 'gene_id', 'transcript_id'} <= set(
+            exons.columns)
+
+        figure = plot_tracks([track], region=region)
+        assert all(
+            len(collection.get_paths()) == 0
+            for collection in figure.axes[0].collections)
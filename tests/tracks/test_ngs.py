@@ -0,0 +1,461 @@
+# pylint: disable=W0622,W0614,W0401
+from __future__ import absolute_import, division, print_function
+from builtins import *
+# pylint: enable=W0622,W0614,W0401
+
+from collections import OrderedDict
+
+import matplotlib
+matplotlib.use('agg')
+
+import numpy as np
+import pandas as pd
+import pysam
+import pytest
+
+from geneviz.tracks import ngs, plot_tracks
+
+# pylint: disable=redefined-outer-name, no-self-use,too-few-public-methods
+
+
+class TestCoverageTrack(object):
+    @pytest.mark.parametrize('stepper', ['all', 'nofilter'])
+    def test_coverage(self, bam_path, stepper):
+        """Tests block-based coverage against a pysam pileup."""
+
+        region = ('1', 1100, 2100)
+
+        track = ngs.CoverageTrack(bam_path, stepper=stepper)
+        coverage = track._get_coverage(region)
+
+        expected = np.zeros(region[2] - region[1])
+        with pysam.AlignmentFile(bam_path) as file_:
+            for column in file_.pileup(
+                    *region, stepper=stepper, truncate=True,
+                    min_base_quality=0, ignore_overlaps=False):
+                expected[column.pos - region[1]] = sum(
+                    not read.is_del for read in column.pileups)
+
+        assert coverage.sum() > 0
+        assert np.all(coverage == expected)
+
+    @pytest.mark.parametrize('bins,chunk_size', [(10, 1000), (7, 33),
+                                                 (100, 7)])
+    def test_binned_coverage(self, bam_path, bins, chunk_size):
+        """Tests chunked binned coverage against per-base coverage."""
+
+        region = ('1', 1100, 2100)
+
+        track = ngs.CoverageTrack(bam_path, chunk_size=chunk_size)
+        coverage = track._get_coverage(region)
+
+        edges, aggregates = track._get_binned_coverage(region, bins)
+        assert len(edges) == bins + 1
+
+        for i, (bin_start, bin_end) in enumerate(zip(edges[:-1], edges[1:])):
+            values = coverage[bin_start - region[1]:bin_end - region[1]]
+            assert aggregates['max'][i] == values.max()
+            assert aggregates['min'][i] == values.min()
+            assert np.isclose(aggregates['mean'][i], values.mean())
+
+    def test_draw_binned(self, bam_path):
+        """Tests drawing of binned coverage."""
+
+        track = ngs.CoverageTrack(bam_path, bins='auto', agg='max')
+        figure = plot_tracks([track], region=('1', 1100, 2100))
+
+        line, = figure.axes[0].get_lines()
+        assert len(line.get_xdata()) <= 1000
+
+    def test_cached_coverage(self, bam_path, tmpdir):
+        """Tests coverage read from a coverage pyramid."""
+
+        region = ('1', 1100, 2100)
+        cache_dir = str(tmpdir / 'cache')
+
+        expected = ngs.CoverageTrack(bam_path)._get_coverage(region)
+
+        track = ngs.CoverageTrack(bam_path, cache_dir=cache_dir)
+        assert np.all(track._get_coverage(region) == expected)
+
+        # Binned coverage should use zoom level with 64 bp bins.
+        edges, aggregates = track._get_binned_coverage(region, 10)
+        assert np.all(edges % 64 == 0)
+
+        for i, (bin_start, bin_end) in enumerate(zip(edges[:-1], edges[1:])):
+            values = ngs.CoverageTrack(bam_path)._get_coverage(
+                ('1', bin_start, bin_end))
+            assert aggregates['max'][i] == values.max()
+            assert np.isclose(aggregates['mean'][i], values.mean())
+
+        # Pyramid should be reused by other tracks.
+        other = ngs.CoverageTrack(bam_path, cache_dir=cache_dir)
+        assert (other._get_pyramid()._dir_path ==
+                track._get_pyramid()._dir_path)
+        assert len(tmpdir.join('cache').listdir()) == 1
+
+    def test_cached_coverage_end(self, bam_path, tmpdir):
+        """Tests binned coverage of regions beyond the chromosome end."""
+
+        track = ngs.CoverageTrack(bam_path, cache_dir=str(tmpdir / 'cache'))
+        length = track._get_pyramid()._lengths['1']
+
+        edges, aggregates = track._get_binned_coverage(
+            ('1', length + 100, length + 1000), 10)
+
+        assert list(edges) == [length]
+        assert all(len(values) == 0 for values in aggregates.values())
+
+        edges, _ = track._get_binned_coverage(('1', length - 100,
+                                               length + 1000), 10)
+        assert edges[0] == length - 100
+        assert edges[-1] == length
+
+    def test_cached_coverage_shared(self, bam_path, tmpdir):
+        """Tests that pyramids built by multiple tracks don't conflict."""
+
+        cache_dir = str(tmpdir / 'cache')
+        region = ('1', 1100, 2100)
+
+        tracks = [ngs.CoverageTrack(bam_path, cache_dir=cache_dir)
+                  for _ in range(2)]
+
+        for track in tracks:
+            track._get_pyramid().build('1')
+
+        expected = ngs.CoverageTrack(bam_path)._get_coverage(region)
+        assert all(np.all(track._get_coverage(region) == expected)
+                   for track in tracks)
+
+        pyramid_dir, = tmpdir.join('cache').listdir()
+        assert not any('.tmp' in path.basename
+                       for path in pyramid_dir.listdir())
+
+    def test_draw_parallel(self, bam_path):
+        """Tests drawing multiple tracks with coverage computed in parallel."""
+
+        region = ('1', 1100, 2100)
+        tracks = [ngs.CoverageTrack(bam_path, bins=50, agg=agg)
+                  for agg in ['mean', 'max', 'min']]
+
+        expected = plot_tracks(tracks, region=region)
+        figure = plot_tracks(tracks, region=region, n_jobs=2)
+
+        for ax, expected_ax in zip(figure.axes, expected.axes):
+            line, = ax.get_lines()
+            expected_line, = expected_ax.get_lines()
+            assert np.all(line.get_ydata() == expected_line.get_ydata())
+
+        assert all(track._prefetched is None for track in tracks)
+
+    def test_read_filter(self, bam_path):
+        """Tests coverage of reads selected by a read filter."""
+
+        region = ('1', 1100, 2100)
+        read_filter = ngs.ReadFilter(min_mapq=30, strand='-')
+
+        track = ngs.CoverageTrack(bam_path, read_filter=read_filter)
+        coverage = track._get_coverage(region)
+
+        with pysam.AlignmentFile(bam_path) as file_:
+            reads = [read for read in file_.fetch(*region)
+                     if read.mapping_quality >= 30 and read.is_reverse
+                     and not read.is_duplicate]
+            expected = ngs.block_coverage(reads, region[1], region[2])
+
+        assert coverage.sum() > 0
+        assert np.all(coverage == expected)
+
+    def test_coverage_mates(self, tmpdir):
+        """Tests that overlapping mates are counted once, as in pileups."""
+
+        header = {'SQ': [{'LN': 1000, 'SN': '1'}]}
+        file_path = str(tmpdir / 'mates.bam')
+
+        # Pairs with overlapping (pair1, pair2) and non-overlapping
+        # mates (pair3). Note that pileups don't handle indels within overlaps.
+        reads = [('pair1', 99, 100, '20M50N30M', 175),
+                 ('pair2', 163, 110, '40M', 130),
+                 ('pair2', 83, 130, '40M', 110),
+                 ('pair1', 147, 175, '30M5D10M', 100),
+                 ('pair3', 99, 300, '20M', 400),
+                 ('pair3', 147, 400, '20M', 300)]
+
+        with pysam.AlignmentFile(file_path, 'wb', header=header) as file_:
+            for name, flag, start, cigar, mate_start in reads:
+                read = pysam.AlignedSegment()
+                read.query_name = name
+                read.flag = flag
+                read.cigarstring = cigar
+                read.query_sequence = 'A' * read.infer_query_length()
+                read.query_qualities = pysam.qualitystring_to_array(
+                    'I' * read.infer_query_length())
+                read.reference_id = 0
+                read.reference_start = start
+                read.next_reference_id = 0
+                read.next_reference_start = mate_start
+                read.mapping_quality = 60
+                file_.write(read)
+
+        pysam.index(file_path)
+
+        region = ('1', 0, 500)
+
+        expected = np.zeros(region[2] - region[1])
+        with pysam.AlignmentFile(file_path) as file_:
+            for column in file_.pileup(
+                    *region, stepper='nofilter', truncate=True,
+                    min_base_quality=1, ignore_overlaps=True):
+                expected[column.pos - region[1]] = sum(
+                    not read.is_del for read in column.pileups)
+
+        track = ngs.CoverageTrack(file_path)
+        coverage = track._get_coverage(region)
+
+        assert coverage.max() == 2
+        assert np.all(coverage == expected)
+
+        track = ngs.MultiCoverageTrack(
+            file_path, signals=OrderedDict([
+                ('+', ngs.ReadFilter(strand='+')), ('total', None)]))
+        coverage = track._get_coverage(region)
+
+        assert np.all(coverage[1] == expected)
+        assert coverage[0].sum() == 20 + 30 + 40 + 20
+
+
+class TestMultiCoverageTrack(object):
+    def test_coverage(self, bam_path):
+        """Tests that signals match coverage of separate tracks."""
+
+        region = ('1', 1100, 2100)
+        signals = OrderedDict([('+', ngs.ReadFilter(strand='+')),
+                               ('-', ngs.ReadFilter(strand='-')),
+                               ('mapq', ngs.ReadFilter(min_mapq=30)),
+                               ('total', None)])
+
+        track = ngs.MultiCoverageTrack(bam_path, signals=signals)
+        coverage = track._get_coverage(region)
+
+        assert coverage.shape == (4, region[2] - region[1])
+
+        for values, (_, read_filter) in zip(coverage, signals.items()):
+            expected = ngs.CoverageTrack(
+                bam_path, read_filter=read_filter)._get_coverage(region)
+            assert np.all(values == expected)
+
+        assert np.all(coverage[0] + coverage[1] == coverage[3])
+
+    def test_draw_binned(self, bam_path):
+        """Tests drawing of binned stranded coverage."""
+
+        track = ngs.MultiCoverageTrack.stranded(bam_path, bins=20, agg='max')
+        figure = plot_tracks([track], region=('1', 1100, 2100))
+
+        lines = figure.axes[0].get_lines()
+        assert [line.get_label() for line in lines] == ['+', '-']
+        assert all(len(line.get_xdata()) == 20 for line in lines)
+
+
+class TestSpliceTrack(object):
+    def test_from_bam(self, bam_path):
+        """Tests extraction of junctions against pysam.find_introns."""
+
+        region = ('1', 1100, 2100)
+
+        track = ngs.SpliceTrack.from_bam(bam_path)
+        junctions = track._fetch_data(region)
+
+        with pysam.AlignmentFile(bam_path) as file_:
+            reads = (read for read in file_.fetch(*region)
+                     if not read.is_duplicate)
+            expected = file_.find_introns(reads)
+
+        assert len(junctions) > 0
+        assert (dict(zip(zip(junctions['start'], junctions['end']),
+                         junctions['score'])) == dict(expected))
+
+    def test_from_bam_filters(self, bam_path):
+        """Tests min_count and min_anchor filters."""
+
+        region = ('1', 1100, 2100)
+
+        junctions = ngs.SpliceTrack.from_bam(bam_path)._fetch_data(region)
+
+        filtered = ngs.SpliceTrack.from_bam(
+            bam_path, min_count=2)._fetch_data(region)
+        assert len(filtered) > 0
+        assert filtered['score'].min() >= 2
+        assert len(filtered) < len(junctions)
+
+        # Test reads have 20 aligned bases before each junction.
+        anchored = ngs.SpliceTrack.from_bam(
+            bam_path, min_anchor=21)._fetch_data(region)
+        assert len(anchored) == 0
+
+    def test_from_bam_cache(self, bam_path, mocker):
+        """Tests reuse of cached junctions for contained regions."""
+
+        track = ngs.SpliceTrack.from_bam(bam_path)
+        junctions = track._fetch_data(('1', 1000, 2500))
+
+        extract = mocker.spy(track._data, '_extract')
+        subset = track._fetch_data(('1', 1500, 1800))
+
+        assert not extract.called
+        assert len(subset) > 0
+        assert len(subset) < len(junctions)
+
+    def test_draw(self, bam_path):
+        """Tests drawing of junctions extracted from a BAM file."""
+
+        track = ngs.SpliceTrack.from_bam(bam_path)
+        figure = plot_tracks([track], region=('1', 1100, 2100))
+
+        assert len(figure.axes[0].collections) == 1
+
+    def test_draw_culled(self):
+        """Tests culling of weak and narrow junctions."""
+
+        data = pd.DataFrame({
+            'chromosome': ['1', '1', '1'],
+            'start': [100, 200, 300],
+            'end': [900, 210, 800],
+            'score': [10, 10, 1]
+        })
+
+        track = ngs.SpliceTrack(data, min_score=2, min_width=5)
+        figure = plot_tracks([track], region=('1', 0, 1000))
+
+        collection, = figure.axes[0].collections
+        path, = collection.get_paths()
+
+        assert list(path.vertices[:, 0]) == [100, 100, 900, 900]
+        assert list(path.vertices[:, 1]) == [0, 10 / 0.75, 10 / 0.75, 0]
+        assert figure.axes[0].get_ylim() == (0, 10)
+
+
+class TestAlignmentTrack(object):
+    def test_downsample(self, bam_path):
+        """Tests that reads are downsampled per window."""
+
+        track = ngs.AlignmentTrack(bam_path, max_depth=2, window_size=100)
+        reads = track._fetch_reads(('1', 1000, 2100))
+
+        windows = [read.reference_start // 100 for read in reads]
+        assert len(reads) > 0
+        assert max(windows.count(window) for window in set(windows)) == 2
+        assert not any(read.is_duplicate for read in reads)
+
+        # Downsampling should be reproducible.
+        assert ([read.query_name for read in reads] == [
+            read.query_name for read in track._fetch_reads(('1', 1000, 2100))
+        ])
+
+    def test_pack_rows(self):
+        """Tests that packed intervals don't overlap."""
+
+        starts = np.array([0, 5, 10, 12, 30, 31])
+        ends = np.array([10, 15, 20, 25, 40, 35])
+
+        rows = ngs.pack_rows(starts, ends, spacing=1)
+
+        assert list(rows) == [0, 1, 2, 0, 0, 1]
+
+    def test_draw(self, tmpdir):
+        """Tests drawing of reads with mismatches."""
+
+        header = {'SQ': [{'LN': 1000, 'SN': '1'}]}
+        file_path = str(tmpdir / 'mismatch.bam')
+
+        with pysam.AlignmentFile(file_path, 'wb', header=header) as file_:
+            read = pysam.AlignedSegment()
+            read.query_name = 'read'
+            read.cigarstring = '5M10N5M'
+            read.query_sequence = 'AAAAAACAAA'
+            read.reference_id = 0
+            read.reference_start = 100
+            read.set_tag('MD', '6A3')
+            file_.write(read)
+
+        pysam.index(file_path)
+
+        track = ngs.AlignmentTrack(file_path)
+        figure = plot_tracks([track], region=('1', 0, 300))
+
+        blocks, gaps, mismatches = figure.axes[0].collections
+
+        assert len(blocks.get_paths()) == 2
+        assert len(gaps.get_segments()) == 1
+        assert mismatches.get_paths()[0].vertices[0, 0] == 116
+
+    def test_draw_unmapped(self, tmpdir):
+        """Tests that unmapped reads are skipped, whatever the filter."""
+
+        header = {'SQ': [{'LN': 1000, 'SN': '1'}]}
+        file_path = str(tmpdir / 'unmapped.bam')
+
+        with pysam.AlignmentFile(file_path, 'wb', header=header) as file_:
+            for name, flag, cigar in [('mapped', 0, '10M'),
+                                      ('unmapped', 4, None)]:
+                read = pysam.AlignedSegment()
+                read.query_name = name
+                read.flag = flag
+                read.cigarstring = cigar
+                read.query_sequence = 'A' * 10
+                read.reference_id = 0
+                read.reference_start = 100
+                file_.write(read)
+
+        pysam.index(file_path)
+
+        track = ngs.AlignmentTrack(
+            file_path, read_filter=ngs.ReadFilter(), mismatches=False)
+
+        reads = track._fetch_reads(('1', 0, 300))
+        assert [read.query_name for read in reads] == ['mapped']
+
+        figure = plot_tracks([track], region=('1', 0, 300))
+        assert len(figure.axes[0].collections[0].get_paths()) == 1
+
+
+class TestSashimiTrack(object):
+    def test_fetch_data(self, bam_path):
+        """Tests coverage and junctions against the separate tracks."""
+
+        region = ('1', 1100, 2100)
+
+        track = ngs.SashimiTrack(bam_path)
+        coverage, junctions = track._fetch_data(region)
+
+        expected_coverage = ngs.CoverageTrack(bam_path)._get_coverage(region)
+        expected_junctions = ngs.SpliceTrack.from_bam(bam_path)._fetch_data(
+            region)
+
+        assert np.all(coverage == expected_coverage)
+        assert len(junctions) > 0
+        assert (junctions.reset_index(drop=True)
+                .equals(expected_junctions.reset_index(drop=True)))
+
+    def test_fetch_data_cache(self, bam_path, mocker):
+        """Tests that each region is only read once."""
+
+        track = ngs.SashimiTrack(bam_path)
+        compute = mocker.spy(track, '_compute_data')
+
+        track._fetch_data(('1', 1100, 2100))
+        track._fetch_data(('1', 1100, 2100))
+
+        assert compute.call_count == 1
+
+    def test_draw(self, bam_path):
+        """Tests drawing of coverage and arcs on a single axis."""
+
+        track = ngs.SashimiTrack(bam_path, min_count=5)
+        figure = plot_tracks([track], region=('1', 1100, 2100))
+
+        ax = figure.axes[0]
+        _, junctions = track._fetch_data(('1', 1100, 2100))
+
+        assert len(ax.collections) == 2
+        assert len(ax.texts) == len(junctions)
@@ -0,0 +1,105 @@
+# pylint: disable=W0622,W0614,W0401
+from __future__ import absolute_import, division, print_function
+from builtins import *
+# pylint: enable=W0622,W0614,W0401
+
+import matplotlib
+matplotlib.use('agg')
+
+import pysam
+import pytest
+
+from geneviz.tracks import plot_tracks, signal
+
+# pylint: disable=redefined-outer-name, no-self-use,too-few-public-methods
+
+INTERVALS = [('1', 100, 200, 1.5), ('1', 200, 250, 3.0), ('1', 400, 500, 2.0),
+             ('2', 100, 200, 4.0)]
+
+
+@pytest.fixture
+def bedgraph_path(tmpdir):
+    file_path = str(tmpdir / 'test.bedgraph')
+
+    with open(file_path, 'w') as file_:
+        for interval in INTERVALS:
+            file_.write('\t'.join(map(str, interval)) + '\n')
+
+    return pysam.tabix_index(file_path, preset='bed')
+
+
+@pytest.fixture
+def bigwig_path(tmpdir):
+    pybigwig = pytest.importorskip('pyBigWig')
+
+    file_path = str(tmpdir / 'test.bw')
+
+    file_ = pybigwig.open(file_path, 'w')
+    file_.addHeader([('1', 10000), ('2', 10000)])
+
+    for chrom in ['1', '2']:
+        subset = [iv for iv in INTERVALS if iv[0] == chrom]
+        file_.addEntries(
+            [iv[0] for iv in subset],
+            [iv[1] for iv in subset],
+            ends=[iv[2] for iv in subset],
+            values=[iv[3] for iv in subset])
+
+    file_.close()
+
+    return file_path
+
+
+class TestSignalTrack(object):
+    def test_fetch_bedgraph(self, bedgraph_path):
+        """Tests fetching of intervals from a bedGraph file."""
+
+        track = signal.SignalTrack(bedgraph_path)
+        starts, ends, values = track._fetch_intervals(('1', 150, 450))
+
+        assert list(starts) == [100, 200, 400]
+        assert list(ends) == [200, 250, 500]
+        assert list(values) == [1.5, 3.0, 2.0]
+
+    def test_fetch_bigwig(self, bigwig_path):
+        """Tests fetching of intervals from a bigWig file."""
+
+        track = signal.SignalTrack(bigwig_path)
+        starts, ends, values = track._fetch_intervals(('1', 150, 450))
+
+        assert list(starts) == [100, 200, 400]
+        assert list(ends) == [200, 250, 500]
+        assert list(values) == [1.5, 3.0, 2.0]
+
+    def test_fetch_bigwig_summarized(self, bigwig_path):
+        """Tests summarizing of wide regions for bigWig files."""
+
+        track = signal.SignalTrack(bigwig_path, agg='max')
+        starts, ends, values = track._fetch_intervals(('1', 0, 1000), bins=2)
+
+        # Second bin has no data and should be dropped.
+        assert list(starts) == [0]
+        assert list(ends) == [500]
+        assert list(values) == [3.0]
+
+    def test_draw(self, bedgraph_path):
+        """Tests drawing of intervals as steps."""
+
+        track = signal.SignalTrack(bedgraph_path)
+        figure = plot_tracks([track], region=('1', 0, 1000))
+
+        line, = figure.axes[0].get_lines()
+        assert len(line.get_xdata()) == 10
+        assert line.get_ydata().max() == 3.0
+
+    def test_step_coordinates(self):
+        """Tests that adjacent intervals don't return to zero."""
+
+        x, y = signal.step_coordinates([100, 200, 400], [200, 250, 500],
+                                       [1.5, 3.0, 2.0])
+
+        assert list(x) == [100, 100, 200, 200, 250, 250, 400, 400, 500, 500]
+        assert list(y) == [0, 1.5, 1.5, 3.0, 3.0, 0, 0, 2.0, 2.0, 0]
+
+        x, y = signal.step_coordinates([], [], [])
+        assert len(x) == 0 and len(y) == 0
@@ -0,0 +1,57 @@
+# pylint: disable=W0622,W0614,W0401
+from __future__ import absolute_import, division, print_function
+from builtins import *
+# pylint: enable=W0622,W0614,W0401
+
+import pickle
+
+import pytest
+
+from geneviz.util.annotation import AnnotationDatabase
+
+# pylint: disable=redefined-outer-name, no-self-use,too-few-public-methods
+
+
+@pytest.fixture
+def gtf_path():
+    return pytest.helpers.data_path('mm10.test.gtf.gz')
+
+
+@pytest.fixture
+def database(gtf_path, tmpdir):
+    return AnnotationDatabase.build(gtf_path, str(tmpdir / 'db'))
+
+
+class TestAnnotationDatabase(object):
+    def test_contigs(self, database):
+        assert database.contigs == ['1', '11']
+
+    def test_fetch_frame(self, database):
+        """Tests fetching of exons within a region."""
+
+        exons = database.fetch_frame('1', 182409431, 182461830)
+
+        assert len(exons) > 0
+        assert set(exons['chromosome']) == {'1'}
+        assert set(exons['gene_name']) == {'Trp53bp2'}
+        assert set(exons['strand']) == {1}
+
+        # Transcripts are returned in full.
+        assert exons['start'].min() == 182409171
+        assert exons['end'].max() == 182462432
+
+    def test_fetch_frame_empty(self, database):
+        assert len(database.fetch_frame('1', 0, 1000)) == 0
+        assert len(database.fetch_frame('X', 0, 1000)) == 0
+
+    def test_reopen(self, database, tmpdir):
+        """Tests reopening and pickling of a database."""
+
+        reopened = pickle.loads(
+            pickle.dumps(AnnotationDatabase(str(tmpdir / 'db'))))
+
+        expected = database.fetch_frame('11', 0, 200000000)
+        result = reopened.fetch_frame('11', 0, 200000000)
+
+        assert len(result) > 0
+        assert result.equals(expected)
@@ -0,0 +1,116 @@
+# pylint: disable=W0622,W0614,W0401
+from __future__ import absolute_import, division, print_function
+from builtins import *
+# pylint: enable=W0622,W0614,W0401
+
+import random
+
+import pysam
+import pytest
+
+from geneviz.util import bgzf, tabix
+
+# pylint: disable=redefined-outer-name, no-self-use,too-few-public-methods
+
+
+@pytest.fixture
+def gtf_path():
+    return pytest.helpers.data_path('mm10.test.gtf.gz')
+
+
+@pytest.fixture
+def bed_path(tmpdir):
+    """Builds a BED file spanning many BGZF blocks."""
+
+    random.seed(0)
+
+    records = []
+    for contig in ['1', '2']:
+        for _ in range(20000):
+            start = random.randint(0, 5000000)
+            end = start + random.randint(1, 50000)
+            records.append((contig, start, end))
+
+    records.sort()
+
+    file_path = str(tmpdir / 'test.bed')
+    with open(file_path, 'w') as file_:
+        file_.write('#header\n')
+        for i, (contig, start, end) in enumerate(records):
+            file_.write('{}\t{}\t{}\tfeature_{}\n'.format(
+                contig, start, end, i))
+
+    return pysam.tabix_index(file_path, preset='bed', keep_original=False)
+
+
+def _pysam_lines(file_path, reference=None, start=None, end=None):
+    with pysam.TabixFile(str(file_path)) as file_:
+        if reference is None:
+            return [
+                line for contig in file_.contigs
+                for line in file_.fetch(contig, start, end)
+            ]
+        return list(file_.fetch(reference, start, end))
+
+
+class TestBgzfTabixReader(object):
+    @pytest.mark.parametrize('region', [('1', None, None),
+                                        ('1', 1000000, 1001000),
+                                        ('2', 2500000, 2600000),
+                                        ('2', 4999000, 10**8),
+                                        ('3', 0, 1000)])
+    def test_fetch_lines(self, bed_path, region):
+        """Tests fetching of regions against pysam."""
+
+        reader = bgzf.BgzfTabixReader(bed_path, n_threads=4, window_size=4)
+        lines = list(reader.fetch_lines(*region))
+
+        expected = ([] if region[0] == '3' else _pysam_lines(
+            bed_path, *region))
+
+        assert lines == expected
+
+    def test_fetch_lines_parsed(self, bed_path, mocker):
+        """Tests that positions are only parsed for boundary blocks."""
+
+        reader = bgzf.BgzfTabixReader(bed_path, n_threads=2)
+        position = mocker.spy(reader, '_position')
+
+        # Positions don't need to be checked for entire contigs.
+        assert len(list(reader.fetch_lines('1'))) == 20000
+        assert position.call_count == 0
+
+        # For regions, only blocks at the boundaries need to be checked.
+        lines = list(reader.fetch_lines('1', 1000000, 4000000))
+
+        assert lines == _pysam_lines(bed_path, '1', 1000000, 4000000)
+        assert position.call_count < len(lines)
+
+    def test_fetch_lines_all(self, bed_path):
+        """Tests scanning of the full file."""
+
+        reader = bgzf.BgzfTabixReader(bed_path, n_threads=4)
+        lines = list(reader.fetch_lines())
+
+        assert len(lines) == 40000
+        assert lines == _pysam_lines(bed_path)
+
+    def test_fetch_lines_gtf(self, gtf_path):
+        """Tests fetching from a GTF file (using 1-based positions)."""
+
+        reader = bgzf.BgzfTabixReader(gtf_path, n_threads=2)
+        region = ('1', 182407167, 182464436)
+
+        assert list(reader.fetch_lines(*region)) == _pysam_lines(
+            gtf_path, *region)
+
+    def test_fetch_batches(self, gtf_path):
+        """Tests reading batches using parallel decompression."""
+
+        gtf_iter = tabix.GtfIterator(gtf_path)
+
+        batches = list(gtf_iter.fetch_batches(n_threads=2))
+        expected = list(gtf_iter.fetch_batches())
+
+        assert len(batches) == len(expected)
+        assert all(batch.equals(exp) for batch, exp in zip(batches, expected))
@@ -0,0 +1,333 @@
+# pylint: disable=W0622,W0614,W0401
+from __future__ import absolute_import, division, print_function
+from builtins import *
+# pylint: enable=W0622,W0614,W0401
+
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from geneviz.util import genomic
+from geneviz.util.genomic import GenomicDataFrame, GenomicIntervalTree
+
+# pylint: disable=redefined-outer-name, no-self-use,too-few-public-methods
+
+
+@pytest.fixture
+def random_intervals():
+    """Random intervals on two chromosomes, including nested intervals."""
+
+    random = np.random.RandomState(0)
+
+    starts = random.randint(0, 100000, size=2000)
+    ends = starts + random.randint(1, 5000, size=2000)
+    ends[::100] += 50000
+
+    chromosomes = np.where(random.rand(2000) < 0.5, '1', '2')
+
+    return chromosomes, starts, ends
+
+
+def _brute_force(chromosomes, starts, ends, chromosome, begin, end=None):
+    if end is None:
+        mask = (starts <= begin) & (ends > begin)
+    else:
+        mask = (starts < end) & (ends > begin) & (begin < end)
+    return np.flatnonzero(mask & (chromosomes == chromosome))
+
+
+class TestGenomicIntervalTree(object):
+    def test_search_indices(self, random_intervals):
+        """Tests range and point queries against a brute force search."""
+
+        tree = GenomicIntervalTree.from_arrays(*random_intervals)
+
+        for chromosome, begin, end in [('1', 1000, 1200), ('2', 0, 10),
+                                       ('1', 60000, 90000), ('2', 99000, 10**6),
+                                       ('1', 5000, None), ('2', 500, 500)]:
+            result = tree.search_indices(chromosome, begin, end)
+            expected = _brute_force(*random_intervals, chromosome, begin, end)
+            assert sorted(result) == list(expected)
+
+    def test_search(self):
+        """Tests searching intervals built from tuples."""
+
+        tree = GenomicIntervalTree.from_tuples([('2', 10, 20, 'b'),
+                                                ('1', 30, 40, 'c'),
+                                                ('1', 0, 50, 'a')])
+
+        assert [interval.data for interval in tree.search('1', 35, 38)] == [
+            'a', 'c'
+        ]
+        assert [interval.data for interval in tree.search('1', 45)] == ['a']
+        assert tree.search('1', 50, 60) == []
+        assert len(tree['2']) == 1
+
+        with pytest.raises(KeyError):
+            tree.search('3', 0, 10)
+
+
+class TestGenomicDataFrame(object):
+    def test_search(self):
+        """Tests subsetting of rows overlapping a region."""
+
+        frame = GenomicDataFrame(
+            pd.DataFrame({
+                'chromosome': ['1', '2', '1', '1'],
+                'start': [100, 100, 150, 300],
+                'end': [200, 200, 250, 400],
+                'name': ['a', 'b', 'c', 'd']
+            }, index=[3, 2, 1, 0]))
+
+        result = frame.search('1', 180, 320)
+
+        assert list(result['name']) == ['d', 'c', 'a']
+
+
+@pytest.fixture
+def query_frame():
+    """Random query intervals, including a chromosome without targets."""
+
+    random = np.random.RandomState(1)
+
+    starts = random.randint(0, 110000, size=500)
+    ends = starts + random.randint(1, 2000, size=500)
+
+    return GenomicDataFrame(
+        pd.DataFrame({
+            'chromosome': random.choice(['1', '2', '3'], size=500),
+            'start': starts,
+            'end': ends
+        }, index=np.arange(500)[::-1]))
+
+
+@pytest.fixture
+def target_frame(random_intervals):
+    chromosomes, starts, ends = random_intervals
+    return GenomicDataFrame(
+        pd.DataFrame({
+            'chromosome': chromosomes,
+            'start': starts,
+            'end': ends,
+            'name': ['feature_{}'.format(i) for i in range(len(starts))]
+        }))
+
+
+def _brute_force_pairs(query_frame, target_frame):
+    pairs = []
+    for i, row in enumerate(query_frame.itertuples()):
+        matches = _brute_force(target_frame['chromosome'].values,
+                               target_frame['start'].values,
+                               target_frame['end'].values, row.chromosome,
+                               row.start, row.end)
+        pairs.extend((i, j) for j in matches)
+    return pairs
+
+
+class TestGenomicDataFrameOverlaps(object):
+    @pytest.mark.parametrize('n_jobs', [1, 2])
+    def test_overlap_indices(self, query_frame, target_frame, n_jobs):
+        """Tests bulk overlap queries against a brute force search."""
+
+        self_pos, other_pos = query_frame.overlap_indices(
+            target_frame, n_jobs=n_jobs)
+
+        expected = _brute_force_pairs(query_frame, target_frame)
+
+        assert len(expected) > 0
+        assert list(zip(self_pos, other_pos)) == expected
+
+    def test_overlap_indices_chunked(self, query_frame, target_frame,
+                                     monkeypatch):
+        """Tests that chunking candidates does not affect the result."""
+
+        expected = query_frame.overlap_indices(target_frame)
+
+        monkeypatch.setattr(genomic, 'MAX_CANDIDATES', 7)
+        result = query_frame.overlap_indices(target_frame)
+
+        assert np.all(result[0] == expected[0])
+        assert np.all(result[1] == expected[1])
+
+    @pytest.mark.parametrize('how', ['inner', 'left'])
+    def test_overlap_join(self, how):
+        """Tests joining of overlapping rows."""
+
+        query = GenomicDataFrame(
+            pd.DataFrame({
+                'chromosome': ['1', '1', '2'],
+                'start': [100, 1000, 100],
+                'end': [200, 1100, 200],
+                'name': ['a', 'b', 'c']
+            }, index=['x', 'y', 'z']))
+
+        target = GenomicDataFrame(
+            pd.DataFrame({
+                'chromosome': ['1', '1', '1'],
+                'start': [150, 0, 500],
+                'end': [160, 120, 600],
+                'name': ['g1', 'g2', 'g3']
+            }))
+
+        joined = query.overlap_join(target, how=how)
+
+        if how == 'inner':
+            assert list(joined.index) == ['x', 'x']
+            assert list(joined['name_other']) == ['g1', 'g2']
+        else:
+            assert list(joined.index) == ['x', 'x', 'y', 'z']
+            assert list(joined['name_other'].fillna('')) == [
+                'g1', 'g2', '', ''
+            ]
+
+        assert list(joined.columns) == [
+            'chromosome', 'start', 'end', 'name', 'chromosome_other',
+            'start_other', 'end_other', 'name_other'
+        ]
+        assert len(joined.search('1', 0, 1000)) == 2
+
+    def test_overlap_join_invalid(self, query_frame, target_frame):
+        """Tests error for unsupported join types."""
+
+        with pytest.raises(ValueError):
+            query_frame.overlap_join(target_frame, how='outer')
+
+    @pytest.mark.parametrize('n_jobs', [1, 2])
+    def test_count_overlaps(self, query_frame, target_frame, n_jobs):
+        """Tests counting of overlaps against a brute force search."""
+
+        counts = query_frame.count_overlaps(target_frame, n_jobs=n_jobs)
+
+        expected = np.zeros(len(query_frame), dtype=int)
+        for i, _ in _brute_force_pairs(query_frame, target_frame):
+            expected[i] += 1
+
+        assert list(counts.index) == list(query_frame.index)
+        assert list(counts.values) == list(expected)
+
+    def test_nearest(self, query_frame, target_frame):
+        """Tests nearest intervals against a brute force search."""
+
+        nearest = query_frame.nearest(target_frame)
+
+        for i, row in enumerate(query_frame.itertuples()):
+            on_chrom = target_frame['chromosome'].values == row.chromosome
+
+            if not on_chrom.any():
+                assert nearest['position'].iloc[i] == -1
+                assert nearest['distance'].iloc[i] == -1
+                continue
+
+            distances = np.maximum.reduce([
+                target_frame['start'].values - row.end,
+                row.start - target_frame['end'].values,
+                np.zeros(len(target_frame), dtype=int)
+            ])
+            distances = np.where(on_chrom, distances, np.iinfo(int).max)
+
+            position = nearest['position'].iloc[i]
+            assert nearest['distance'].iloc[i] == distances.min()
+            assert distances[position] == distances.min()
+
+
+class TestGenomicDataFrameTrees(object):
+    def test_carry_trees(self, target_frame):
+        """Tests that trees are kept for frames with the same rows."""
+
+        trees = target_frame.trees
+
+        assert target_frame.assign(score=1).trees is trees
+        assert target_frame[['chromosome', 'start', 'end']].trees is trees
+
+        subset = target_frame.iloc[:100]
+        assert subset.trees is not trees
+        assert len(subset.search('1', 0, 10**6)) == (
+            subset['chromosome'] == '1').sum()
+
+    def test_set_position(self, target_frame):
+        """Tests that trees are dropped when positions are assigned."""
+
+        trees = target_frame.trees
+
+        target_frame['score'] = 1
+        assert target_frame.trees is trees
+
+        target_frame['start'] = target_frame['start'] + 10**6
+        target_frame['end'] = target_frame['end'] + 10**6
+
+        assert target_frame.trees is not trees
+        assert len(target_frame.search('1', 0, 10**6)) == 0
+
+    @pytest.mark.parametrize('modify', [
+        lambda frame: frame.replace({'start': {10: 15}}),
+        lambda frame: frame.where(frame != 10, 15),
+        lambda frame: frame.loc.__setitem__((0, 'start'), 15),
+        lambda frame: frame.iloc.__setitem__((0, 1), 15),
+        lambda frame: frame.update(pd.DataFrame({'start': [15]})),
+        lambda frame: frame.replace({'start': {10: 15}}, inplace=True)
+    ])
+    def test_modify_position(self, modify):
+        """Tests that trees are rebuilt when positions are modified."""
+
+        frame = GenomicDataFrame(
+            pd.DataFrame({
+                'chromosome': ['1', '1'],
+                'start': [10, 100],
+                'end': [20, 200]
+            }))
+
+        assert list(frame.search('1', 3, 12).index) == [0]
+
+        modified = modify(frame)
+        if modified is None:
+            modified = frame
+
+        assert len(modified.search('1', 3, 12)) == 0
+        assert list(modified.search('1', 16, 18).index) == [0]
+
+    def test_save_load(self, target_frame, tmpdir):
+        """Tests searching of saved (memory-mapped) trees."""
+
+        dir_path = tmpdir / 'trees'
+        target_frame.save_trees(dir_path)
+
+        frame = GenomicDataFrame(target_frame.copy())
+        frame.load_trees(dir_path)
+
+        assert frame.trees.fingerprint == target_frame.fingerprint()
+        assert isinstance(frame.trees['1'].starts, np.memmap)
+
+        expected = target_frame.search('1', 5000, 6000)
+        assert frame.search('1', 5000, 6000).equals(expected)
+
+    def test_save_load_pickle(self, target_frame, query_frame, tmpdir):
+        """Tests that loaded trees are pickled by location."""
+
+        dir_path = tmpdir / 'trees'
+        target_frame.save_trees(dir_path)
+
+        frame = GenomicDataFrame(target_frame.copy())
+        frame.load_trees(dir_path)
+
+        unpickled = pickle.loads(pickle.dumps(frame.trees['1']))
+        assert isinstance(unpickled.starts, np.memmap)
+        assert len(pickle.dumps(frame.trees['1'])) < 1000
+
+        expected = query_frame.overlap_indices(target_frame)
+        result = query_frame.overlap_indices(frame, n_jobs=2)
+
+        assert np.all(result[0] == expected[0])
+        assert np.all(result[1] == expected[1])
+
+    def test_load_invalid(self, target_frame, tmpdir):
+        """Tests that trees of other positions are not loaded."""
+
+        dir_path = tmpdir / 'trees'
+        target_frame.save_trees(dir_path)
+
+        frame = GenomicDataFrame(target_frame.iloc[:-1])
+
+        with pytest.raises(ValueError):
+            frame.load_trees(dir_path)
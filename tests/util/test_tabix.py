@@ -3,10 +3,17 @@ from __future__ import absolute_import, division, print_function
 from builtins import *
 # pylint: enable=W0622,W0614,W0401
 
+import gzip
+from pathlib import Path
+import random
+import shutil
+
 import numpy as np
+import pandas as pd
+import pysam
 import pytest
 
-from geneviz.util import tabix
+from geneviz.util import _tabix, tabix
 
 # pylint: disable=redefined-outer-name, no-self-use,too-few-public-methods
 
@@ -144,3 +151,523 @@ class TestGtfFile(object):
 
         with pytest.raises(ValueError):
             gtf.get_gene('ENSMUSG00000000000')
+
+
+@pytest.fixture
+def gtf_copy(gtf_path, tmpdir):
+    """Copy of the test GTF, to avoid writing indices in the data dir."""
+
+    copy_path = tmpdir / 'test.gtf.gz'
+    shutil.copy(str(gtf_path), str(copy_path))
+    shutil.copy(str(gtf_path) + '.tbi', str(copy_path) + '.tbi')
+
+    return Path(str(copy_path))
+
+
+class TestGeneIndex(object):
+    def test_locate(self, gtf_copy):
+        """Tests locating genes by id and name."""
+
+        index = tabix.GeneIndex.from_gtf(gtf_copy)
+
+        location, missing = index.locate(
+            ['ENSMUSG00000026510', 'ENSMUSG00000000000'])
+        assert location == ('1', 182409171, 182462432, '+')
+        assert missing is None
+
+        by_name, = index.locate(['Trp53bp2'], field='gene_name')
+        assert by_name == location
+
+    def test_persist(self, gtf_copy):
+        """Tests that the index is written next to the GTF and reused."""
+
+        index = tabix.GeneIndex.from_gtf(gtf_copy)
+        index_path = tabix.GeneIndex.default_path(gtf_copy)
+        assert index_path.exists()
+
+        reloaded = tabix.GeneIndex.read(index_path)
+        assert (reloaded.locate(['ENSMUSG00000026510']) ==
+                index.locate(['ENSMUSG00000026510']))
+
+    def test_read_only(self, gtf_copy, mocker):
+        """Tests that the index is kept in memory if it can't be written."""
+
+        mocker.patch.object(
+            tabix.GeneIndex, 'write', side_effect=PermissionError())
+
+        index = tabix.GeneIndex.from_gtf(gtf_copy)
+
+        assert not tabix.GeneIndex.default_path(gtf_copy).exists()
+        assert index.locate(['ENSMUSG00000026510'])[0] is not None
+
+
+class TestGtfIterator(object):
+    def test_fetch_genes(self, gtf_copy):
+        """Tests fetching of gene records by id."""
+
+        gtf_iter = tabix.GtfIterator(gtf_copy)
+        gene, missing = gtf_iter.fetch_genes(
+            ['ENSMUSG00000026510', 'ENSMUSG00000000000'])
+
+        assert gene['gene_id'] == 'ENSMUSG00000026510'
+        assert gene.feature == 'gene'
+        assert missing is None
+
+    def test_fetch_genes_filters(self, gtf_copy):
+        """Tests that filters are applied to genes fetched by id."""
+
+        gtf_iter = tabix.GtfIterator(gtf_copy)
+
+        gene, = gtf_iter.fetch_genes(
+            ['ENSMUSG00000026510'], filters=[lambda rec: rec.strand == '-'])
+        assert gene is None
+
+        genes = list(gtf_iter.fetch_genes(
+            filters=[lambda rec: rec.strand == '-'], reference='1'))
+        assert len(genes) > 0
+        assert all(gene.strand == '-' and gene.contig == '1'
+                   for gene in genes)
+
+    def test_fetch_many(self, gtf_path):
+        """Tests fetching multiple (overlapping) regions in one pass."""
+
+        gtf_iter = tabix.GtfIterator(gtf_path)
+
+        regions = [('1', 182430000, 182440000), ('11', 0, 10**9),
+                   ('1', 182407167, 182464436), ('1', 182435000, 182436000),
+                   ('X', 0, 1000)]
+
+        results = gtf_iter.fetch_many(regions)
+
+        assert len(results) == len(regions)
+        assert len(results[0]) > 0
+        assert results[-1] == []
+
+        for region, records in zip(regions[:-1], results[:-1]):
+            expected = list(gtf_iter.fetch(*region))
+            assert ([str(rec) for rec in records] ==
+                    [str(rec) for rec in expected])
+
+    def test_fetch_many_nearby(self, gtf_path):
+        """Tests routing of records to many nearby (merged) regions."""
+
+        gtf_iter = tabix.GtfIterator(gtf_path)
+
+        regions = [('1', start, start + 300)
+                   for start in range(182400000, 182470000, 200)]
+        regions.append(('1', 182409000, 182463000))
+
+        results = gtf_iter.fetch_many(regions)
+
+        assert sum(len(records) > 0 for records in results) > 1
+        for region, records in zip(regions, results):
+            expected = list(gtf_iter.fetch(*region))
+            assert ([str(rec) for rec in records] ==
+                    [str(rec) for rec in expected])
+
+    def test_merge_regions(self):
+        """Tests merging of overlapping and nearby regions."""
+
+        regions = [('1', 500, 600), ('2', 0, 10), ('1', 0, 100),
+                   ('1', 50, 200), ('1', 250, 300)]
+
+        merged = tabix._merge_regions(regions, max_gap=50)
+
+        assert merged == [('1', 0, 300, [2, 3, 4]), ('1', 500, 600, [0]),
+                          ('2', 0, 10, [1])]
+
+    def test_fetch_batches(self, gtf_path):
+        """Tests batches against records fetched using pysam."""
+
+        gtf_iter = tabix.GtfIterator(gtf_path)
+        region = ('1', 182407167, 182464436)
+
+        batches = list(gtf_iter.fetch_batches(*region, batch_size=10))
+        records = list(gtf_iter.fetch(*region))
+
+        assert len(batches) > 1
+        assert all(len(batch) <= 10 for batch in batches)
+
+        frame = pd.concat(batches, ignore_index=True)
+        assert list(frame['start']) == [rec.start for rec in records]
+        assert list(frame['end']) == [rec.end for rec in records]
+        assert list(frame['feature']) == [rec.feature for rec in records]
+
+    def test_fetch_batches_filters(self, gtf_path):
+        """Tests declarative filters and attribute extraction."""
+
+        gtf_iter = tabix.GtfIterator(gtf_path)
+
+        filters = [
+            tabix.RecordFilter(
+                feature='exon',
+                strand='+',
+                attributes={'gene_id': 'ENSMUSG00000026510'})
+        ]
+        batches = gtf_iter.fetch_batches(
+            '1', filters=filters, attributes=['gene_id', 'transcript_id'])
+        frame = pd.concat(batches, ignore_index=True)
+
+        expected = [
+            rec for rec in gtf_iter.fetch('1')
+            if rec.feature == 'exon' and rec['gene_id'] == 'ENSMUSG00000026510'
+        ]
+
+        assert len(frame) == len(expected)
+        assert set(frame['gene_id']) == {'ENSMUSG00000026510'}
+        assert (list(frame['transcript_id']) ==
+                [rec['transcript_id'] for rec in expected])
+
+    def test_fetch_batches_invalid_filter(self, tmpdir):
+        """Tests filtering on columns that are not present in a file."""
+
+        bed_path = str(tmpdir / 'test.bed')
+        with open(bed_path, 'w') as file_:
+            file_.write('1\t10\t20\ta\t5\t+\n1\t30\t40\tb\t1\t-\n')
+
+        pysam.tabix_index(bed_path, preset='bed')
+        bed_iter = tabix.BedIterator(bed_path + '.gz')
+
+        frame, = bed_iter.fetch_batches(
+            '1', filters=[tabix.RecordFilter(min_score=2)])
+        assert list(frame['name']) == ['a']
+
+        with pytest.raises(ValueError):
+            list(bed_iter.fetch_batches(
+                '1', filters=[tabix.RecordFilter(feature='exon')]))
+
+
+class TestRegionCache(object):
+    def test_fetch_contained(self, gtf_path, mocker):
+        """Tests that contained regions are served from the cache."""
+
+        gtf_iter = tabix.GtfIterator(gtf_path)
+        cache = tabix.RegionCache(gtf_iter)
+
+        cache.fetch('1', 182407167, 182464436)
+
+        fetch = mocker.spy(gtf_iter, 'fetch_frame')
+        insert = mocker.spy(cache, '_insert')
+        records = cache.fetch('1', 182430000, 182440000)
+
+        assert not fetch.called
+        assert not insert.called
+        assert (records.reset_index(drop=True).equals(
+            gtf_iter.fetch_frame('1', 182430000, 182440000)))
+
+    def test_fetch_overlapping(self, gtf_path, mocker):
+        """Tests that only missing flanks of overlapping regions are fetched.
+        """
+
+        gtf_iter = tabix.GtfIterator(gtf_path)
+        cache = tabix.RegionCache(gtf_iter)
+
+        cache.fetch('1', 182420000, 182440000)
+
+        fetch = mocker.spy(gtf_iter, 'fetch_frame')
+        records = cache.fetch('1', 182407167, 182464436)
+
+        assert [call[0][1:] for call in fetch.call_args_list] == [
+            (182407167, 182420000), (182440000, 182464436)]
+
+        expected = gtf_iter.fetch_frame('1', 182407167, 182464436)
+        assert (sorted(records['attributes']) ==
+                sorted(expected['attributes']))
+        assert list(records['start']) == sorted(expected['start'])
+
+    def test_eviction(self, gtf_path):
+        """Tests eviction of regions exceeding the memory budget."""
+
+        gtf_iter = tabix.GtfIterator(gtf_path)
+        cache = tabix.RegionCache(gtf_iter, max_bytes=1)
+
+        cache.fetch('1', 182407167, 182464436)
+        cache.fetch('11', 0, 10**9)
+
+        assert list(cache._entries) == [('11', 0, 10**9)]
+
+    def test_lru_order(self, gtf_path):
+        """Tests that cache hits mark regions as recently used."""
+
+        gtf_iter = tabix.GtfIterator(gtf_path)
+        cache = tabix.RegionCache(gtf_iter)
+
+        cache.fetch('1', 182407167, 182464436)
+        cache.fetch('11', 0, 10**9)
+        nbytes = cache.nbytes
+
+        cache.fetch('1', 182430000, 182440000)
+
+        assert list(cache._entries) == [('11', 0, 10**9),
+                                        ('1', 182407167, 182464436)]
+        assert cache.nbytes == nbytes
+
+
+class TestCompress(object):
+    @pytest.fixture
+    def gtf_lines(self, gtf_path):
+        with gzip.open(str(gtf_path), 'rt') as file_:
+            return [line for line in file_ if not line.startswith('#')]
+
+    def test_compress_gtf(self, gtf_lines, tmpdir):
+        """Tests sorting, compressing and indexing of an unsorted GTF."""
+
+        random.seed(0)
+        shuffled = list(gtf_lines)
+        random.shuffle(shuffled)
+
+        file_path = str(tmpdir / 'shuffled.gtf')
+        with open(file_path, 'w') as file_:
+            file_.write('#!comment\n')
+            file_.writelines(shuffled)
+
+        out_path = _tabix.GtfFile.compress(file_path, max_lines=100)
+
+        with pysam.TabixFile(out_path, parser=pysam.asGTF()) as file_:
+            records = [str(rec) for contig in file_.contigs
+                       for rec in file_.fetch(contig)]
+            header = list(file_.header)
+
+        assert header == ['#!comment']
+        assert sorted(records) == sorted(
+            line.rstrip('\n') for line in gtf_lines)
+
+    @pytest.mark.parametrize('contigs', [['1', '11'], ['11', '1']])
+    def test_compress_sorted(self, gtf_lines, tmpdir, mocker, contigs):
+        """Tests that sorting is skipped for sorted files.
+
+        Contigs don't need to be in lexicographic order (e.g. karyotype
+        order, in which chr2 precedes chr10).
+        """
+
+        lines = sorted(gtf_lines, key=_tabix._gtf_sort_key)
+        lines = sorted(lines, key=lambda line: contigs.index(line.split()[0]))
+
+        file_path = str(tmpdir / 'sorted.gtf')
+        with open(file_path, 'w') as file_:
+            file_.writelines(lines)
+
+        sort_mock = mocker.spy(_tabix, 'external_sort')
+        out_path = _tabix.GtfFile.compress(file_path)
+
+        assert not sort_mock.called
+        assert len(list(tabix.GtfIterator(out_path).fetch('1'))) > 0
+        assert len(list(tabix.GtfIterator(out_path).fetch('11'))) > 0
+
+    def test_is_sorted(self):
+        """Tests detection of sorted lines."""
+
+        key = _tabix._bed_sort_key
+
+        assert _tabix.is_sorted(['2\t5\t10\n', '10\t1\t5\n'], key=key)
+        assert not _tabix.is_sorted(['2\t5\t10\n', '2\t1\t5\n'], key=key)
+        assert not _tabix.is_sorted(
+            ['2\t5\t10\n', '10\t1\t5\n', '2\t20\t30\n'], key=key)
+
+    def test_compress_bed(self, tmpdir):
+        """Tests compressing and indexing of an unsorted BED file."""
+
+        file_path = str(tmpdir / 'test.bed')
+        with open(file_path, 'w') as file_:
+            file_.write('track name=test\n')
+            file_.write('2\t5\t10\tc\n1\t30\t40\tb\n1\t10\t20\ta\n')
+
+        out_path = _tabix.BedFile.compress(file_path, max_lines=1)
+
+        names = [rec.name for rec in tabix.BedIterator(out_path).fetch()]
+        assert names == ['a', 'b', 'c']
+
+    @pytest.mark.parametrize('records', [
+        '1\t10\t20\ta\n\n1\t30\t40\tb\nbrowser hide all\n2\t5\t10\tc\n',
+        '2\t5\t10\tc\n\nbrowser hide all\n1\t30\t40\tb\n1\t10\t20\ta\n\n'
+    ])
+    def test_compress_bed_headers(self, tmpdir, records):
+        """Tests compressing a BED file with blank and interleaved headers."""
+
+        file_path = str(tmpdir / 'test.bed')
+        with open(file_path, 'w') as file_:
+            file_.write('track name=test\n#comment\n')
+            file_.write(records)
+
+        assert _tabix._count_skipped(file_path) == 3
+
+        out_path = _tabix.BedFile.compress(file_path, max_lines=1)
+
+        names = [rec.name for rec in tabix.BedIterator(out_path).fetch()]
+        assert names == ['a', 'b', 'c']
+
+
+class TestFetchFrame(object):
+    def test_gtf(self, gtf_path):
+        """Tests columnar frames against frames built from Series."""
+
+        gtf_file = _tabix.GtfFile(gtf_path)
+
+        frame = gtf_file.fetch_frame('1', 182407167, 182464436)
+        expected = _tabix.GtfFrame.from_records(
+            _tabix.GtfFile._to_series(rec)
+            for rec in gtf_file.fetch('1', 182407167, 182464436, raw=True))
+
+        assert len(frame) > 0
+        assert frame['feature'].dtype.name == 'category'
+        pd.testing.assert_frame_equal(frame, expected)
+
+    def test_bed(self, tmpdir):
+        """Tests columnar frames for BED files with optional fields."""
+
+        file_path = str(tmpdir / 'test.bed')
+        with open(file_path, 'w') as file_:
+            file_.write('1\t10\t20\ta\t5\t+\n1\t30\t40\tb\t.\t-\n')
+
+        bed_file = _tabix.BedFile(_tabix.BedFile.compress(file_path))
+
+        frame = bed_file.fetch_frame('1', 0, 100)
+        expected = _tabix.BedFrame.from_records(
+            [_tabix.BedFile._to_series(rec)
+             for rec in bed_file.fetch('1', 0, 100, raw=True)])
+
+        assert list(frame['score'].isnull()) == [False, True]
+        assert frame['chrom'].dtype.name == 'category'
+        pd.testing.assert_frame_equal(frame, expected)
+
+
+class TestGtfFrame(object):
+    def test_read_csv(self, gtf_path):
+        """Tests reading a GTF file with all attributes."""
+
+        frame = _tabix.GtfFrame.read_csv(gtf_path, chunksize=50)
+
+        assert len(frame) > 0
+        assert set(frame['contig']) == {'1', '11'}
+        assert 'attribute' not in frame.columns
+        assert frame['gene_id'].dtype.name == 'category'
+
+        gene = frame.loc[frame['gene_id'] == 'ENSMUSG00000026510']
+        gene = gene.loc[gene['feature'] == 'gene'].iloc[0]
+
+        assert gene['gene_name'] == 'Trp53bp2'
+        assert gene['start'] == 182409172
+        assert gene['end'] == 182462432
+        assert np.isnan(gene['score'])
+
+    def test_read_csv_attributes(self, gtf_path):
+        """Tests reading a selection of attributes in parallel."""
+
+        expected = _tabix.GtfFrame.read_csv(gtf_path)
+
+        frame = _tabix.GtfFrame.read_csv(
+            gtf_path, attributes=['gene_id', 'exon_number'], chunksize=50,
+            n_jobs=2)
+
+        assert list(frame.columns[8:]) == ['exon_number', 'gene_id']
+        assert (list(frame['exon_number'].astype(str)) ==
+                list(expected['exon_number'].astype(str)))
+
+    def test_parse_attributes(self):
+        """Tests parsing of (unquoted or similarly named) attributes."""
+
+        chunk = pd.DataFrame({
+            'attribute': [
+                'gene_id "a"; havana_gene_id "b"; level 2;',
+                'havana_gene_id "c"; gene_id "d"; tag "x y";',
+            ]
+        })
+
+        parsed = _tabix._parse_gtf_chunk(chunk)
+
+        assert list(parsed.columns) == [
+            'gene_id', 'havana_gene_id', 'level', 'tag'
+        ]
+        assert list(parsed['gene_id']) == ['a', 'd']
+        assert list(parsed['havana_gene_id']) == ['b', 'c']
+        assert list(parsed['level'].astype(object).fillna('')) == ['2', '']
+        assert list(parsed['tag'].astype(object).fillna('')) == ['', 'x y']
+
+    def test_read_csv_kwargs(self, gtf_path):
+        """Tests passing of extra arguments to pandas.read_csv."""
+
+        frame = _tabix.GtfFrame.read_csv(gtf_path, nrows=10, chunksize=4)
+
+        assert len(frame) == 10
+        assert frame['contig'].dtype.name == 'category'
+
+    @pytest.mark.parametrize('kwargs', [
+        {}, {'incl_left': False, 'incl_right': False},
+        {'filters': {'feature': 'exon'}}
+    ])
+    def test_fetch_frame(self, gtf_path, kwargs):
+        """Tests indexed region lookups against a full scan."""
+
+        frame = _tabix.GtfFrame.read_csv(gtf_path)
+        start, end = 182409172, 182430000
+
+        result = frame.fetch_frame('1', start, end, **kwargs)
+
+        mask = ((frame['contig'] == '1') & (frame['start'] <= end) &
+                (frame['end'] >= start))
+        if 'incl_left' in kwargs:
+            mask &= (frame['start'] > start) & (frame['end'] < end)
+        for name, value in kwargs.get('filters', {}).items():
+            mask &= frame[name] == value
+
+        assert len(result) > 0
+        assert list(result.index) == list(frame.index[mask.values])
+
+    def test_region_index_reset(self, gtf_path):
+        """Tests that the index is dropped when positions are changed."""
+
+        frame = _tabix.GtfFrame.read_csv(gtf_path)
+        assert len(frame.fetch_frame('11', 0, 10)) == 0
+
+        frame['start'] = 0
+        assert len(frame.fetch_frame('11', 0, 10)) > 0
+
+        # Derived frames should not reuse the index of the original frame.
+        subset = frame.loc[frame['contig'] == '1']
+        assert '_region_index' not in subset.__dict__
+        assert set(subset.fetch_frame()['contig']) == {'1'}
+
+    def test_region_index_inplace(self, gtf_path):
+        """Tests that the index is rebuilt after in-place operations."""
+
+        frame = _tabix.GtfFrame.read_csv(gtf_path)
+        start, end = 182409172, 182430000
+
+        expected = frame.fetch_frame('1', start, end)
+        assert len(expected) > 0
+
+        frame.sort_values('end', ascending=False, inplace=True)
+        result = frame.fetch_frame('1', start, end)
+        assert sorted(result.index) == sorted(expected.index)
+
+        frame.drop(expected.index[:2], inplace=True)
+        result = frame.fetch_frame('1', start, end)
+        assert sorted(result.index) == sorted(expected.index[2:])
+
+
+class TestBedFrame(object):
+    def test_fetch_frame(self):
+        """Tests region lookups using BED column names."""
+
+        frame = _tabix.BedFrame({
+            'chrom': ['1', '1', '2'],
+            'chromStart': [10, 30, 10],
+            'chromEnd': [20, 40, 20],
+            'name': ['a', 'b', 'c']
+        })
+
+        assert list(frame.fetch_frame('1', 15, 25)['name']) == ['a']
+        assert list(frame.fetch_frame('1')['name']) == ['a', 'b']
+
+    def test_read(self, tmpdir):
+        """Tests reading a BED file with the same dtypes as fetched frames."""
+
+        file_path = str(tmpdir / 'test.bed')
+        with open(file_path, 'w') as file_:
+            file_.write('track name=test\n')
+            file_.write('1\t10\t20\ta\n2\t30\t40\tb\n')
+
+        frame = _tabix.BedFrame.read(file_path)
+
+        assert frame['chrom'].dtype.name == 'category'
+        assert list(frame.fetch_frame('2')['name']) == ['b']